@@ -1,6 +1,17 @@
-from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs, get_pop_freqs
-from popopolus.calculate_frequencies.impute import average_missing, remove_missing
-
 """
 popopolus takes a vcf as input to create a matrix of allele frequencies
-"""
\ No newline at end of file
+"""
+import importlib
+
+# Re-exports are imported on first use so that the CLI and light submodules such as popopolus.utils start without numpy and pandas
+_EXPORTS = {
+    'get_ind_freqs': 'popopolus.calculate_frequencies.calculate_frequencies',
+    'get_pop_freqs': 'popopolus.calculate_frequencies.calculate_frequencies',
+    'average_missing': 'popopolus.calculate_frequencies.impute',
+    'remove_missing': 'popopolus.calculate_frequencies.impute'
+}
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return(getattr(importlib.import_module(_EXPORTS[name]), name))
+    raise AttributeError(f"module 'popopolus' has no attribute '{name}'")
@@ -1,8 +1,8 @@
+"""
+Calculate allele balance for variants from a multisample vcf
+"""
 from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
 from popopolus.calculate_frequencies.calculate_frequencies import get_pop_freqs
+from popopolus.calculate_frequencies.calculate_frequencies import write_ind_freqs
 from popopolus.calculate_frequencies.impute import average_missing
 from popopolus.calculate_frequencies.impute import remove_missing
-
-"""
-Calculate allele balance for variants from a multisample vcf
-"""
\ No newline at end of file
@@ -1,10 +1,29 @@
 import re
 import numpy as np
-import pandas as pd
 import logging
+from popopolus.utils import open_vcf, check_individuals
+from popopolus.calculate_frequencies.vcf_blocks import read_vcf_samples, population_index, iter_pop_count_blocks
 
 
-def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_qual, pate_flag, output_dir):
+def _grow_rows(arrays, n_rows):
+    '''
+    Returns the arrays with twice as many rows, keeping the first n_rows filled ones.
+    '''
+    grown = {}
+    for name, array in arrays.items():
+        grown[name] = np.empty((2 * max(array.shape[0], 1),) + array.shape[1:], dtype=array.dtype)
+        grown[name][:n_rows] = array[:n_rows]
+    return(grown)
+
+def ingestion_checkpoint(checkpoint_dir, vcf_file, ind_map, min_depth, min_count, min_qual, pate_flag):
+    '''
+    Returns the IngestionCheckpoint of reading vcf_file with these filters and individuals.
+    '''
+    from popopolus.checkpoint import IngestionCheckpoint
+    settings = {'individuals': sorted(ind_map.keys()), 'min_depth': min_depth, 'min_count': min_count, 'min_qual': min_qual, 'pate_flag': pate_flag}
+    return(IngestionCheckpoint(checkpoint_dir, vcf_file, settings))
+
+def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_qual, pate_flag, output_dir, keep_coordinates=False, checkpoint_dir=None, resume=False, checkpoint_interval=100000):
     '''
     Returns an np.array object of allele balance across sites for each individual from a multisample vcf.
 
@@ -12,26 +31,39 @@ def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_q
         n_sites (int): the number of sites to process from the VCF
         n_tax (int): the number of individuals to process from the VCF
         ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier 
-        vcf_file (string): a multisample vcf file uncompressed
+        vcf_file (string): a multisample vcf file uncompressed, or '-' to read the standard input in a single pass.
+            Arrays grow as sites are read when n_sites is not known in advance.
         min_depth (int): the minimum depth of a site to be considered high-quality
         min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
         min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
         pate_flag (bool): is the VCF a direct product of the PATE pipeline
         output_dir (string): the directory where all results will be written
+        keep_coordinates (bool): also return the chromosome and position of every site
+        checkpoint_dir (string): if given, the rows read so far are saved there with the byte offset reached every checkpoint_interval sites
+        resume (bool): continue from the checkpoint in checkpoint_dir if the VCF and filters are unchanged
+        checkpoint_interval (int): the number of sites read between checkpoints
 
     Returns:
         tax_list (list): A list of individual labels
         ab_dat: a numpy array of allele balance data as well as depth, genotype quality, and filtering information
+        coordinates (tuple): only with keep_coordinates. A list of chromosome names, the index of each site's chromosome in that list, and each site's position
     '''
     
     # Goal - these all need to be typed as arrays to keep the memory from exploding
     # The individual files can be written out using pandas from array
+    # Without counts from get_vcf_dimensions, as for a stream, the arrays start small and double when full
+    if n_sites <= 0:
+        n_sites = 65536
+    if n_tax <= 0:
+        n_tax = len(ind_map)
     allele_balance_data = np.empty((n_sites, n_tax), dtype=np.float32)
     site_depth_data = np.empty((n_sites, n_tax), dtype=np.uint16)
     genotype_quality_data = np.empty((n_sites, n_tax), dtype=np.uint8)
     passing_filter_data = np.empty((n_sites, n_tax), dtype=np.bool_)
-    # chromosome_data = {}
-    # site_position_data = {}
+    # Chromosomes are stored as codes into chromosome_names to keep coordinates small
+    chromosome_data = np.empty(n_sites, dtype=np.int32)
+    site_position_data = np.empty(n_sites, dtype=np.int64)
+    chromosome_names = {}
     vcf_map = {}
     vcf_index = {}
     tax_list = []
@@ -39,10 +71,39 @@ def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_q
     n_sites = 0
     n_variants = {}
     skip_header = 1
+    n_sites_total, n_tax_total = allele_balance_data.shape
+    arrays = {'allele_balance': allele_balance_data, 'depth': site_depth_data, 'genotype_quality': genotype_quality_data,
+              'passing': passing_filter_data, 'chromosome': chromosome_data, 'position': site_position_data}
+    offset = 0
+    checkpoint = None
+    # Checkpointed reads always record coordinates so a resumed read can return them
+    record_coordinates = keep_coordinates or (checkpoint_dir is not None)
+    if (checkpoint_dir is not None) and (vcf_file == '-'):
+        raise ValueError('Ingestion checkpoints need a VCF file that can be read again. Standard input cannot be checkpointed.')
+    if checkpoint_dir is not None:
+        checkpoint = ingestion_checkpoint(checkpoint_dir, vcf_file, ind_map, min_depth, min_count, min_qual, pate_flag)
+        state = checkpoint.load() if resume else None
+        if state is None:
+            checkpoint.clear()
+        else:
+            checkpoint.restore(arrays)
+            tax_list = state['tax_list']
+            vcf_map = {int(column): tax for column, tax in state['vcf_map'].items()}
+            vcf_index = {tax: k for k, tax in enumerate(tax_list)}
+            n_variants = state['n_variants']
+            chromosome_names = state['chromosome_names']
+            n_tax = len(tax_list)
+            n_sites = state['n_sites']
+            offset = state['offset']
+            skip_header = 0
 
-    with open(vcf_file,'r') as fh:
-        for line in fh:
-            line = line.strip()
+    # Read as bytes so the offset of every line is known for checkpoints
+    with open_vcf(vcf_file, binary=True) as fh:
+        if offset > 0:
+            fh.seek(offset)
+        for raw_line in fh:
+            offset += len(raw_line)
+            line = raw_line.decode().strip()
             if '#CHROM' in line:
                 temp = line.split()
                 #print(line)
@@ -76,6 +137,16 @@ def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_q
                 if skip_header == 0:
                     temp = line.split()
                     if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')):
+                        if n_sites == len(chromosome_data):
+                            arrays = _grow_rows(arrays, n_sites)
+                            allele_balance_data, site_depth_data = arrays['allele_balance'], arrays['depth']
+                            genotype_quality_data, passing_filter_data = arrays['genotype_quality'], arrays['passing']
+                            chromosome_data, site_position_data = arrays['chromosome'], arrays['position']
+                        if record_coordinates:
+                            if temp[0] not in chromosome_names:
+                                chromosome_names[temp[0]] = len(chromosome_names)
+                            chromosome_data[n_sites] = chromosome_names[temp[0]]
+                            site_position_data[n_sites] = int(temp[1])
                         for i in range(9, len(temp)): ####Continue fixing here
                             if i in vcf_map.keys():
                                 ref_counts = 0
@@ -112,46 +183,114 @@ def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_q
                                 # site_position_data[vcf_map[i]].append(temp[1])
                                 n_variants[vcf_map[i]] = n_variants[vcf_map[i]] + 1
                         n_sites = n_sites + 1
+                        if (checkpoint is not None) and (n_sites - checkpoint.saved_sites >= checkpoint_interval):
+                            checkpoint.save(offset, n_sites, arrays, {
+                                'tax_list': tax_list, 'vcf_map': vcf_map, 'n_variants': n_variants,
+                                'chromosome_names': chromosome_names, 'n_sites_total': n_sites_total, 'n_tax_total': n_tax_total
+                            })
+    if checkpoint is not None:
+        checkpoint.clear()
 
-    if (output_dir != 'dummy'):
-        for i in range(0, len(tax_list)):
-            output_file = f'{output_dir}/{tax_list[i]}.txt'
-            outfile = open(output_file, 'w')
-            #outfile.write('chr\tpos\tallele_balance\tdepth\tgenotype_quality\tpass_filters\n')
-            outfile.write('allele_balance\tdepth\tgenotype_quality\tpass_filters\n')
-            for j in range(0, n_variants[tax_list[i]]):
-                # outstring = f'{chromosome_data[tax_list[i]][j]}\t{site_position_data[tax_list[i]][j]}\t{allele_balance_data[tax_list[i]][j]}\t{site_depth_data[tax_list[i]][j]}\t{genotype_quality_data[tax_list[i]][j]}\t{passing_filter_data[tax_list[i]][j]}\n'
-                outstring = f'{allele_balance_data[j,vcf_index[tax_list[i]]]}\t{site_depth_data[j,vcf_index[tax_list[i]]]}\t{genotype_quality_data[j,vcf_index[tax_list[i]]]}\t{passing_filter_data[j,vcf_index[tax_list[i]]]}\n'
-                outfile.write(outstring)
-            outfile.close()
-        # Free up memory from the lists of positional information    
-        #chromosome_data.clear()
-        #site_position_data.clear()
-        # Free the memory from individual lists as they are typed into the nd-array
-        #allele_balance_data.clear()
-        #site_depth_data.clear()
-        #genotype_quality_data.clear()
-        #passing_filter_data.clear()
+    # Free up memory from the lists of positional information    
+    #chromosome_data.clear()
+    #site_position_data.clear()
+    # Free the memory from individual lists as they are typed into the nd-array
+    #allele_balance_data.clear()
+    #site_depth_data.clear()
+    #genotype_quality_data.clear()
+    #passing_filter_data.clear()
     
     #allele_balance_array = np.array(list(allele_balance_data.values()), dtype=np.float32).transpose()
     #site_depth_array = np.array(list(site_depth_data.values()), dtype=np.uint16).transpose()
     #genotype_quality_array = np.array(list(genotype_quality_data.values()), dtype=np.uint8).transpose()
     #passing_filter_array = np.array(list(passing_filter_data.values()), dtype=np.bool_).transpose()
     
+    if vcf_file == '-':
+        check_individuals(ind_map, tax_list)
+    # Rows beyond n_sites are unused capacity of grown arrays
     ab_dat = np.array([
-        allele_balance_data,
-        site_depth_data,
-        genotype_quality_data,
-        passing_filter_data
+        allele_balance_data[:n_sites, :n_tax],
+        site_depth_data[:n_sites, :n_tax],
+        genotype_quality_data[:n_sites, :n_tax],
+        passing_filter_data[:n_sites, :n_tax]
     ])
     
+    if (output_dir != 'dummy'):
+        write_ind_freqs(tax_list, ab_dat, output_dir)
+
     #ab_df = pd.DataFrame(allele_balance_data)
     #print(ab_df)
     logging.info(f'Array shape: {ab_dat.shape}')
     logging.info(f'Memory usage: {ab_dat.nbytes / 1024 / 1024:.2f} MB')
     logging.info(f'Processed VCF of {n_sites} for {n_tax}\n')
+    if keep_coordinates:
+        return(tax_list, ab_dat, (list(chromosome_names.keys()), chromosome_data[:n_sites], site_position_data[:n_sites]))
     return(tax_list, ab_dat)
 
 
-def get_pop_freqs (ind_map, vcf_file, min_depth, min_count, output_file):
-    pass
+def write_ind_freqs(tax_list, ab_dat, output_dir):
+    '''
+    Writes the allele balance, depth, genotype quality, and filter status of every site to one file per individual.
+
+    Parameters:
+        tax_list (list): A list of individual labels in the individual order of ab_dat
+        ab_dat (np.array): allele balance data returned from get_ind_freqs, possibly with imputed allele balances
+        output_dir (string): the directory where all results will be written
+    '''
+    for i in range(0, len(tax_list)):
+        # Columns are cast back to the types they are read as so files look the same as before stacking
+        allele_balance_data = ab_dat[0,:,i].astype(np.float32)
+        site_depth_data = ab_dat[1,:,i].astype(np.uint16)
+        genotype_quality_data = ab_dat[2,:,i].astype(np.uint8)
+        passing_filter_data = ab_dat[3,:,i].astype(np.bool_)
+        output_file = f'{output_dir}/{tax_list[i]}.txt'
+        outfile = open(output_file, 'w')
+        #outfile.write('chr\tpos\tallele_balance\tdepth\tgenotype_quality\tpass_filters\n')
+        outfile.write('allele_balance\tdepth\tgenotype_quality\tpass_filters\n')
+        for j in range(0, ab_dat.shape[1]):
+            outstring = f'{allele_balance_data[j]}\t{site_depth_data[j]}\t{genotype_quality_data[j]}\t{passing_filter_data[j]}\n'
+            outfile.write(outstring)
+        outfile.close()
+
+
+def get_pop_freqs(ind_map, vcf_file, min_depth, min_count, output_file, pate_flag=False, min_qual=0, block_size=10000):
+    '''
+    Writes a matrix of population allele frequencies across sites from a multisample vcf.
+    Reads of the individuals in each population are pooled and the frequency is the alternate fraction of the pooled reads.
+    The VCF is processed in blocks of sites and each block is appended to output_file, so the matrix is never held in memory.
+
+    Parameters:
+        ind_map (dict): a dictionary mapping individuals in the VCF to their sample sheet row, which must have a population column
+        vcf_file (string): a multisample vcf file uncompressed
+        min_depth (int): the minimum depth of an individual at a site for its reads to be counted
+        min_count (int): the minimum number of pooled reads supporting the minor allele for a site to be written
+        output_file (string): tab-separated output with chrom, pos, and one column per population. NA where a population has no reads.
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        min_qual (int): the minimum phred-scaled genotype quality of an individual at a site for its reads to be counted
+        block_size (int): the number of sites processed at once
+
+    Returns:
+        populations (list): the population names in column order
+        n_written (int): the number of sites written
+    '''
+    import pandas as pd
+    populations, columns, starts = population_index(read_vcf_samples(vcf_file, pate_flag), ind_map)
+    logging.info(f'Pooling reads of {len(columns)} individuals into {len(populations)} populations')
+    n_sites = 0
+    n_written = 0
+    with open(output_file, 'w') as outfile:
+        outfile.write('chrom\tpos\t' + '\t'.join(populations) + '\n')
+        for chrom, pos, pop_alt, pop_depth, pop_n in iter_pop_count_blocks(vcf_file, columns, starts, pate_flag, min_depth, min_qual, block_size):
+            total_alt = pop_alt.sum(axis=1)
+            total_depth = pop_depth.sum(axis=1)
+            keep = np.minimum(total_alt, total_depth - total_alt) >= min_count
+            with np.errstate(divide='ignore', invalid='ignore'):
+                freqs = pop_alt[keep] / pop_depth[keep]
+            block_df = pd.DataFrame(freqs, columns=populations)
+            block_df.insert(0, 'pos', pos[keep])
+            block_df.insert(0, 'chrom', np.array(chrom)[keep])
+            block_df.to_csv(outfile, sep='\t', header=False, index=False, na_rep='NA', float_format='%.6g')
+            n_sites += len(pos)
+            n_written += int(keep.sum())
+    logging.info(f'Wrote population allele frequencies of {n_written} of {n_sites} sites to {output_file}')
+    return(populations, n_written)
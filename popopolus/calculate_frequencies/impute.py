@@ -1,5 +1,89 @@
-def average_missing():
-    pass
+import numpy as np
+import logging
 
-def remove_missing():
-    pass
\ No newline at end of file
+####
+# Imputation of allele balance at missing genotypes
+# A genotype is missing where its depth or genotype quality fails the filters. The pass_filters row of get_ind_freqs
+# only passes heterozygotes, so it is not used here and homozygous allele balances of 0 and 1 count as data.
+# Both functions work in place on the ab_dat array from get_ind_freqs and visit it in chunks of sites,
+# so temporary arrays are bounded by chunk_size and the full (n_sites, n_tax) matrix is never copied.
+####
+def valid_genotypes(ab_dat, start, stop, min_depth=1, min_qual=0):
+    '''
+    Returns the genotypes of sites start to stop with at least max(min_depth, 1) reads and a genotype quality of at least min_qual.
+    '''
+    return((ab_dat[1, start:stop] >= max(min_depth, 1)) & (ab_dat[2, start:stop] >= min_qual))
+
+def average_missing(ab_dat, tax_list=None, ind_map=None, method='mean', chunk_size=100000, population_key='population', min_depth=1, min_qual=0):
+    '''
+    Replaces the allele balance of every missing genotype at a site with an average over the valid genotypes.
+    The pass_filters flags are left unchanged.
+
+    Parameters:
+        ab_dat (np.array): allele balance data returned from get_ind_freqs, modified in place
+        tax_list (list): individual labels in the individual order of ab_dat. Needed for popmean.
+        ind_map (dict): a dictionary mapping individuals to their sample sheet row. Needed for popmean.
+        method (string): mean averages over all valid genotypes at the site. popmean averages over valid
+            genotypes of the same population and falls back to mean where the whole population is missing.
+        chunk_size (int): the number of sites processed at once
+        population_key (string): the sample sheet column holding populations
+        min_depth (int): the minimum depth of a valid genotype
+        min_qual (int): the minimum phred-scaled genotype quality of a valid genotype
+
+    Returns:
+        n_imputed (int): the number of allele balances replaced
+    '''
+    if method not in ['mean', 'popmean']:
+        raise ValueError(f"Unsupported imputation method {method}. Use 'mean' or 'popmean'.")
+    n_sites = ab_dat.shape[1]
+    allele_balance = ab_dat[0]
+    if method == 'popmean':
+        labels = [str(ind_map[tax][population_key]) for tax in tax_list]
+        populations, pop_code = np.unique(labels, return_inverse=True)
+        # Indicator matrix turns grouped sums over individuals into one matrix product per chunk
+        indicator = np.zeros((len(tax_list), len(populations)), dtype=allele_balance.dtype)
+        indicator[np.arange(len(tax_list)), pop_code] = 1
+        logging.info(f'Imputing missing allele balance with the mean of {len(populations)} populations')
+    n_imputed = 0
+    for start in range(0, n_sites, chunk_size):
+        ab_chunk = allele_balance[start:start + chunk_size]
+        valid = valid_genotypes(ab_dat, start, start + chunk_size, min_depth, min_qual)
+        valid_ab = np.where(valid, ab_chunk, 0)
+        n_valid = valid.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fill = np.broadcast_to((valid_ab.sum(axis=1) / n_valid)[:, np.newaxis], ab_chunk.shape)
+            if method == 'popmean':
+                pop_n = valid.astype(allele_balance.dtype) @ indicator
+                pop_mean = (valid_ab @ indicator) / pop_n
+                fill = np.where((pop_n > 0)[:, pop_code], pop_mean[:, pop_code], fill)
+        missing = ~valid & (n_valid > 0)[:, np.newaxis]
+        np.copyto(ab_chunk, fill, where=missing)
+        n_imputed += int(missing.sum())
+    logging.info(f'Imputed {n_imputed} allele balances by {method}')
+    return(n_imputed)
+
+def remove_missing(ab_dat, max_missing=0.0, chunk_size=100000, min_depth=1, min_qual=0):
+    '''
+    Removes sites where more than max_missing of individuals have missing genotypes by compacting kept sites to the front of ab_dat in place.
+
+    Parameters:
+        ab_dat (np.array): allele balance data returned from get_ind_freqs, modified in place
+        max_missing (float): the largest fraction of individuals with missing genotypes for a site to be kept
+        chunk_size (int): the number of sites processed at once
+        min_depth (int): the minimum depth of a valid genotype
+        min_qual (int): the minimum phred-scaled genotype quality of a valid genotype
+
+    Returns:
+        ab_dat (np.array): a view of the first n_kept sites of the input array
+    '''
+    n_sites = ab_dat.shape[1]
+    n_tax = ab_dat.shape[2]
+    n_kept = 0
+    for start in range(0, n_sites, chunk_size):
+        n_missing = (~valid_genotypes(ab_dat, start, start + chunk_size, min_depth, min_qual)).sum(axis=1)
+        keep = np.flatnonzero(n_missing <= max_missing * n_tax) + start
+        # Kept sites only move towards the front, so sites not yet visited are never overwritten
+        ab_dat[:, n_kept:n_kept + len(keep)] = ab_dat[:, keep]
+        n_kept += len(keep)
+    logging.info(f'Kept {n_kept} of {n_sites} sites with at most {max_missing} of individuals missing')
+    return(ab_dat[:, :n_kept])
@@ -0,0 +1,248 @@
+import re
+from itertools import chain
+import numpy as np
+import logging
+from popopolus.utils import open_vcf
+
+####
+# Block-wise VCF reading
+# Sites are parsed in blocks of block_size into integer count matrices so downstream sums over
+# samples are vectorized and memory does not grow with the number of sites.
+####
+def vcf_sample_name(column, pate_flag):
+    '''
+    Returns the individual name of a VCF sample column, which may be a path to the individual's alignment.
+
+    Parameters:
+        column (string): the sample column from the #CHROM line
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+
+    Returns:
+        name (string): the individual name
+    '''
+    if '/' in column:
+        tax_path = column.split('/')
+        if pate_flag == True:
+            return(tax_path[-2])
+        return(tax_path[-1])
+    return(column)
+
+def read_vcf_samples(vcf_file, pate_flag):
+    '''
+    Returns the individual names of all sample columns of a VCF in column order.
+    '''
+    with open_vcf(vcf_file) as fh:
+        for line in fh:
+            if line.startswith('#CHROM'):
+                return([vcf_sample_name(column, pate_flag) for column in line.split()[9:]])
+    raise ValueError(f'No #CHROM header line found in {vcf_file}')
+
+def population_index(sample_names, ind_map, population_key='population'):
+    '''
+    Returns the sample columns to read grouped by population, for sums over the samples of each population with population_sums.
+
+    Parameters:
+        sample_names (list): individual names of the VCF sample columns in column order
+        ind_map (dict): a dictionary mapping individuals in the VCF to their sample sheet row
+        population_key (string): the sample sheet column holding populations
+
+    Returns:
+        populations (list): population names in sorted order
+        columns (np.array): indices of the sample columns to read, sorted by population
+        starts (np.array): the position in columns where each population begins
+    '''
+    in_map = [i for i, name in enumerate(sample_names) if name in ind_map]
+    labels = np.array([str(ind_map[sample_names[i]][population_key]) for i in in_map])
+    populations, codes = np.unique(labels, return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    columns = np.array(in_map, dtype=np.int64)[order]
+    starts = np.searchsorted(codes[order], np.arange(len(populations)))
+    return(list(populations), columns, starts)
+
+# Matches every genotype on its own line. Genotypes with at least five fields and allelic depths in the second field
+# fill the reference count, alternate count, and, where the fourth field is a number, genotype quality groups.
+# Any other genotype falls through to the second alternative and leaves all three groups empty.
+GENOTYPE_FIELDS = re.compile(r'^[^:\n]*:(\d+),(\d+)[^:\n]*:[^:\n]*:(?:(\d+)|[^:\n]*):[^\n]*$|^[^\n]*$', re.MULTILINE)
+
+def parse_allele_counts(records, columns):
+    '''
+    Returns reference counts, alternate counts, and genotype qualities of a block of VCF records.
+    Genotypes are read the same way as get_ind_freqs: allelic depths in the second field and genotype quality
+    in the fourth. Malformed or missing genotypes count as zero reads.
+
+    Parameters:
+        records (list): VCF records split on whitespace
+        columns (np.array): indices of the sample columns to read, counted from the first sample column
+
+    Returns:
+        ref (np.array): reference counts of every site (rows) and sample (columns)
+        alt (np.array): alternate counts
+        gq (np.array): genotype qualities
+    '''
+    if (len(records) == 0) or (len(columns) == 0):
+        empty = np.zeros((len(records), len(columns)), dtype=np.int32)
+        return(empty, empty.copy(), empty.copy())
+    # One regex scan over the genotypes of the whole block replaces splitting every genotype in Python,
+    # and prefixing every captured group with 0 turns empty groups into zeros for a single numeric parse
+    columns = [int(column) for column in columns]
+    genotypes = '\n'.join([record[9 + column] for record in records for column in columns])
+    fields = GENOTYPE_FIELDS.findall(genotypes)
+    counts = np.fromstring('0' + ' 0'.join(chain.from_iterable(fields)), dtype=np.int32, sep=' ').reshape(len(records), len(columns), 3)
+    return(counts[:, :, 0], counts[:, :, 1], counts[:, :, 2])
+
+def parse_ind_block(records, columns, min_depth, min_count, min_qual):
+    '''
+    Returns the allele balance arrays of get_ind_freqs for a block of VCF records.
+    A genotype passes filters with at least min_depth reads, one reference read, min_count alternate reads, and a genotype quality of min_qual.
+
+    Parameters:
+        records (list): VCF records split on whitespace
+        columns (np.array): indices of the sample columns to read, counted from the first sample column
+
+    Returns:
+        allele_balance (np.array): alternate allele fraction of every site (rows) and sample (columns), 0 without reads
+        depth (np.array): read depth
+        genotype_quality (np.array): genotype quality
+        passing (np.array): genotypes passing filters
+    '''
+    ref, alt, gq = parse_allele_counts(records, columns)
+    depth = ref + alt
+    allele_balance = (alt / np.maximum(depth, 1)).astype(np.float32)
+    passing = (depth >= min_depth) & (ref >= 1) & (alt >= min_count) & (gq >= min_qual)
+    return(allele_balance, depth.astype(np.uint16), gq.astype(np.uint8), passing)
+
+def iter_vcf_blocks(vcf_file, pate_flag, block_size=10000):
+    '''
+    Yields blocks of up to block_size filter-passing VCF records, each split on whitespace.
+    '''
+    block = []
+    with open_vcf(vcf_file) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            temp = line.split()
+            if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')):
+                block.append(temp)
+                if len(block) == block_size:
+                    yield(block)
+                    block = []
+    if len(block) > 0:
+        yield(block)
+
+def individual_columns(sample_names, ind_map):
+    '''
+    Returns the individuals of the sample sheet in VCF column order and the indices of their sample columns.
+    '''
+    columns = np.array([i for i, name in enumerate(sample_names) if name in ind_map], dtype=np.int64)
+    return([sample_names[i] for i in columns], columns)
+
+def iter_genotype_blocks(vcf_file, columns, pate_flag, min_depth, min_qual, block_size=10000):
+    '''
+    Yields the allele balance, depth, and validity of every individual for blocks of sites.
+    A genotype is valid with at least min_depth reads, and at least one, and a genotype quality of at least min_qual.
+    Homozygous genotypes are valid with an allele balance of 0 or 1. The passing flag of get_ind_freqs also needs reads
+    of both alleles, so it keeps heterozygotes only, which suits fitting allele balance mixtures but not comparing individuals.
+
+    Parameters:
+        vcf_file (string): a multisample vcf file uncompressed, or '-' for standard input after its header was read
+        columns (np.array): indices of the sample columns to read, counted from the first sample column
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        min_depth (int): the minimum depth of a valid genotype
+        min_qual (int): the minimum phred-scaled genotype quality of a valid genotype
+        block_size (int): the number of sites per block
+
+    Yields:
+        chrom (list): chromosome of every site in the block
+        pos (np.array): position of every site
+        allele_balance (np.array): alternate allele fraction of every site (rows) and individual (columns)
+        depth (np.array): read depth
+        valid (np.array): genotypes passing the depth and quality filters
+    '''
+    for records in iter_vcf_blocks(vcf_file, pate_flag, block_size):
+        ref, alt, gq = parse_allele_counts(records, columns)
+        depth = ref + alt
+        yield(
+            [record[0] for record in records],
+            np.array([int(record[1]) for record in records], dtype=np.int64),
+            (alt / np.maximum(depth, 1)).astype(np.float32),
+            depth,
+            (depth >= max(min_depth, 1)) & (gq >= min_qual)
+        )
+
+def array_genotype_blocks(ab_dat, min_depth, min_qual, block_size=10000, coordinates=None):
+    '''
+    Yields the blocks of iter_genotype_blocks from allele balance data returned from get_ind_freqs, which may be memory mapped.
+    Validity comes from the depth and genotype quality rows of ab_dat, not from its passing row.
+
+    Parameters:
+        ab_dat (np.array): allele balance data returned from get_ind_freqs
+        min_depth (int): the minimum depth of a valid genotype
+        min_qual (int): the minimum phred-scaled genotype quality of a valid genotype
+        block_size (int): the number of sites per block
+        coordinates (tuple): chromosome names, chromosome codes, and positions from get_ind_freqs.
+            Without them chrom is None and pos is the index of the site.
+    '''
+    n_sites = ab_dat.shape[1]
+    for start in range(0, n_sites, block_size):
+        stop = min(start + block_size, n_sites)
+        depth = ab_dat[1, start:stop]
+        if coordinates is None:
+            chrom, pos = None, np.arange(start, stop)
+        else:
+            chrom_names, chrom_index, positions = coordinates
+            chrom, pos = [chrom_names[c] for c in chrom_index[start:stop]], positions[start:stop]
+        yield(chrom, pos, ab_dat[0, start:stop], depth, (depth >= max(min_depth, 1)) & (ab_dat[2, start:stop] >= min_qual))
+
+def population_sums(values, starts):
+    '''
+    Sums the columns of values over each population of population_index.
+    Differences of cumulative sums give 0 for a population without columns, where np.add.reduceat would return the next column.
+
+    Parameters:
+        values (np.array): counts of every site (rows) and sample (columns) in the column order of population_index
+        starts (np.array): the position in columns where each population begins
+
+    Returns:
+        sums (np.array): sums of every site (rows) and population (columns)
+    '''
+    cumulative = np.zeros((values.shape[0], values.shape[1] + 1), dtype=np.int64)
+    np.cumsum(values, axis=1, out=cumulative[:, 1:])
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.append(starts[1:], values.shape[1])
+    return(cumulative[:, ends] - cumulative[:, starts])
+
+def iter_pop_count_blocks(vcf_file, columns, starts, pate_flag, min_depth, min_qual, block_size=10000, ploidy=None):
+    '''
+    Yields read counts summed over the individuals of each population for blocks of sites.
+    An individual only contributes reads at a site where it has at least min_depth reads and a genotype quality of at least min_qual.
+
+    Parameters:
+        vcf_file (string): a multisample vcf file uncompressed
+        columns (np.array): sample columns grouped by population from population_index
+        starts (np.array): the position in columns where each population begins
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        min_depth (int): the minimum depth of an individual at a site
+        min_qual (int): the minimum phred-scaled genotype quality of an individual at a site
+        block_size (int): the number of sites per block
+        ploidy (np.array): the ploidy of every column in columns. If given, pop_n counts sampled chromosomes instead of individuals.
+
+    Yields:
+        chrom (list): chromosome of every site in the block
+        pos (np.array): position of every site
+        pop_alt (np.array): alternate counts of every site (rows) and population (columns)
+        pop_depth (np.array): total counts
+        pop_n (np.array): the number of individuals (or chromosomes) contributing to each count
+    '''
+    for records in iter_vcf_blocks(vcf_file, pate_flag, block_size):
+        ref, alt, gq = parse_allele_counts(records, columns)
+        passing = ((ref + alt) >= min_depth) & (gq >= min_qual)
+        alt = np.where(passing, alt, 0)
+        depth = np.where(passing, ref + alt, 0)
+        sampled = passing.astype(np.int32) if ploidy is None else passing * ploidy[np.newaxis, :]
+        yield(
+            [record[0] for record in records],
+            np.array([int(record[1]) for record in records], dtype=np.int64),
+            population_sums(alt, starts),
+            population_sums(depth, starts),
+            population_sums(sampled, starts)
+        )
@@ -0,0 +1,248 @@
+import os
+import json
+import logging
+import hashlib
+import tempfile
+from urllib.parse import quote
+import numpy as np
+
+####
+# Checkpoints for resuming long runs
+# Every file is written to a temporary name in its final directory and moved into place with os.replace,
+# so a run killed at any point leaves either the previous complete file or the new complete file, never a partial one.
+####
+def atomic_write(path, write):
+    '''
+    Calls write(fh) on a temporary file next to path and renames it to path once it is complete and synced.
+
+    Parameters:
+        path (string): the final file name
+        write (function): writes the contents to the binary file handle it is given
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def atomic_write_json(path, record):
+    '''
+    Writes a JSON record atomically.
+    '''
+    atomic_write(path, lambda fh: fh.write(json.dumps(record).encode()))
+
+def ingestion_fingerprint(vcf_file, ind_map, **settings):
+    '''
+    Identifies the input of an ingestion: the VCF path, size, and modification time, the individuals read, and the read filters.
+    Cached arrays are only reused when the fingerprint of the new run is identical.
+    '''
+    status = os.stat(vcf_file)
+    return({
+        'vcf_file': os.path.abspath(vcf_file),
+        'size': status.st_size,
+        'mtime_ns': status.st_mtime_ns,
+        'individuals': sorted(ind_map.keys()),
+        **settings
+    })
+
+def save_ingestion(checkpoint_dir, tax_list, ab_dat, fingerprint):
+    '''
+    Caches the allele balance array of a finished ingestion as ingestion.npy with its individuals and fingerprint in ingestion.json.
+    The array is written before the record, so a record always describes a complete array.
+    '''
+    atomic_write(f'{checkpoint_dir}/ingestion.npy', lambda fh: np.save(fh, ab_dat))
+    atomic_write_json(f'{checkpoint_dir}/ingestion.json', {'fingerprint': fingerprint, 'tax_list': list(tax_list), 'shape': list(ab_dat.shape)})
+    logging.info(f'Cached ingestion of {ab_dat.shape[2]} individuals and {ab_dat.shape[1]} sites in {checkpoint_dir}')
+
+def load_ingestion(checkpoint_dir, fingerprint):
+    '''
+    Returns the cached individuals and allele balance array of an earlier run with the same fingerprint, or None.
+    The array is memory mapped read only, so resuming does not read it all before fitting starts.
+    '''
+    record_file = f'{checkpoint_dir}/ingestion.json'
+    if not os.path.exists(record_file):
+        return(None)
+    with open(record_file, 'r') as fh:
+        record = json.load(fh)
+    if record['fingerprint'] != json.loads(json.dumps(fingerprint)):
+        logging.warning(f'Cached ingestion in {checkpoint_dir} was made from a different VCF or settings. Reading the VCF again.')
+        return(None)
+    ab_dat = np.load(f'{checkpoint_dir}/ingestion.npy', mmap_mode='r')
+    logging.info(f'Reusing cached ingestion of {ab_dat.shape[2]} individuals and {ab_dat.shape[1]} sites from {checkpoint_dir}')
+    return(record['tax_list'], ab_dat)
+
+class IndividualCheckpoints:
+    '''
+    One completion record per individual, written atomically as each individual is finished.
+
+    Parameters:
+        checkpoint_dir (string): directory of the records. Created if it does not exist.
+        settings (dict): the settings the records depend on. Resuming with different settings is refused.
+        resume (bool): keep the records of an earlier run. Otherwise they are removed.
+    '''
+    def __init__(self, checkpoint_dir, settings, resume=False):
+        self.record_dir = f'{checkpoint_dir}/individuals'
+        os.makedirs(self.record_dir, exist_ok=True)
+        settings = json.loads(json.dumps(settings))
+        settings_file = f'{checkpoint_dir}/settings.json'
+        if resume and os.path.exists(settings_file):
+            with open(settings_file, 'r') as fh:
+                previous = json.load(fh)
+            if previous != settings:
+                changed = sorted(key for key in set(previous) | set(settings) if previous.get(key) != settings.get(key))
+                raise ValueError(f'Cannot resume from {checkpoint_dir}: settings changed ({", ".join(changed)})')
+        self.run_file = f'{checkpoint_dir}/run.json'
+        if not resume:
+            for name in os.listdir(self.record_dir):
+                os.remove(f'{self.record_dir}/{name}')
+            if os.path.exists(self.run_file):
+                os.remove(self.run_file)
+        atomic_write_json(settings_file, settings)
+
+    def _path(self, ind_name):
+        return(f'{self.record_dir}/{quote(ind_name, safe="")}.json')
+
+    def completed(self):
+        '''
+        Returns the records of all finished individuals keyed by individual.
+        '''
+        records = {}
+        for name in os.listdir(self.record_dir):
+            if name.endswith('.json'):
+                with open(f'{self.record_dir}/{name}', 'r') as fh:
+                    record = json.load(fh)
+                records[record['individual']] = record
+        return(records)
+
+    def load_run_id(self):
+        '''
+        Returns the results database run ID of the run being resumed, or None if it did not record one.
+        '''
+        if not os.path.exists(self.run_file):
+            return(None)
+        with open(self.run_file, 'r') as fh:
+            return(json.load(fh)['run_id'])
+
+    def save_run_id(self, run_id):
+        '''
+        Records the results database run ID so a resumed run keeps adding rows to the same run.
+        '''
+        atomic_write_json(self.run_file, {'run_id': run_id})
+
+    def write(self, ind_name, record):
+        '''
+        Marks an individual as finished with its record.
+        '''
+        atomic_write_json(self._path(ind_name), {'individual': ind_name, **record})
+
+def file_fingerprint(path, head_bytes=1048576):
+    '''
+    Identifies the contents of a file by its path, size, modification time, and a sha256 hash of its first head_bytes.
+    '''
+    status = os.stat(path)
+    with open(path, 'rb') as fh:
+        head = fh.read(head_bytes)
+    return({
+        'path': os.path.abspath(path),
+        'size': status.st_size,
+        'mtime_ns': status.st_mtime_ns,
+        'head_sha256': hashlib.sha256(head).hexdigest()
+    })
+
+def digest_before(path, offset, n_bytes=65536):
+    '''
+    Returns the sha256 hash of the n_bytes of a file that end at offset.
+    '''
+    start = max(0, offset - n_bytes)
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        return(hashlib.sha256(fh.read(offset - start)).hexdigest())
+
+class IngestionCheckpoint:
+    '''
+    Progress of reading a VCF into arrays, kept so an interrupted read continues where it stopped.
+    Each save appends the rows filled since the previous save as one part file and then replaces state.json,
+    which holds the byte offset and site count reached and the parts written so far. Saving costs the new rows only.
+
+    Parameters:
+        checkpoint_dir (string): directory of the checkpoint. Parts go to its ingestion_parts subdirectory.
+        vcf_file (string): the VCF being read
+        settings (dict): read settings that change the arrays, such as filters and individuals
+    '''
+    def __init__(self, checkpoint_dir, vcf_file, settings):
+        self.part_dir = f'{checkpoint_dir}/ingestion_parts'
+        self.vcf_file = vcf_file
+        self.fingerprint = json.loads(json.dumps({**file_fingerprint(vcf_file), **settings}))
+        self.parts = []
+        self.saved_sites = 0
+
+    def load(self):
+        '''
+        Returns the saved state if it belongs to an unchanged VCF and the same settings. Otherwise clears the checkpoint and returns None.
+        '''
+        state_file = f'{self.part_dir}/state.json'
+        if not os.path.exists(state_file):
+            return(None)
+        with open(state_file, 'r') as fh:
+            state = json.load(fh)
+        if (state['fingerprint'] != self.fingerprint) or (digest_before(self.vcf_file, state['offset']) != state['digest']):
+            logging.warning(f'Ingestion checkpoint in {self.part_dir} does not match {self.vcf_file} or the read settings. Reading from the start.')
+            self.clear()
+            return(None)
+        self.parts = state['parts']
+        self.saved_sites = state['n_sites']
+        logging.info(f'Resuming ingestion of {self.vcf_file} at byte {state["offset"]} after {state["n_sites"]} sites')
+        return(state)
+
+    def restore(self, arrays):
+        '''
+        Copies the saved rows of every array, keyed by name, into the preallocated arrays.
+        '''
+        for part in self.parts:
+            with np.load(f'{self.part_dir}/{part["file"]}') as saved:
+                for name, array in arrays.items():
+                    array[part['start']:part['stop']] = saved[name]
+
+    def save(self, offset, n_sites, arrays, extra):
+        '''
+        Saves the rows from the previous save up to n_sites and the state after reading up to byte offset.
+
+        Parameters:
+            offset (int): the byte offset of the first unread line
+            n_sites (int): the number of rows filled
+            arrays (dict): arrays indexed by site in their first dimension
+            extra (dict): JSON-serializable reader state needed to continue, such as the individuals and chromosome codes
+        '''
+        os.makedirs(self.part_dir, exist_ok=True)
+        if n_sites > self.saved_sites:
+            part_file = f'part{len(self.parts):06d}.npz'
+            rows = {name: array[self.saved_sites:n_sites] for name, array in arrays.items()}
+            atomic_write(f'{self.part_dir}/{part_file}', lambda fh: np.savez(fh, **rows))
+            self.parts.append({'file': part_file, 'start': self.saved_sites, 'stop': n_sites})
+            self.saved_sites = n_sites
+        atomic_write_json(f'{self.part_dir}/state.json', {
+            'fingerprint': self.fingerprint,
+            'offset': offset,
+            'digest': digest_before(self.vcf_file, offset),
+            'n_sites': n_sites,
+            'parts': self.parts,
+            **extra
+        })
+
+    def clear(self):
+        '''
+        Removes the checkpoint.
+        '''
+        if os.path.exists(self.part_dir):
+            for name in os.listdir(self.part_dir):
+                os.remove(f'{self.part_dir}/{name}')
+            os.rmdir(self.part_dir)
+        self.parts = []
+        self.saved_sites = 0
@@ -1,6 +1,15 @@
-from popopolus.fit_mixtures.fit_mixtures import est_ploidy
-from popopolus.fit_mixtures.fit_mixtures import fit_gmm_to_ab
-
 """
 Fit mixute models to allele balance data
-"""
\ No newline at end of file
+"""
+import importlib
+
+# Imported on first use so that submodules such as windows or render do not pull in sklearn through fit_mixtures
+_EXPORTS = {
+    'est_ploidy': 'popopolus.fit_mixtures.fit_mixtures',
+    'fit_gmm_to_ab': 'popopolus.fit_mixtures.fit_mixtures'
+}
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return(getattr(importlib.import_module(_EXPORTS[name]), name))
+    raise AttributeError(f"module 'popopolus.fit_mixtures' has no attribute '{name}'")
@@ -0,0 +1,301 @@
+import numpy as np
+import logging
+from scipy.special import gammaln, logsumexp
+from scipy.optimize import minimize_scalar
+from popopolus.fit_mixtures.gmm import get_fixed_params
+
+####
+# Beta-binomial mixtures on read counts
+# Component k of ploidy p has mean allele balance k/p, so only the weights and one shared overdispersion are estimated.
+# Sites are collapsed to their distinct (depth, alt) pairs and every log-likelihood term comes from log tables,
+# so an EM iteration costs the number of distinct pairs, not the number of sites.
+####
+def ab_to_counts(ab, depth):
+    """
+    Recover integer alternate allele counts from allele balance and depth.
+
+    Parameters:
+        ab (np.array): Allele balance of each site
+        depth (np.array): Read depth of each site
+
+    Returns:
+        alt (np.array): Alternate allele count of each site
+        depth (np.array): Read depth of each site as integers
+    """
+    depth = np.ravel(depth).astype(np.int64)
+    alt = np.rint(np.ravel(ab).astype(np.float64) * depth).astype(np.int64)
+    return(alt, depth)
+
+def _log_rising(a, max_n):
+    """
+    Table of log rising factorials log(a (a+1) ... (a+m-1)) = gammaln(a+m) - gammaln(a) for m = 0..max_n.
+    a holds one value per component and the table has one row per component.
+    """
+    steps = np.log(np.asarray(a, dtype=np.float64)[:, np.newaxis] + np.arange(max_n)[np.newaxis, :])
+    return(np.concatenate([np.zeros((steps.shape[0], 1)), np.cumsum(steps, axis=1)], axis=1))
+
+def betabinom_logpmf_table(alt, depth, means, rho, log_factorial):
+    """
+    Beta-binomial log probabilities of alt given depth for every component, with binomial components when rho is zero.
+
+    Parameters:
+        alt (np.array): Alternate allele counts
+        depth (np.array): Read depths
+        means (np.array): Mean allele balance of each component
+        rho (float): Overdispersion, the correlation of reads within a site
+        log_factorial (np.array): gammaln(n + 1) for n = 0..max depth
+
+    Returns:
+        log_pmf (np.array): Log probability of every count (rows) under every component (columns)
+    """
+    log_choose = log_factorial[depth] - log_factorial[alt] - log_factorial[depth - alt]
+    means = np.asarray(means, dtype=np.float64)
+    if rho <= 0:
+        log_pmf = alt[:, np.newaxis] * np.log(means)[np.newaxis, :] + (depth - alt)[:, np.newaxis] * np.log1p(-means)[np.newaxis, :]
+        return(log_choose[:, np.newaxis] + log_pmf)
+    max_n = len(log_factorial) - 1
+    s = (1 - rho) / rho
+    rise_alt = _log_rising(means * s, max_n)
+    rise_ref = _log_rising((1 - means) * s, max_n)
+    rise_total = _log_rising([s], max_n)[0]
+    log_pmf = rise_alt[:, alt].T + rise_ref[:, depth - alt].T - rise_total[depth][:, np.newaxis]
+    return(log_choose[:, np.newaxis] + log_pmf)
+
+class BetaBinomialMixture:
+    """
+    Mixture of beta-binomial components at the expected allele balances of one ploidy.
+    Sites are only observed when they pass the read count filters, so every component is truncated to
+    the alt counts that could have passed: at least min_alt alternate reads, at least one reference read,
+    and an allele balance strictly inside truncation.
+
+    Parameters:
+        ploidy (int): The ploidy. Components sit at allele balance 1/ploidy .. (ploidy-1)/ploidy.
+        fixed_weights (np.array): Component weights held fixed during EM
+        overdispersion (float): Fixed overdispersion. None estimates it and 0 gives binomial components.
+        truncation (tuple): The open interval of allele balance kept by the filters
+        min_alt (int): The minimum alternate allele count kept by the filters
+        max_iter (int): Maximum number of EM iterations
+        tol (float): EM stops when the mean log likelihood improves by less than tol
+    """
+
+    def __init__(self, ploidy, fixed_weights=None, overdispersion=None, truncation=(0.05, 0.95), min_alt=1, max_iter=200, tol=1e-6):
+        self.ploidy = ploidy
+        self.n_components = ploidy - 1
+        self.means, _ = get_fixed_params(self.n_components)
+        self.means = self.means.ravel()
+        self.fixed_weights = None if fixed_weights is None else np.ravel(fixed_weights).astype(np.float64)
+        self.overdispersion = overdispersion
+        self.truncation = truncation
+        self.min_alt = min_alt
+        self.max_iter = max_iter
+        self.tol = tol
+        self.weights = None
+        self.rho = None
+
+    def _collapse(self, counts):
+        """Distinct (alt, depth) pairs of an (n_sites, 2) array of counts with their multiplicities and the map back to sites."""
+        counts = np.asarray(counts, dtype=np.int64)
+        pairs, inverse, multiplicity = np.unique(counts, axis=0, return_inverse=True, return_counts=True)
+        return(pairs[:, 0], pairs[:, 1], multiplicity, np.ravel(inverse))
+
+    def _depth_grid(self, depth):
+        """
+        Every alt count that passes the filters at each distinct depth of depth.
+        Returns the index of every entry of depth into the distinct depths, the grid alt counts and depths,
+        and the index of every grid entry into the distinct depths. Depends on the data only, so a fit builds it once.
+        """
+        depths, depth_index = np.unique(depth, return_inverse=True)
+        grid_depth = np.repeat(depths, depths + 1)
+        grid_alt = np.concatenate([np.arange(n + 1) for n in depths])
+        grid_ab = grid_alt / np.maximum(grid_depth, 1)
+        kept = (grid_alt >= self.min_alt) & (grid_alt <= grid_depth - 1) & (grid_ab > self.truncation[0]) & (grid_ab < self.truncation[1])
+        return(np.ravel(depth_index), grid_alt[kept], grid_depth[kept], np.searchsorted(depths, grid_depth[kept]))
+
+    def _log_normalizer(self, grid, rho, log_factorial):
+        """
+        Log probability that a site of each distinct depth passes the filters under each component.
+        Evaluated over the alt counts of the depth grid, so the cost scales with the distinct depths.
+        """
+        depth_index, grid_alt, grid_depth, grid_index = grid
+        log_pmf = betabinom_logpmf_table(grid_alt, grid_depth, self.means, rho, log_factorial)
+        log_norm = np.full((depth_index.max() + 1, self.n_components), -np.inf)
+        for k in range(self.n_components):
+            np.logaddexp.at(log_norm[:, k], grid_index, log_pmf[:, k])
+        return(log_norm)
+
+    def _log_component_pmf(self, alt, depth, rho, log_factorial, grid=None):
+        if grid is None:
+            grid = self._depth_grid(depth)
+        log_norm = self._log_normalizer(grid, rho, log_factorial)
+        return(betabinom_logpmf_table(alt, depth, self.means, rho, log_factorial) - log_norm[grid[0]])
+
+    def _loglik(self, alt, depth, multiplicity, weights, rho, log_factorial, grid=None):
+        weighted = self._log_component_pmf(alt, depth, rho, log_factorial, grid) + np.log(weights)[np.newaxis, :]
+        log_norm = logsumexp(weighted, axis=1)
+        return(np.dot(multiplicity, log_norm), weighted - log_norm[:, np.newaxis])
+
+    def fit(self, counts):
+        """
+        Fit the weights and overdispersion by EM on the distinct count pairs.
+        The overdispersion is updated by a bounded search on its logit inside each M-step.
+
+        Parameters:
+            counts (np.array): Alternate allele counts (column 0) and read depths (column 1) of every site
+
+        Returns:
+            self
+        """
+        alt, depth, multiplicity, _ = self._collapse(counts)
+        self.log_factorial_ = gammaln(np.arange(depth.max() + 1) + 1)
+        grid = self._depth_grid(depth)
+        n_sites = multiplicity.sum()
+        weights = np.full(self.n_components, 1 / self.n_components) if self.fixed_weights is None else self.fixed_weights
+        rho = 0.01 if self.overdispersion is None else self.overdispersion
+        log_likelihood = -np.inf
+        for n_iter in range(1, self.max_iter + 1):
+            new_log_likelihood, log_resp = self._loglik(alt, depth, multiplicity, weights, rho, self.log_factorial_, grid)
+            resp = np.exp(log_resp) * multiplicity[:, np.newaxis]
+            if self.fixed_weights is None:
+                weights = np.maximum(resp.sum(axis=0) / n_sites, 1e-12)
+                weights /= weights.sum()
+            if self.overdispersion is None:
+                def neg_expected_loglik(logit_rho):
+                    log_pmf = self._log_component_pmf(alt, depth, 1 / (1 + np.exp(-logit_rho)), self.log_factorial_, grid)
+                    return(-np.sum(resp * log_pmf))
+                result = minimize_scalar(neg_expected_loglik, bounds=(-12, 0), method='bounded', options={'xatol': 1e-4})
+                rho = 1 / (1 + np.exp(-result.x))
+            change = (new_log_likelihood - log_likelihood) / n_sites
+            log_likelihood = new_log_likelihood
+            if abs(change) < self.tol:
+                break
+        self.weights = weights
+        self.rho = rho
+        self.n_iter_ = n_iter
+        self.n_pairs_ = len(alt)
+        self.log_likelihood_, _ = self._loglik(alt, depth, multiplicity, weights, rho, self.log_factorial_, grid)
+        return(self)
+
+    def _site_table(self, counts):
+        alt, depth, multiplicity, inverse = self._collapse(counts)
+        log_factorial = gammaln(np.arange(max(depth.max(), len(self.log_factorial_) - 1) + 1) + 1)
+        return(alt, depth, multiplicity, inverse, log_factorial)
+
+    def score_samples(self, counts):
+        """Log likelihood of every site"""
+        alt, depth, multiplicity, inverse, log_factorial = self._site_table(counts)
+        weighted = self._log_component_pmf(alt, depth, self.rho, log_factorial) + np.log(self.weights)[np.newaxis, :]
+        return(logsumexp(weighted, axis=1)[inverse])
+
+    def score(self, counts):
+        """Mean log likelihood per site"""
+        return(self.score_samples(counts).mean())
+
+    def predict(self, counts):
+        """Most likely component of every site"""
+        alt, depth, multiplicity, inverse, log_factorial = self._site_table(counts)
+        weighted = self._log_component_pmf(alt, depth, self.rho, log_factorial) + np.log(self.weights)[np.newaxis, :]
+        return(weighted.argmax(axis=1)[inverse])
+
+    def ab_density(self, counts, edges):
+        """
+        Allele balance density of every component at the depths of counts, binned on edges.
+        The components are distributions of alt counts, so the density of each depth is its truncated pmf spread over
+        the bins of the allele balances it allows, weighted by the share of sites at that depth and the component weight.
+
+        Parameters:
+            counts (np.array): Alternate allele counts (column 0) and read depths (column 1) of every site
+            edges (np.array): Bin edges of allele balance
+
+        Returns:
+            density (np.array): Density of every bin (rows) under every component (columns)
+        """
+        alt, depth, multiplicity, inverse, log_factorial = self._site_table(counts)
+        grid = self._depth_grid(depth)
+        depth_index, grid_alt, grid_depth, grid_index = grid
+        depth_share = np.bincount(depth_index, weights=multiplicity) / multiplicity.sum()
+        log_pmf = betabinom_logpmf_table(grid_alt, grid_depth, self.means, self.rho, log_factorial) - self._log_normalizer(grid, self.rho, log_factorial)[grid_index]
+        mass = np.exp(log_pmf) * depth_share[grid_index][:, np.newaxis] * self.weights[np.newaxis, :]
+        grid_ab = grid_alt / grid_depth
+        in_range = (grid_ab >= edges[0]) & (grid_ab <= edges[-1])
+        bins = np.clip(np.searchsorted(edges, grid_ab[in_range], side='right') - 1, 0, len(edges) - 2)
+        density = np.zeros((len(edges) - 1, self.n_components))
+        np.add.at(density, bins, mass[in_range])
+        return(density / np.diff(edges)[:, np.newaxis])
+
+    def _n_parameters(self):
+        """Number of free parameters: the free weights plus the overdispersion if it is estimated"""
+        n_parameters = 0
+        if self.fixed_weights is None:
+            n_parameters += self.n_components - 1
+        if self.overdispersion is None:
+            n_parameters += 1
+        return(n_parameters)
+
+    def bic(self, counts):
+        return(-2 * self.score_samples(counts).sum() + self._n_parameters() * np.log(len(counts)))
+
+def fit_betabinom_to_ab(ind_name, counts, ploidy, model_constraints, output_dir, truncation=(0.05, 0.95), min_alt=1, return_models=False, renderer=None, store=None):
+    """
+    Fit beta-binomial mixtures to the read counts of an individual and select the ploidy by BIC.
+    Follows fit_gmm_to_ab: the same ploidy selection rule and the same .fit.txt output.
+    The component means are always the expected allele balances of the ploidy.
+
+    Parameters:
+        ind_name (string): The name of the individual
+        counts (np.array): Alternate allele counts (column 0) and read depths (column 1) of every site
+        ploidy (list): The ploidies to test
+        model_constraints (int): 2 fixes the weights to the expected dosage frequencies. Otherwise they are estimated.
+        output_dir (str): The output directory where all results will be directed
+        truncation (tuple): The open interval of allele balance kept before fitting
+        min_alt (int): The minimum alternate allele count kept by the filters
+        return_models (bool): Also return the fitted models, keyed by ploidy
+        renderer (PlotRenderer): Queues the fit plot for background rendering. None draws it before returning.
+        store (ResultsStore): Records every fitted model in the results database instead of writing {ind_name}.fit.txt
+
+    Returns:
+        best_n (int): The selected ploidy
+        predictions (np.array): The component of every site under the selected model
+    """
+    best_n = 1
+    best_bic = np.inf
+    best_model = None
+    fits = {}
+    output_file = f'{output_dir}/{ind_name}.fit.txt'
+    outfile = open(output_file, 'w') if store is None else None
+    for p in ploidy:
+        _, weights = get_fixed_params(p - 1)
+        model = BetaBinomialMixture(p, fixed_weights = weights if model_constraints == 2 else None, truncation = truncation, min_alt = min_alt)
+        model.fit(counts)
+        fits[p] = model
+        bic = model.bic(counts)
+        if store is not None:
+            store.add_model(ind_name, p, 'betabinom', len(counts), model.score(counts) * len(counts), bic, {'means': model.means, 'overdispersion': model.rho, 'weights': model.weights})
+        else:
+            outfile.write(f'Model for ploidy = {p}\n')
+            outfile.write('Fitted beta-binomial mixture parameters:\n')
+            outfile.write(f'Means:\n {model.means}\n')
+            outfile.write(f'Overdispersion:\n {model.rho}\n')
+            outfile.write(f'Weights:\n {model.weights}\n')
+            outfile.write(f'Best likelihood: {model.score(counts)}\n')
+            outfile.write(f'BIC: {bic}\n')
+            outfile.write('\n')
+        logging.debug(f'Individual {ind_name}: ploidy {p} fitted on {model.n_pairs_} distinct count pairs in {model.n_iter_} iterations')
+        # only consider a 3.2 point difference via Kass and Raftery 1995
+        if bic < (best_bic - 3.2):
+            best_bic = bic
+            best_n = p
+            best_model = model
+    predictions = best_model.predict(counts)
+    if outfile is not None:
+        outfile.close()
+    plot_title = f'Beta-binomial Mixture Fit to Allele Balance Data ({ind_name})'
+    if renderer is None:
+        from popopolus.fit_mixtures.plot_mixtures import plot_betabinom_fit
+        plot_betabinom_fit(counts, best_model, output_dir, plot_name=f'{ind_name}.fit', title=plot_title)
+    elif renderer.wants('individual'):
+        from popopolus.fit_mixtures.render import betabinom_plot_payload
+        renderer.submit(betabinom_plot_payload(counts, best_model, f'{ind_name}.fit', plot_title))
+
+    if return_models:
+        return(best_n, predictions, fits)
+    return(best_n, predictions)
@@ -0,0 +1,102 @@
+import numpy as np
+import logging
+
+####
+# Block bootstrap support for ploidy calls
+# Replicates reweight the per-block log-likelihoods of the fitted models (RELL, Kishino and Hasegawa 1989)
+# so no model is refitted and each replicate is a single matrix product
+####
+def block_loglik(dat, fits, block_size):
+    """
+    Returns the per-block sums of the per-site log-likelihoods of each fitted model.
+    These are the sufficient statistics for every bootstrap replicate and are computed once.
+
+    Parameters:
+        dat (np.array): Allele balance data the models were fitted to
+        fits (dict): Fitted mixture models keyed by ploidy
+        block_size (int): The number of consecutive sites in a block
+
+    Returns:
+        ploidies (list): The ploidies in the column order of block_ll
+        block_ll (np.array): Log-likelihood of each block (rows) under each model (columns)
+        n_params (np.array): The number of free parameters of each model
+    """
+    ploidies = list(fits.keys())
+    block_index = np.arange(len(dat)) // block_size
+    block_ll = np.column_stack([np.bincount(block_index, weights=fits[p].score_samples(dat)) for p in ploidies])
+    n_params = np.array([fits[p]._n_parameters() for p in ploidies])
+    return(ploidies, block_ll, n_params)
+
+def _replicate_bics(block_ll, n_params, n_sites, n_replicates, seed):
+    """
+    Draw multinomial block weights for a batch of replicates and return their BIC for every model.
+    """
+    rng = np.random.default_rng(seed)
+    n_blocks = block_ll.shape[0]
+    weights = rng.multinomial(n_blocks, np.full(n_blocks, 1 / n_blocks), size=n_replicates)
+    return(-2 * (weights @ block_ll) + n_params * np.log(n_sites))
+
+def select_ploidy_bic(bics, ploidies, margin=3.2):
+    """
+    Apply the ploidy selection rule of fit_gmm_to_ab to many sets of BIC values at once.
+    A later ploidy only replaces the current call if its BIC is lower by more than margin.
+
+    Parameters:
+        bics (np.array): BIC values with one row per replicate and one column per ploidy
+        ploidies (list): The ploidies in column order
+        margin (float): The BIC improvement needed to change the call
+
+    Returns:
+        calls (np.array): The selected ploidy of each replicate
+    """
+    best_bic = np.full(bics.shape[0], np.inf)
+    calls = np.zeros(bics.shape[0], dtype=int)
+    for m, p in enumerate(ploidies):
+        better = bics[:, m] < (best_bic - margin)
+        best_bic[better] = bics[better, m]
+        calls[better] = p
+    return(calls)
+
+def bootstrap_ploidy(ind_name, dat, fits, best_n, n_replicates=1000, block_size=100, batch_size=250, executor=None, random_state=0):
+    """
+    Block bootstrap support for a ploidy call.
+    Blocks of consecutive sites are resampled with multinomial weights and the ploidy is re-selected in every replicate.
+
+    Parameters:
+        ind_name (string): The name of the individual
+        dat (np.array): Allele balance data the models were fitted to
+        fits (dict): Fitted mixture models keyed by ploidy. Support is conditional on these ploidies,
+            so pruned candidates should be fitted first with fit_bootstrap_candidates.
+        best_n (int): The ploidy selected on the full data
+        n_replicates (int): The number of bootstrap replicates
+        block_size (int): The number of consecutive sites in a block
+        batch_size (int): The number of replicates drawn together in one vectorized batch
+        executor (concurrent.futures.Executor): Spreads batches across worker processes if given
+        random_state (int): Seed for the block weights
+
+    Returns:
+        support (dict): The fraction of replicates that select best_n and quantiles of the BIC difference
+            between the best alternative ploidy and best_n
+    """
+    ploidies, block_ll, n_params = block_loglik(dat, fits, block_size)
+    if len(ploidies) < 2:
+        logging.info(f'Individual {ind_name}: only one ploidy was fitted, bootstrap support is trivially 1')
+        return({'support': 1.0, 'dbic_median': np.nan, 'dbic_lower': np.nan, 'dbic_upper': np.nan})
+    batches = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(batches))
+    args = ([block_ll] * len(batches), [n_params] * len(batches), [len(dat)] * len(batches), batches, seeds)
+    if executor is None:
+        bics = np.concatenate(list(map(_replicate_bics, *args)))
+    else:
+        bics = np.concatenate(list(executor.map(_replicate_bics, *args)))
+    calls = select_ploidy_bic(bics, ploidies)
+    best = ploidies.index(best_n)
+    dbic = np.delete(bics, best, axis=1).min(axis=1) - bics[:, best]
+    support = {
+        'support': np.mean(calls == best_n),
+        'dbic_median': np.median(dbic),
+        'dbic_lower': np.quantile(dbic, 0.025),
+        'dbic_upper': np.quantile(dbic, 0.975)
+    }
+    logging.info(f'Individual {ind_name}: bootstrap support for ploidy {best_n} is {support["support"]:.3f} from {n_replicates} replicates')
+    return(support)
@@ -0,0 +1,105 @@
+import os
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import sklearn
+
+####
+# On-disk memoization of mixture fits
+# One .npz file per fit, named by a hash of everything the fit depends on.
+# The modification time of a file marks its last use, so the least recently used fits are evicted first.
+####
+
+# Bump when a change to the fitting code changes the fitted parameters for the same data
+ENGINE_VERSION = f'gmm-1-sklearn-{sklearn.__version__}'
+
+def fit_key(dat, ploidy, model_constraints, engine_version=ENGINE_VERSION):
+    """
+    Returns the cache key of a fit: a sha256 hash of the data, its dtype and shape, the ploidy, the constraints, and the engine version.
+
+    Parameters:
+        dat (np.array): Filtered allele balance data of one individual
+        ploidy (int): The ploidy of the fit
+        model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
+        engine_version (str): Identifies the fitting code
+
+    Returns:
+        key (str): Hexadecimal digest
+    """
+    dat = np.ascontiguousarray(dat)
+    digest = hashlib.sha256()
+    digest.update(f'{engine_version}|{dat.dtype.str}|{dat.shape}|{ploidy}|{model_constraints}|'.encode())
+    digest.update(dat.tobytes())
+    return(digest.hexdigest())
+
+class FitCache:
+    """
+    Directory of cached mixture fits with a size cap and least recently used eviction.
+
+    Parameters:
+        cache_dir (str): Directory holding the cached fits. Created if missing.
+        max_bytes (int): The cache is trimmed to at most this many bytes after every write
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return(os.path.join(self.cache_dir, f'{key}.npz'))
+
+    def get(self, key):
+        """
+        Returns the cached values for key as a dict of arrays, or None if the fit is not cached.
+        A hit refreshes the modification time of the entry.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                values = {name: npz[name] for name in npz.files}
+            os.utime(path)
+        except (OSError, ValueError, EOFError) as error:
+            if os.path.exists(path):
+                logging.warning(f'Ignoring unreadable cache entry {path}: {error}')
+            self.misses += 1
+            return(None)
+        self.hits += 1
+        return(values)
+
+    def put(self, key, values):
+        """
+        Store a dict of arrays under key, then evict the least recently used entries beyond max_bytes.
+        The entry is written to a temporary file and renamed so readers never see a partial file.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, **values)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache holds at most max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+                logging.debug(f'Evicted cached fit {name}')
+            except FileNotFoundError:
+                pass
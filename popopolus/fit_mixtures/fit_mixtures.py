@@ -1,81 +1,308 @@
 import numpy as np
-import pandas as pd
 import logging
-from popopolus.fit_mixtures.gmm import fit_gmm_to_ab
-from popopolus.fit_mixtures.lmm import fit_mixed_model_ab
+from concurrent.futures import ProcessPoolExecutor
+from popopolus.fit_mixtures.gmm import fit_gmm_to_ab, fit_gmm_cached, get_fixed_params, PRECISIONS
+from popopolus.fit_mixtures.gmm2 import fit_mixture_to_ab, MIXTURE_MODELS
+from popopolus.fit_mixtures.betabinom import fit_betabinom_to_ab, ab_to_counts, BetaBinomialMixture
+from popopolus.fit_mixtures.bootstrap import bootstrap_ploidy
+from popopolus.fit_mixtures.cache import FitCache
+from popopolus.fit_mixtures.prescreen import prescreen_ploidy
+from popopolus.fit_mixtures.render import PlotRenderer, summary_plot_payload
+from popopolus.fit_mixtures.results import ResultsStore
+from popopolus.fit_mixtures.layout import compact_individuals
+from popopolus.checkpoint import IndividualCheckpoints
 
 ####
 # Main popopolus function
 # Consider moving out to other submodule
 ####
-def est_ploidy(tax_list, ab_dat, method, ploidy_levels, minimum_sites, model_constraints, output_dir):
+def est_ploidy(tax_list, ab_dat, method, ploidy_levels, minimum_sites, model_constraints, output_dir, precision='float64', selection='full', prescreen=False, lmm_engine='numpy', n_bootstrap=0, block_size=100, n_jobs=1, minimum_count=1, cache_dir=None, cache_size=1024 ** 3, plots='all', dpi=300, results_db=None, quiet=False, checkpoint_dir=None, resume=False, layout='sites'):
     """
     Estimate ploidy from allele balance data using the specified method.
     
     Parameters:
         tax_list (list): A list of individual names corresponding to the individual order of ab_dat
         ab_dat (np.array): Allele balance data returned from get_ind_freqs.
-        method (str): Method for estimating ploidy ('gmm' or 'other').
+        method (str): Method for estimating ploidy. 'gmm' fits sklearn Gaussian mixtures and 'normal', 'gamma', or 'lognormal' fit mixtures of that distribution by EM with seeded restarts.
+            'betabinom' fits beta-binomial mixtures to the read counts behind the allele balance.
         ploidy_levels (str): The ploidies to test passed as a comma-separated list.
         minimum_sites (int): The minimum number of sites to be considered for analysis
         model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
         output_dir (str): The output directory where all results will be directed
+        precision (str): Floating point precision used by the gmm EM, 'float64' or 'float32'. Other methods only take 'float64'.
+        selection (str): Model selection over gmm ploidies, 'full' or successive 'halving' on site subsamples. Other methods only take 'full'.
+        prescreen (bool): Skip ploidies that are incompatible with the peaks of the allele balance histogram before fitting
+        lmm_engine (str): 'numpy' for the closed-form random intercept LMM or 'statsmodels' to validate against MixedLM
+        n_bootstrap (int): The number of block bootstrap replicates for the support of each ploidy call. 0 skips the bootstrap.
+        block_size (int): The number of consecutive sites resampled together in the bootstrap
+        n_jobs (int): The number of worker processes for bootstrap replicates and EM restarts
+        minimum_count (int): The minimum alternate allele count used when reading the VCF. Truncates the beta-binomial components.
+        cache_dir (str): Directory for cached gmm fits, reused when the same individual is refitted. None disables the cache and
+            is the only value other methods take.
+        cache_size (int): The largest size of the fit cache in bytes. Least recently used fits are evicted beyond it.
+        plots (str): 'none' draws no plots, 'summary' only ploidy_summary.png, and 'all' also the fit and LMM plots of every individual.
+            Plots are rendered by background processes while fitting continues.
+        dpi (int): Resolution of the PNG plots
+        results_db (str): SQLite database that receives the run metadata, every fitted model, the calls, and the LMM tests
+            in batched transactions. Per-individual .fit.txt files are not written when it is given.
+        quiet (bool): Do not print LMM summaries and tests to stdout
+        checkpoint_dir (str): Directory where a completion record of every individual is written atomically once it is fitted
+        resume (bool): Skip individuals with a completion record in checkpoint_dir and take their ploidy.txt lines from it
+        layout (str): 'sites' filters the column of each individual in ab_dat as it is fitted. 'individuals' first packs the sites
+            every individual is fitted on into contiguous buffers in one blocked pass over ab_dat, which the fits use without copies.
     
     Returns:
         ploidy_df: DataFrame containing estimated ploidy for each individual.
     """
-    if method == 'gmm':
-        output_file = f'{output_dir}/ploidy.txt'
-        outfile = open(output_file, 'w')
+    if layout not in ['sites', 'individuals']:
+        raise ValueError(f"Unsupported layout {layout}. Use 'sites' or 'individuals'.")
+    check_gmm_options(method, precision, selection, cache_dir)
+    if (method in ['gmm', 'betabinom']) or (method in MIXTURE_MODELS):
         ploidy_dict = {}
+        site_counts = {}
         ploidy_level_list = ploidy_levels.split(',')
         ploidy = [int(p) for p in ploidy_level_list]
         logging.info(f'Testing for ploidy with the following values:\n{ploidy}\n')
+        executor = None
+        cache = None
+        if cache_dir is not None:
+            cache = FitCache(cache_dir, cache_size)
+        run_settings = {
+            'individuals': len(tax_list), 'sites': ab_dat.shape[1], 'method': method, 'ploidy_levels': ploidy, 'minimum_sites': minimum_sites,
+            'model_constraints': model_constraints, 'output_dir': output_dir, 'precision': precision, 'selection': selection,
+            'prescreen': prescreen, 'lmm_engine': lmm_engine, 'n_bootstrap': n_bootstrap, 'block_size': block_size, 'minimum_count': minimum_count
+        }
+        checkpoints = None
+        completed = {}
+        if checkpoint_dir is not None:
+            checkpoints = IndividualCheckpoints(checkpoint_dir, {**run_settings, 'tax_list': list(tax_list)}, resume)
+            if resume:
+                completed = checkpoints.completed()
+                logging.info(f'Resuming from {checkpoint_dir}: {len(completed)} of {len(tax_list)} individuals already finished')
+        store = None
+        if results_db is not None:
+            store = open_results(results_db, run_settings, checkpoints, completed if resume else None)
+        output_file = f'{output_dir}/ploidy.txt'
+        outfile = open(output_file, 'w')
+        if (n_jobs > 1) and ((n_bootstrap > 0) or (method in MIXTURE_MODELS)):
+            executor = ProcessPoolExecutor(max_workers = n_jobs)
+        renderer = PlotRenderer(output_dir, plots, dpi, n_workers = max(1, n_jobs // 2))
+        if layout == 'individuals':
+            compact_ab, compact_depth, offsets = compact_individuals(ab_dat)
         for i in range(len(ab_dat[0,0,:])):
             ind_name = tax_list[i]
-            ind_dat = ab_dat[0,:,i]
-            ind_depth = ab_dat[1,:,i]
-            ind_mask = ab_dat[3,:,i] == 1
-            ind_dat_filtered = ind_dat[ind_mask]
-            ind_depth_filtered = ind_depth[ind_mask]
-            ind_dat_buffer = (ind_dat_filtered > 0.05) & (ind_dat_filtered < 0.95)
-            ind_dat_filtered_truncated = ind_dat_filtered[ind_dat_buffer]
-            ind_depth_filtered_truncated = ind_depth_filtered[ind_dat_buffer]
-            dat = ind_dat_filtered_truncated
-            if len(ind_dat_filtered_truncated.shape) == 1:
-                dat = ind_dat_filtered_truncated.reshape(-1, 1)
-            # Fit GMM to allele balance data
-            #print(f'min sites: {minimum_sites}\n')
-            #print(f'{len(dat[:])}\t{dat.shape}\n')
-            n_sites = len(dat[:])
-            if n_sites >= minimum_sites:
-                logging.info(f"Individual {ind_name}: {n_sites} sites")
-                best_n, predictions = fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir)
-                #print(predictions)
-                #print(type(ind_dat_filtered_truncated))
-                #print(type(ind_dat_filtered_truncated))
-                #print(type(predictions))
-
-                if best_n > 2:
-                    lmm_result, rand_effects, fixed_effects, p_value = fit_mixed_model_ab(ind_name, ind_dat_filtered_truncated, ind_depth_filtered_truncated, predictions, output_dir)
-                    print(lmm_result.summary())
-                    print(rand_effects)
-                    print(fixed_effects)
-                    print(f'p-value versus diploid assumption: {p_value}')
-                    #print(f'{best_n}')
-                    outfile.write(f'{ind_name}\t{best_n}\t{p_value}\n')
-                else:
-                    print('diploid detected - skipping lmm')
-                    outfile.write(f'{ind_name}\t{best_n}\tNA\n')
-                ploidy_dict[ind_name] = best_n
+            if ind_name in completed:
+                record = completed[ind_name]
+                ploidy_dict[ind_name] = record['ploidy']
+                if record['line'] is not None:
+                    outfile.write(record['line'])
+                    site_counts[ind_name] = record['n_sites']
+                continue
+            if layout == 'individuals':
+                sites = slice(offsets[i], offsets[i + 1])
+                record = fit_individual(ind_name, compact_ab[sites], compact_depth[sites], None, run_settings, executor, cache, renderer, store, quiet, compacted = True, n_jobs = n_jobs)
             else:
-                logging.warning(f'Individual {ind_name}: Sample skipped due to low site count passing filters.\n')
-                ploidy_dict[ind_name] = None
+                record = fit_individual(ind_name, ab_dat[0,:,i], ab_dat[1,:,i], ab_dat[3,:,i] == 1, run_settings, executor, cache, renderer, store, quiet, n_jobs = n_jobs)
+            ploidy_dict[ind_name] = record['ploidy']
+            if record['line'] is not None:
+                outfile.write(record['line'])
+                site_counts[ind_name] = record['n_sites']
+            if store is not None:
+                store.add_call(ind_name, record['ploidy'], record['n_sites'], record['p_value'], record['bootstrap'])
+            if checkpoints is not None:
+                # Results of a checkpointed individual must be in the database before its record says it is done
+                if store is not None:
+                    store.flush()
+                checkpoints.write(ind_name, {'ploidy': record['ploidy'], 'n_sites': record['n_sites'], 'line': record['line']})
         outfile.close()
+        if renderer.wants('summary'):
+            renderer.submit(summary_plot_payload(ploidy_dict, site_counts))
+        renderer.close()
+        if store is not None:
+            store.finish_run()
+            store.close()
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            logging.info(f'Fit cache {cache_dir}: {cache.hits} hits and {cache.misses} misses')
+        import pandas as pd
         ploidy_df = pd.DataFrame.from_dict(ploidy_dict, orient = 'index')
         ploidy_df.reset_index(inplace=True)
         ploidy_df.columns = ['Individual','Ploidy']
         return(ploidy_df)
     else:
         logging.error('Terminated due to unavailable estimation method!\n')
-        raise ValueError("Unsupported method. Use 'gmm'.")
\ No newline at end of file
+        raise ValueError("Unsupported method. Use 'gmm', 'normal', 'gamma', 'lognormal', or 'betabinom'.")
+
+def check_gmm_options(method, precision, selection, cache_dir):
+    """
+    Rejects the options only the gmm method implements when another method is used,
+    so they are not recorded in the run settings without having had an effect.
+
+    Parameters:
+        method (str): The estimation method
+        precision (str): Floating point precision of the EM
+        selection (str): Model selection over ploidies
+        cache_dir (str): Directory for cached fits, or None
+    """
+    if method == 'gmm':
+        return
+    if precision != 'float64':
+        raise ValueError(f"Precision {precision} is only supported by the gmm method. Use 'float64' with {method}.")
+    if selection != 'full':
+        raise ValueError(f"Selection {selection} is only supported by the gmm method. Use 'full' with {method}.")
+    if cache_dir is not None:
+        raise ValueError(f'The fit cache is only supported by the gmm method. Do not give a cache directory with {method}.')
+
+def open_results(results_db, run_settings, checkpoints=None, completed=None):
+    """
+    Opens the results database and starts the run of est_ploidy.
+    A resumed run continues the run ID recorded in its checkpoints, so individuals finished before the interruption
+    keep their calls and models under the same run as the ones fitted after it.
+
+    Parameters:
+        results_db (str): Path of the SQLite database
+        run_settings (dict): The run settings stored with the run
+        checkpoints (IndividualCheckpoints): Checkpoints of the run, or None
+        completed (dict): Records of the individuals finished before a resume, or None for a new run
+
+    Returns:
+        store (ResultsStore): The open store
+    """
+    store = ResultsStore(results_db)
+    run_id = None
+    if (checkpoints is not None) and (completed is not None):
+        run_id = checkpoints.load_run_id()
+    if store.start_run('estimate_ploidy', run_settings, run_id) == run_id:
+        store.discard_unfinished(completed)
+    if checkpoints is not None:
+        checkpoints.save_run_id(store.run_id)
+    return(store)
+
+def fit_bootstrap_candidates(ind_name, boot_dat, fits, settings, executor=None, cache=None, n_jobs=1):
+    """
+    Returns fitted models of every ploidy in settings['ploidy_levels'] for the bootstrap.
+    Ploidies dropped by the prescreen or by successive halving are fitted on all sites, without output, so support
+    is measured against every candidate rather than only the ones that survived pruning.
+
+    Parameters:
+        ind_name (str): Name of the individual
+        boot_dat (np.array): The data the models of fits were fitted to. Read counts for betabinom and allele balance otherwise.
+        fits (dict): Models fitted by the selection, keyed by ploidy
+        settings (dict): The run settings of est_ploidy
+        executor (ProcessPoolExecutor): Pool for EM restarts, or None
+        cache (FitCache): Cache of gmm fits, or None
+        n_jobs (int): The number of worker processes of executor
+
+    Returns:
+        fits (dict): Fitted models keyed by every candidate ploidy in the order of ploidy_levels
+    """
+    method = settings['method']
+    model_constraints = settings['model_constraints']
+    pruned = [p for p in settings['ploidy_levels'] if p not in fits]
+    if len(pruned) > 0:
+        logging.info(f'Individual {ind_name}: fitting pruned ploidies {pruned} on all sites for the bootstrap')
+    candidates = {}
+    for p in settings['ploidy_levels']:
+        if p in fits:
+            candidates[p] = fits[p]
+            continue
+        means, weights = get_fixed_params(p - 1)
+        if method == 'betabinom':
+            model = BetaBinomialMixture(p, fixed_weights = weights if model_constraints == 2 else None, min_alt = settings['minimum_count'])
+            model.fit(boot_dat)
+        elif method in MIXTURE_MODELS:
+            model = MIXTURE_MODELS[method](p - 1, fixed_means = means if model_constraints in [1, 2] else None, fixed_weights = weights if model_constraints == 2 else None)
+            model.fit(np.ravel(boot_dat), executor = executor, n_jobs = n_jobs)
+        else:
+            dtype = PRECISIONS[settings['precision']]
+            model = fit_gmm_cached(np.asarray(boot_dat, dtype=dtype), p, model_constraints, dtype, cache)[0]
+        candidates[p] = model
+    return(candidates)
+
+def fit_individual(ind_name, ind_dat, ind_depth, ind_mask, settings, executor=None, cache=None, renderer=None, store=None, quiet=False, compacted=False, n_jobs=1):
+    """
+    Filters the sites of one individual and fits its ploidy as est_ploidy does for each individual.
+    Sites must pass filters and have an allele balance between 0.05 and 0.95.
+
+    Parameters:
+        ind_name (str): Name of the individual
+        ind_dat (np.array): Allele balance of the individual at every site
+        ind_depth (np.array): Read depth of the individual at every site
+        ind_mask (np.array): Sites passing filters, or None when all sites pass
+        settings (dict): The run settings of est_ploidy: method, ploidy_levels as a list of ints, minimum_sites, model_constraints,
+            output_dir, precision, selection, prescreen, lmm_engine, n_bootstrap, block_size, and minimum_count
+        executor (ProcessPoolExecutor): Pool for bootstrap replicates and EM restarts, or None
+        cache (FitCache): Cache of gmm fits, or None
+        renderer (PlotRenderer): Receives the plot payloads. None plots synchronously.
+        store (ResultsStore): Receives the fitted models and LMM test, or None
+        quiet (bool): Do not print LMM summaries and tests to stdout
+        compacted (bool): ind_dat and ind_depth already hold only the sites to fit, as packed by compact_individuals, and are used without copies
+        n_jobs (int): The number of worker processes of executor, over which the EM restarts are split
+
+    Returns:
+        record (dict): 'ploidy' (None if skipped for too few sites), 'n_sites', the ploidy.txt 'line' (None if skipped),
+            the LMM 'p_value', and the 'bootstrap' summary
+    """
+    method = settings['method']
+    ploidy = settings['ploidy_levels']
+    minimum_sites = settings['minimum_sites']
+    model_constraints = settings['model_constraints']
+    output_dir = settings['output_dir']
+    n_bootstrap = settings['n_bootstrap']
+    if compacted:
+        ind_dat_filtered_truncated = ind_dat
+        ind_depth_filtered_truncated = ind_depth
+    else:
+        if ind_mask is None:
+            ind_dat_filtered = ind_dat
+            ind_depth_filtered = ind_depth
+        else:
+            ind_dat_filtered = ind_dat[ind_mask]
+            ind_depth_filtered = ind_depth[ind_mask]
+        ind_dat_buffer = (ind_dat_filtered > 0.05) & (ind_dat_filtered < 0.95)
+        ind_dat_filtered_truncated = ind_dat_filtered[ind_dat_buffer]
+        ind_depth_filtered_truncated = ind_depth_filtered[ind_dat_buffer]
+    dat = ind_dat_filtered_truncated
+    if len(ind_dat_filtered_truncated.shape) == 1:
+        dat = ind_dat_filtered_truncated.reshape(-1, 1)
+    n_sites = len(dat[:])
+    if n_sites < minimum_sites:
+        logging.warning(f'Individual {ind_name}: Sample skipped due to low site count passing filters.\n')
+        return({'ploidy': None, 'n_sites': n_sites, 'line': None, 'p_value': None, 'bootstrap': None})
+    logging.info(f"Individual {ind_name}: {n_sites} sites")
+    ind_ploidy = ploidy
+    if settings['prescreen']:
+        ind_ploidy = prescreen_ploidy(ind_name, ind_dat_filtered_truncated, ploidy, ind_depth_filtered_truncated)
+    boot_string = ''
+    boot = None
+    boot_dat = dat
+    if method == 'betabinom':
+        boot_dat = np.column_stack(ab_to_counts(ind_dat_filtered_truncated, ind_depth_filtered_truncated))
+        best_n, predictions, fits = fit_betabinom_to_ab(ind_name, boot_dat, ind_ploidy, model_constraints, output_dir, min_alt = settings['minimum_count'], return_models = True, renderer = renderer, store = store)
+    elif method in MIXTURE_MODELS:
+        best_n, predictions, fits = fit_mixture_to_ab(ind_name, dat, ind_ploidy, method, model_constraints, output_dir, executor = executor, n_jobs = n_jobs, return_models = True, renderer = renderer, store = store)
+    elif n_bootstrap > 0:
+        best_n, predictions, fits = fit_gmm_to_ab(ind_name, dat, ind_ploidy, model_constraints, output_dir, settings['precision'], settings['selection'], return_models = True, cache = cache, renderer = renderer, store = store)
+    else:
+        best_n, predictions = fit_gmm_to_ab(ind_name, dat, ind_ploidy, model_constraints, output_dir, settings['precision'], settings['selection'], cache = cache, renderer = renderer, store = store)
+    if n_bootstrap > 0:
+        fits = fit_bootstrap_candidates(ind_name, boot_dat, fits, settings, executor, cache, n_jobs)
+        boot = bootstrap_ploidy(ind_name, boot_dat, fits, best_n, n_bootstrap, settings['block_size'], executor = executor)
+        # Bootstrap support and the 2.5%, 50%, and 97.5% quantiles of the BIC difference to the best alternative
+        boot_string = f'\t{boot["support"]}\t{boot["dbic_lower"]}\t{boot["dbic_median"]}\t{boot["dbic_upper"]}'
+    if best_n > 2:
+        from popopolus.fit_mixtures.lmm import fit_mixed_model_ab
+        lmm_result, rand_effects, fixed_effects, p_value = fit_mixed_model_ab(ind_name, ind_dat_filtered_truncated, ind_depth_filtered_truncated, predictions, output_dir, settings['lmm_engine'], renderer = renderer, store = store, quiet = quiet)
+        if not quiet:
+            print(lmm_result.summary())
+            print(rand_effects)
+            print(fixed_effects)
+            print(f'p-value versus diploid assumption: {p_value}')
+        line = f'{ind_name}\t{best_n}\t{p_value}{boot_string}\n'
+    else:
+        p_value = None
+        if not quiet:
+            print('diploid detected - skipping lmm')
+        line = f'{ind_name}\t{best_n}\tNA{boot_string}\n'
+    return({'ploidy': int(best_n), 'n_sites': n_sites, 'line': line, 'p_value': p_value, 'bootstrap': boot})
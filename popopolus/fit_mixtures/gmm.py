@@ -1,7 +1,9 @@
 import numpy as np
 import sys
-from popopolus.fit_mixtures.plot_mixtures import plot_gmm_fit_sklearn
+import logging
+from popopolus.fit_mixtures.render import gmm_plot_payload
 from sklearn.mixture import GaussianMixture
+from popopolus.fit_mixtures.cache import fit_key
 from .gmm_fixed_means import GaussianMixtureFixedMeans
 from .gmm_fixed_means_fixed_weights import GaussianMixtureFixedMeansFixedWeights
 
@@ -32,6 +34,9 @@ class GaussianMixtureModelFixedMeans:
 
     def score(self, X):
         return self.model.score(X)
+
+    def partial_fit(self, X):
+        self.model.partial_fit(X)
     
 class GaussianMixtureModelFixedMeansFixedWeights:
     def __init__(self, n_components=1, covariance_type='full', means_init = np.array([0.5]).reshape(-1,1), weights_init = np.array([1.0]).reshape(-1,1)):
@@ -46,8 +51,18 @@ class GaussianMixtureModelFixedMeansFixedWeights:
 
     def score(self, X):
         return self.model.score(X)
+
+    def partial_fit(self, X):
+        self.model.partial_fit(X)
     
-def get_fixed_params(n_components):
+# Supported floating point precisions for the EM, scoring, and prediction.
+# In float32 the BIC of a fitted model agrees with the float64 fit to within a
+# relative tolerance of FLOAT32_BIC_RTOL, which is below the error already
+# allowed by the EM convergence threshold (tol=1e-3 on the mean log-likelihood).
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+FLOAT32_BIC_RTOL = 1e-4
+
+def get_fixed_params(n_components, dtype=np.float64):
     means = None
     if (n_components > 6):
         sys.ext('ERROR: Ploidy greater than 6 is not implemented or recommended! Stopping.')
@@ -69,9 +84,157 @@ def get_fixed_params(n_components):
         if n_components == 5:
             means = np.array([1/6,2/6,0.5,4/6,5/6]).reshape(-1,1)
             weights = np.array([1/6,1/6,2/6,1/6,1/6])
-    return(means, weights)
+    return(means.astype(dtype), weights.astype(dtype))
+
+def get_gmm(n_components, model_constraints, dtype=np.float64):
+    """
+    Returns an unfitted mixture model with the constraints used for ploidy estimation.
+
+    Parameters:
+        n_components (int): Number of components in the GMM
+        model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
+        dtype (np.dtype): The floating point precision of the fixed parameters
+
+    Returns:
+        gmm: An unfitted mixture model
+    """
+    gmm = None
+    means, weights = get_fixed_params(n_components, dtype)
+    if model_constraints == 0:
+        gmm = GaussianMixture(n_components = n_components)
+    if model_constraints == 1:
+        gmm = GaussianMixtureFixedMeans(n_components = n_components, means_init = means)
+    if model_constraints == 2:
+        gmm = GaussianMixtureFixedMeansFixedWeights(n_components = n_components, means_init = means, weights_init = weights)
+    return(gmm)
+
+# Successive halving settings. Candidates are first fitted on HALVING_MIN_SITES sites and the subsample
+# grows by HALVING_FACTOR each round. A BIC gap above HALVING_MARGIN is very strong evidence against
+# a candidate (Kass and Raftery 1995), so it is dropped before the next round.
+HALVING_MIN_SITES = 1000
+HALVING_FACTOR = 3
+HALVING_MARGIN = 10.0
 
-def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir):
+def select_ploidy_halving(ind_name, dat, ploidy, model_constraints, dtype=np.float64, min_sites=HALVING_MIN_SITES, factor=HALVING_FACTOR, margin=HALVING_MARGIN, random_state=0):
+    """
+    Prune ploidy candidates by successive halving on nested, seeded subsamples of sites.
+    Every surviving candidate is fitted on the current subsample and those with a BIC more than margin above the best are dropped.
+    The subsample grows by factor until the next round would reach all sites.
+
+    Parameters:
+        ind_name (string): The name of the individual
+        dat (np.array): Allele balance data.
+        ploidy (list): The ploidies to test
+        model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
+        dtype (np.dtype): The floating point precision of the EM
+        min_sites (int): The number of sites in the first subsample
+        factor (int): The growth of the subsample between rounds
+        margin (float): The BIC gap beyond which a candidate is dropped
+        random_state (int): Seed for the site subsamples
+
+    Returns:
+        contenders (list): The ploidies to compare on all sites, in their original order
+        pruned (dict): The subsample size and BIC gap at which each dropped ploidy was pruned
+    """
+    n_sites = len(dat)
+    order = np.random.default_rng(random_state).permutation(n_sites)
+    contenders = list(ploidy)
+    pruned = {}
+    n_subsample = min_sites
+    while (len(contenders) > 1) and (n_subsample < n_sites):
+        sub = dat[np.sort(order[:n_subsample])]
+        bics = {}
+        for p in contenders:
+            gmm = get_gmm(p - 1, model_constraints, dtype)
+            gmm.fit(sub)
+            bics[p] = gmm.bic(sub)
+        best_bic = min(bics.values())
+        for p in contenders:
+            if bics[p] - best_bic > margin:
+                pruned[p] = (n_subsample, bics[p] - best_bic)
+                logging.info(f'Individual {ind_name}: ploidy {p} pruned at {n_subsample} sites with a BIC gap of {bics[p] - best_bic:.2f}')
+        contenders = [p for p in contenders if p not in pruned]
+        n_subsample = n_subsample * factor
+    return(contenders, pruned)
+
+def partial_fit_gmm_to_ab(gmms, dat, ploidy, model_constraints, precision='float64'):
+    """
+    Update the mixture model of each ploidy with one block of allele balance data using stepwise EM.
+    Blocks of sites can be passed as they come out of VCF ingestion so the full data never needs to be held in memory.
+    This is library API only. est_ploidy and the CLI still fit every individual in batch with fit_gmm_to_ab.
+    
+    Parameters:
+        gmms (dict): Models keyed by ploidy from previous blocks. Pass an empty dict with the first block.
+        dat (np.array): A block of filtered allele balance data for one individual.
+        ploidy (list): The ploidies to test
+        model_constraints (int): 1 fixes the means and 2 fixes means and weights. Unconstrained models are not supported.
+        precision (str): Floating point precision of the EM, 'float64' or 'float32'.
+
+    Returns:
+        gmms (dict): The updated models keyed by ploidy
+    """
+    if model_constraints not in (1, 2):
+        raise ValueError('Online fitting requires fixed means. Use model_constraints of 1 or 2.')
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported precision {precision}. Use 'float64' or 'float32'.")
+    dtype = PRECISIONS[precision]
+    dat = np.asarray(dat, dtype=dtype).reshape(-1, 1)
+    for i in range(0, len(ploidy)):
+        n_components = ploidy[i] - 1
+        if ploidy[i] not in gmms:
+            # The first block initializes the model so it needs at least one site per component
+            if len(dat) < n_components:
+                continue
+            gmms[ploidy[i]] = get_gmm(n_components, model_constraints, dtype)
+        elif len(dat) == 0:
+            continue
+        gmms[ploidy[i]].partial_fit(dat)
+    return(gmms)
+
+def fit_gmm_cached(dat, ploidy, model_constraints, dtype=np.float64, cache=None):
+    """
+    Fit the mixture model of one ploidy, or rebuild it from the cache if the same data were fitted before.
+
+    Parameters:
+        dat (np.array): Allele balance data in the precision of the EM
+        ploidy (int): The ploidy to fit
+        model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
+        dtype (np.dtype): The floating point precision of the EM
+        cache (FitCache): Cache of previous fits. None always fits.
+
+    Returns:
+        gmm: The fitted mixture model
+        score (float): Mean log likelihood per site
+        bic (float): Bayesian information criterion
+        labels (np.array): The component of every site, or None if no cache is used
+    """
+    gmm = get_gmm(ploidy - 1, model_constraints, dtype)
+    if cache is None:
+        gmm.fit(dat)
+        return(gmm, gmm.score(dat), gmm.bic(dat), None)
+    key = fit_key(dat, ploidy, model_constraints)
+    values = cache.get(key)
+    if values is not None:
+        gmm._set_parameters((values['weights'], values['means'], values['covariances'], values['precisions_cholesky']))
+        gmm.n_features_in_ = dat.shape[1]
+        gmm.converged_ = True
+        return(gmm, float(values['lnl']) / len(dat), float(values['bic']), values['labels'])
+    gmm.fit(dat)
+    score = gmm.score(dat)
+    bic = gmm.bic(dat)
+    labels = gmm.predict(dat)
+    cache.put(key, {
+        'means': gmm.means_,
+        'covariances': gmm.covariances_,
+        'weights': gmm.weights_,
+        'precisions_cholesky': gmm.precisions_cholesky_,
+        'lnl': score * len(dat),
+        'bic': bic,
+        'labels': labels
+    })
+    return(gmm, score, bic, labels)
+
+def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir, precision='float64', selection='full', return_models=False, cache=None, renderer=None, store=None):
     """
     Fit Gaussian Mixture Model (GMM) to allele balance data.
     
@@ -79,46 +242,74 @@ def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir):
         ind_name (string): The name of the individual
         dat (np.array): Allele balance data.
         n_components (int): Number of components in the GMM.
+        precision (str): Floating point precision of the EM, 'float64' or 'float32'.
+            BIC values from float32 agree with float64 within FLOAT32_BIC_RTOL.
+        selection (str): 'full' fits every ploidy on all sites. 'halving' first prunes candidates
+            on growing subsamples with select_ploidy_halving and only fits the contenders on all sites.
+        return_models (bool): Also return the models fitted on all sites, keyed by ploidy.
+        cache (FitCache): Fits on all sites are looked up here before fitting and stored after
+        renderer (PlotRenderer): Queues the fit plot for background rendering. None draws it before returning.
+        store (ResultsStore): Records every fitted model in the results database instead of writing {ind_name}.fit.txt
     """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported precision {precision}. Use 'float64' or 'float32'.")
+    dtype = PRECISIONS[precision]
+    dat = np.asarray(dat, dtype=dtype)
+    pruned = {}
+    if selection == 'halving':
+        ploidy, pruned = select_ploidy_halving(ind_name, dat, ploidy, model_constraints, dtype)
+    elif selection != 'full':
+        raise ValueError(f"Unsupported selection {selection}. Use 'full' or 'halving'.")
     # Fit GMM to allele balance data
     best_n = 1
     best_bic = np.inf
     best_gmm = None
+    best_labels = None
+    fits = {}
     output_file = f'{output_dir}/{ind_name}.fit.txt'
-    outfile = open(output_file, 'w')
-    for i in range(0, len(ploidy)):
-        n_components = ploidy[i] - 1
-        gmm = None
-        means, weights = get_fixed_params(n_components)
-        if model_constraints == 0:
-            gmm = GaussianMixture(n_components = n_components)
-        if model_constraints == 1:
-            gmm = GaussianMixtureFixedMeans(n_components = n_components, means_init = means)
-        if model_constraints == 2:
-            gmm = GaussianMixtureFixedMeansFixedWeights(n_components = n_components, means_init = means, weights_init = weights)
-        gmm.fit(dat)
-        score = gmm.score(dat)
-        bic = gmm.bic(dat)
-        outfile.write(f'Model for ploidy = {ploidy[i]}\n')
-        outfile.write("Fitted GMM parameters:\n")
-        outfile.write(f'Means:\n {gmm.means_}\n')
-        outfile.write(f'Covariances:\n {gmm.covariances_}\n')
-        outfile.write(f'Weights:\n {gmm.weights_}\n')
-        # Print the best likelihood
-        outfile.write(f'Best likelihood: {score}\n')
-        outfile.write(f'BIC: {bic}\n')
+    outfile = open(output_file, 'w') if store is None else None
+    for p in pruned:
+        if store is not None:
+            store.add_model(ind_name, p, 'gmm', pruned[p][0], None, None, {'pruned_bic_gap': pruned[p][1]})
+            continue
+        outfile.write(f'Model for ploidy = {p}\n')
+        outfile.write(f'Pruned by successive halving at {pruned[p][0]} sites with a BIC gap of {pruned[p][1]}\n')
         outfile.write('\n')
+    for i in range(0, len(ploidy)):
+        gmm, score, bic, labels = fit_gmm_cached(dat, ploidy[i], model_constraints, dtype, cache)
+        fits[ploidy[i]] = gmm
+        if store is not None:
+            store.add_model(ind_name, ploidy[i], 'gmm', len(dat), score * len(dat), bic, {'means': np.ravel(gmm.means_), 'covariances': np.ravel(gmm.covariances_), 'weights': gmm.weights_})
+        else:
+            outfile.write(f'Model for ploidy = {ploidy[i]}\n')
+            outfile.write("Fitted GMM parameters:\n")
+            outfile.write(f'Means:\n {gmm.means_}\n')
+            outfile.write(f'Covariances:\n {gmm.covariances_}\n')
+            outfile.write(f'Weights:\n {gmm.weights_}\n')
+            # Print the best likelihood
+            outfile.write(f'Best likelihood: {score}\n')
+            outfile.write(f'BIC: {bic}\n')
+            outfile.write('\n')
         # only consider a 3.2 point difference via Kass and Raftery 1995
         if bic < (best_bic - 3.2):
             best_bic = bic
             best_n = ploidy[i]
             best_gmm = gmm
+            best_labels = labels
         #We can return the categories for each point based on posterior probabilities too
         #Will be used in downstream linear models
         #Create permutation test to check if model is actually a good fit
-        predictions = best_gmm.predict(dat)
-        #print(predictions)
-    outfile.close()
-    plot_gmm_fit_sklearn(dat, best_gmm, output_dir, plot_name=f'{ind_name}.fit', title=f'GMM Fit to Allele Balance Data ({ind_name})')
+    predictions = best_labels if best_labels is not None else best_gmm.predict(dat)
+    #print(predictions)
+    if outfile is not None:
+        outfile.close()
+    plot_title = f'GMM Fit to Allele Balance Data ({ind_name})'
+    if renderer is None:
+        from popopolus.fit_mixtures.plot_mixtures import plot_gmm_fit_sklearn
+        plot_gmm_fit_sklearn(dat, best_gmm, output_dir, plot_name=f'{ind_name}.fit', title=plot_title)
+    elif renderer.wants('individual'):
+        renderer.submit(gmm_plot_payload(dat, best_gmm, f'{ind_name}.fit', plot_title))
 
+    if return_models:
+        return(best_n, predictions, fits)
     return(best_n, predictions)
\ No newline at end of file
@@ -1,118 +1,367 @@
 import numpy as np
-from scipy import stats
-from scipy.optimize import minimize
+from scipy.special import gammaln, digamma, polygamma, logsumexp
 from typing import Tuple, List, Dict
 import logging
 
-# These functions are not in use. Just a poor attempt to lift over the old R code to avoid scikit learn and allow more flexibility in model specification
-# Leaving to return to in the future, but optimization is not correct
-def fit_mixture_model(x: np.ndarray, n_components: int, model_type: str = 'normal') -> Dict:
+# Mixtures with normal, gamma, or lognormal components fitted by EM in log space.
+# Every restart starts from a different seeded initialization and restarts can run in parallel.
+# Component means and weights can be fixed to the expected allele balances of a ploidy like the sklearn models in gmm.py.
+def fit_mixture_model(x: np.ndarray, n_components: int, model_type: str = 'normal', n_init: int = 10, random_state: int = 0, executor=None, n_jobs: int = 1) -> Dict:
     """
     Fit a mixture model to data
-    
+
     Parameters:
         x: Input data
         n_components: Number of mixture components
         model_type: Type of mixture model ('normal', 'gamma', or 'lognormal')
-        
+        n_init: Number of seeded EM restarts
+        random_state: Seed for the restarts
+        executor: Runs the restarts in parallel if given
+        n_jobs: Number of worker processes of executor
+
     Returns:
         Dictionary containing fitted parameters and log likelihood
     """
-    model_classes = {
-        'normal': NormalMixture,
-        'gamma': GammaMixture,
-        'lognormal': LognormalMixture
-    }
-    
-    if model_type not in model_classes:
+    if model_type not in MIXTURE_MODELS:
         raise ValueError(f"Unknown model type: {model_type}")
-    
-    model = model_classes[model_type](n_components)
-    result = model.fit(x)
-    
+
+    model = MIXTURE_MODELS[model_type](n_components, n_init=n_init, random_state=random_state)
+    result = model.fit(x, executor=executor, n_jobs=n_jobs)
+
     return result
 
 
+def _fit_restart(model, x: np.ndarray, seed) -> Tuple[float, np.ndarray, np.ndarray, int]:
+    """Run one EM restart. Defined at module level so restarts can be sent to worker processes."""
+    rng = np.random.default_rng(seed)
+    weights, params = model._init_params(x, rng)
+    return model._em(x, weights, params)
+
+
+def _fit_restarts(model, x: np.ndarray, seeds) -> List[Tuple[float, np.ndarray, np.ndarray, int]]:
+    """Run a batch of EM restarts in one task so x is sent to a worker process once per batch rather than once per restart."""
+    return [_fit_restart(model, x, seed) for seed in seeds]
+
+
 class MixtureModel:
-    """Base class for mixture models with different component distributions"""
-    
-    def __init__(self, n_components: int):
+    """
+    Base class for mixture models with different component distributions.
+    Subclasses provide the component log density and the weighted maximum likelihood M-step.
+
+    Parameters:
+        n_components (int): Number of mixture components
+        fixed_means (np.array): Component locations held fixed during EM. See the subclass for the location that is fixed.
+        fixed_weights (np.array): Component weights held fixed during EM
+        n_init (int): Number of seeded EM restarts. The restart with the highest log likelihood is kept.
+        max_iter (int): Maximum number of EM iterations per restart
+        tol (float): EM stops when the mean log likelihood improves by less than tol
+        reg_scale (float): Added to every variance to keep components from collapsing onto single values
+        random_state (int): Seed for the restarts
+    """
+
+    def __init__(self, n_components: int, fixed_means=None, fixed_weights=None, n_init: int = 10, max_iter: int = 500, tol: float = 1e-6, reg_scale: float = 1e-6, random_state: int = 0):
         self.n_components = n_components
+        self.fixed_means = None if fixed_means is None else np.ravel(fixed_means).astype(float)
+        self.fixed_weights = None if fixed_weights is None else np.ravel(fixed_weights).astype(float)
+        self.n_init = n_init
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reg_scale = reg_scale
+        self.random_state = random_state
         self.weights = None
         self.params = None
-        
-    def _component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
-        """Calculate PDF for each component. To be implemented by subclasses."""
+
+    def _log_component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+        """Log density of every sample (rows) under every component (columns). To be implemented by subclasses."""
+        raise NotImplementedError
+
+    def _m_step(self, x: np.ndarray, resp: np.ndarray) -> np.ndarray:
+        """Weighted maximum likelihood component parameters given responsibilities. To be implemented by subclasses."""
         raise NotImplementedError
-        
-    def _init_params(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-        """Initialize model parameters using data quantiles"""
-        weights = np.ones(self.n_components) / self.n_components
-        # Sort data and split into n_components parts
-        x_sorted = np.sort(x)
-        splits = np.array_split(x_sorted, self.n_components)
-        means = [np.mean(split) for split in splits]
-        stds = [np.std(split) for split in splits]
-        params = np.concatenate([means, stds])
-        return weights, params
-    
-    def _negative_log_likelihood(self, params: np.ndarray, x: np.ndarray) -> float:
-        """Calculate negative log likelihood for optimization"""
-        n_samples = len(x)
-        reshaped_params = params.reshape(2, self.n_components)
-        component_probs = self._component_pdf(x[:, np.newaxis], reshaped_params)
-        mixture_probs = np.sum(self.weights[:, np.newaxis] * component_probs, axis=0)
-        return -np.sum(np.log(mixture_probs + 1e-10))
-    
-    def fit(self, x: np.ndarray, n_init: int = 10) -> Dict:
-        """Fit mixture model using multiple random initializations"""
-        best_nll = np.inf
-        best_result = None
-        
-        for _ in range(n_init):
-            # Initialize parameters
-            weights, init_params = self._init_params(x)
-            self.weights = weights
-            
-            # Optimize
-            result = minimize(
-                self._negative_log_likelihood,
-                init_params,
-                args=(x,),
-                method='Nelder-Mead'
-            )
-            
-            if result.fun < best_nll:
-                best_nll = result.fun
-                best_result = result
-                self.params = result.x
-        
+
+    def _check_data(self, x: np.ndarray) -> np.ndarray:
+        return np.ravel(np.asarray(x, dtype=float))
+
+    def _init_params(self, x: np.ndarray, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Initialize from a random hard partition of the data.
+        Distinct data points drawn by rng are the component centres (jittered fixed means if given)
+        and each sample is assigned to the nearest centre before a single M-step.
+        """
+        if self.fixed_means is not None:
+            # Jitter the fixed means by up to half their spacing so restarts partition the data differently
+            spacing = np.diff(self.fixed_means).min() if self.n_components > 1 else x.std()
+            centres = self.fixed_means + rng.uniform(-0.5, 0.5, self.n_components) * spacing
+        else:
+            centres = np.sort(rng.choice(x, self.n_components, replace=False))
+        labels = np.abs(x[:, np.newaxis] - centres[np.newaxis, :]).argmin(axis=1)
+        resp = np.zeros((len(x), self.n_components))
+        resp[np.arange(len(x)), labels] = 1
+        # Keep every component alive with a little mass from all samples
+        resp = (resp + 1e-3) / (1 + 1e-3 * self.n_components)
+        weights = resp.mean(axis=0) if self.fixed_weights is None else self.fixed_weights
+        return weights, self._m_step(x, resp)
+
+    def _e_step(self, x: np.ndarray, weights: np.ndarray, params: np.ndarray) -> Tuple[float, np.ndarray]:
+        weighted_log_prob = self._log_component_pdf(x, params) + np.log(weights)[np.newaxis, :]
+        log_prob_norm = logsumexp(weighted_log_prob, axis=1)
+        log_resp = weighted_log_prob - log_prob_norm[:, np.newaxis]
+        return log_prob_norm.sum(), np.exp(log_resp)
+
+    def _em(self, x: np.ndarray, weights: np.ndarray, params: np.ndarray) -> Tuple[float, np.ndarray, np.ndarray, int]:
+        """EM from one starting point. Returns the log likelihood, weights, parameters, and number of iterations."""
+        log_likelihood = -np.inf
+        for n_iter in range(1, self.max_iter + 1):
+            new_log_likelihood, resp = self._e_step(x, weights, params)
+            if self.fixed_weights is None:
+                weights = np.maximum(resp.mean(axis=0), 1e-12)
+                weights /= weights.sum()
+            params = self._m_step(x, resp)
+            change = (new_log_likelihood - log_likelihood) / len(x)
+            log_likelihood = new_log_likelihood
+            if abs(change) < self.tol:
+                break
+        log_likelihood, _ = self._e_step(x, weights, params)
+        return log_likelihood, weights, params, n_iter
+
+    def fit(self, x: np.ndarray, executor=None, n_jobs: int = 1) -> Dict:
+        """
+        Fit the mixture model with n_init seeded restarts.
+        Restarts draw from independent streams of np.random.SeedSequence(random_state)
+        so the result does not depend on whether they run in parallel.
+        In parallel the restarts are split into one contiguous batch per worker, so the data are pickled once per worker.
+
+        Parameters:
+            x (np.array): Input data
+            executor (concurrent.futures.Executor): Runs the restarts in parallel if given
+            n_jobs (int): Number of worker processes of executor, which is the number of restart batches
+
+        Returns:
+            Dictionary containing fitted weights, parameters, and log likelihood
+        """
+        x = self._check_data(x)
+        seeds = np.random.SeedSequence(self.random_state).spawn(self.n_init)
+        if executor is None:
+            results = [_fit_restart(self, x, seed) for seed in seeds]
+        else:
+            n_batches = max(1, min(self.n_init, n_jobs))
+            bounds = np.linspace(0, self.n_init, n_batches + 1).astype(int)
+            batches = [seeds[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+            results = [r for batch in executor.map(_fit_restarts, [self] * n_batches, [x] * n_batches, batches) for r in batch]
+        best = int(np.argmax([r[0] for r in results]))
+        log_likelihood, self.weights, self.params, self.n_iter_ = results[best]
+        self.log_likelihood_ = log_likelihood
+        self.n_features_in_ = 1
+        logging.debug(f'{type(self).__name__} with {self.n_components} components: best of {self.n_init} restarts has log likelihood {log_likelihood}')
+
         return {
             'weights': self.weights,
-            'params': self.params.reshape(2, self.n_components),
-            'log_likelihood': -best_nll
+            'params': self.params,
+            'log_likelihood': log_likelihood
         }
 
+    def score_samples(self, x: np.ndarray) -> np.ndarray:
+        """Log density of the mixture at every sample"""
+        x = self._check_data(x)
+        return logsumexp(self._log_component_pdf(x, self.params) + np.log(self.weights)[np.newaxis, :], axis=1)
+
+    def score(self, x: np.ndarray) -> float:
+        """Mean log likelihood per sample"""
+        return self.score_samples(x).mean()
+
+    def predict_proba(self, x: np.ndarray) -> np.ndarray:
+        _, resp = self._e_step(self._check_data(x), self.weights, self.params)
+        return resp
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """Most likely component of every sample"""
+        return self.predict_proba(x).argmax(axis=1)
+
+    def _n_parameters(self) -> int:
+        """Number of free parameters: the scale of every component plus any free locations and weights"""
+        n_parameters = self.n_components
+        if self.fixed_means is None:
+            n_parameters += self.n_components
+        if self.fixed_weights is None:
+            n_parameters += self.n_components - 1
+        return n_parameters
+
+    def bic(self, x: np.ndarray) -> float:
+        x = self._check_data(x)
+        return -2 * self.score_samples(x).sum() + self._n_parameters() * np.log(len(x))
+
 class NormalMixture(MixtureModel):
-    """Mixture of Normal distributions"""
-    
-    def _component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """Mixture of Normal distributions. params are the means (row 0) and standard deviations (row 1)."""
+
+    def _log_component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
         means = params[0]
-        stds = np.abs(params[1])  # Ensure positive standard deviations
-        return stats.norm.pdf(x, means, stds)
+        stds = params[1]
+        z = (x[:, np.newaxis] - means[np.newaxis, :]) / stds[np.newaxis, :]
+        return -0.5 * z ** 2 - np.log(stds)[np.newaxis, :] - 0.5 * np.log(2 * np.pi)
+
+    def _m_step(self, x: np.ndarray, resp: np.ndarray) -> np.ndarray:
+        nk = resp.sum(axis=0) + 10 * np.finfo(float).eps
+        if self.fixed_means is None:
+            means = (resp.T @ x) / nk
+        else:
+            means = self.fixed_means
+        variances = (resp * (x[:, np.newaxis] - means[np.newaxis, :]) ** 2).sum(axis=0) / nk + self.reg_scale
+        return np.array([means, np.sqrt(variances)])
 
 class GammaMixture(MixtureModel):
-    """Mixture of Gamma distributions"""
-    
-    def _component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
-        shapes = np.abs(params[0])  # Ensure positive shape parameters
-        scales = np.abs(params[1])  # Ensure positive scale parameters
-        return stats.gamma.pdf(x, shapes, scale=scales)
+    """
+    Mixture of Gamma distributions. params are the shapes (row 0) and scales (row 1).
+    Fixed means fix shape * scale and only the shape is estimated.
+    """
+
+    def _check_data(self, x: np.ndarray) -> np.ndarray:
+        x = super()._check_data(x)
+        if np.any(x <= 0):
+            raise ValueError('Gamma mixtures need strictly positive data')
+        return x
+
+    def _log_component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+        shapes = params[0][np.newaxis, :]
+        scales = params[1][np.newaxis, :]
+        log_x = np.log(x)[:, np.newaxis]
+        return (shapes - 1) * log_x - x[:, np.newaxis] / scales - shapes * np.log(scales) - gammaln(shapes)
+
+    def _m_step(self, x: np.ndarray, resp: np.ndarray) -> np.ndarray:
+        nk = resp.sum(axis=0) + 10 * np.finfo(float).eps
+        mean_x = (resp.T @ x) / nk
+        mean_log_x = (resp.T @ np.log(x)) / nk
+        if self.fixed_means is None:
+            means = mean_x
+            target = np.log(mean_x) - mean_log_x
+        else:
+            means = self.fixed_means
+            target = np.log(means) - mean_log_x + mean_x / means - 1
+        # Jensen's inequality makes target positive, only rounding can break it
+        target = np.maximum(target, 1e-12)
+        shapes = self._solve_shape(target)
+        return np.array([shapes, means / shapes])
+
+    @staticmethod
+    def _solve_shape(target: np.ndarray, n_newton: int = 6) -> np.ndarray:
+        """
+        Solve log(k) - digamma(k) = target for the shape k of every component at once.
+        Newton iterations on log(k) from the approximation of Minka (2002) converge in a few steps.
+        """
+        shapes = (3 - target + np.sqrt((target - 3) ** 2 + 24 * target)) / (12 * target)
+        for _ in range(n_newton):
+            f = np.log(shapes) - digamma(shapes) - target
+            df = 1 - shapes * polygamma(1, shapes)
+            shapes = shapes * np.exp(-f / df)
+        return shapes
 
 class LognormalMixture(MixtureModel):
-    """Mixture of Lognormal distributions"""
-    
-    def _component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """
+    Mixture of Lognormal distributions. params are the means (row 0) and standard deviations (row 1) of log(x).
+    Fixed means fix the component medians exp(params[0]), which keeps the M-step in closed form.
+    """
+
+    def _check_data(self, x: np.ndarray) -> np.ndarray:
+        x = super()._check_data(x)
+        if np.any(x <= 0):
+            raise ValueError('Lognormal mixtures need strictly positive data')
+        return x
+
+    def _log_component_pdf(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
         locs = params[0]
-        scales = np.abs(params[1])  # Ensure positive scale parameters
-        return stats.lognorm.pdf(x, scales, loc=0, scale=np.exp(locs))
\ No newline at end of file
+        scales = params[1]
+        log_x = np.log(x)[:, np.newaxis]
+        z = (log_x - locs[np.newaxis, :]) / scales[np.newaxis, :]
+        return -0.5 * z ** 2 - np.log(scales)[np.newaxis, :] - 0.5 * np.log(2 * np.pi) - log_x
+
+    def _m_step(self, x: np.ndarray, resp: np.ndarray) -> np.ndarray:
+        nk = resp.sum(axis=0) + 10 * np.finfo(float).eps
+        log_x = np.log(x)
+        if self.fixed_means is None:
+            locs = (resp.T @ log_x) / nk
+        else:
+            locs = np.log(self.fixed_means)
+        variances = (resp * (log_x[:, np.newaxis] - locs[np.newaxis, :]) ** 2).sum(axis=0) / nk + self.reg_scale
+        return np.array([locs, np.sqrt(variances)])
+
+MIXTURE_MODELS = {
+    'normal': NormalMixture,
+    'gamma': GammaMixture,
+    'lognormal': LognormalMixture
+}
+
+def fit_mixture_to_ab(ind_name, dat, ploidy, model_type, model_constraints, output_dir, n_init=10, random_state=0, executor=None, n_jobs=1, return_models=False, renderer=None, store=None):
+    """
+    Fit mixtures of normal, gamma, or lognormal components to allele balance data and select the ploidy by BIC.
+    Follows fit_gmm_to_ab: the same ploidy selection rule and the same .fit.txt and .fit.png outputs.
+
+    Parameters:
+        ind_name (string): The name of the individual
+        dat (np.array): Allele balance data
+        ploidy (list): The ploidies to test
+        model_type (str): The component distribution, 'normal', 'gamma', or 'lognormal'
+        model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
+        output_dir (str): The output directory where all results will be directed
+        n_init (int): Number of seeded EM restarts for every ploidy
+        random_state (int): Seed for the restarts
+        executor (concurrent.futures.Executor): Runs the restarts in parallel if given
+        n_jobs (int): Number of worker processes of executor
+        return_models (bool): Also return the fitted models, keyed by ploidy
+        renderer (PlotRenderer): Queues the fit plot for background rendering. None draws it before returning.
+        store (ResultsStore): Records every fitted model in the results database instead of writing {ind_name}.fit.txt
+
+    Returns:
+        best_n (int): The selected ploidy
+        predictions (np.array): The component of every site under the selected model
+    """
+    from popopolus.fit_mixtures.gmm import get_fixed_params
+    from popopolus.fit_mixtures.render import mixture_plot_payload
+    if model_type not in MIXTURE_MODELS:
+        raise ValueError(f"Unknown model type: {model_type}. Use 'normal', 'gamma', or 'lognormal'.")
+    dat = np.ravel(np.asarray(dat, dtype=float))
+    best_n = 1
+    best_bic = np.inf
+    best_model = None
+    fits = {}
+    output_file = f'{output_dir}/{ind_name}.fit.txt'
+    outfile = open(output_file, 'w') if store is None else None
+    for p in ploidy:
+        n_components = p - 1
+        means, weights = get_fixed_params(n_components)
+        model = MIXTURE_MODELS[model_type](
+            n_components,
+            fixed_means = means if model_constraints in [1, 2] else None,
+            fixed_weights = weights if model_constraints == 2 else None,
+            n_init = n_init,
+            random_state = random_state
+        )
+        model.fit(dat, executor=executor, n_jobs=n_jobs)
+        fits[p] = model
+        bic = model.bic(dat)
+        if store is not None:
+            store.add_model(ind_name, p, model_type, len(dat), model.score(dat) * len(dat), bic, {'params': model.params, 'weights': model.weights})
+        else:
+            outfile.write(f'Model for ploidy = {p}\n')
+            outfile.write(f'Fitted {model_type} mixture parameters:\n')
+            outfile.write(f'Parameters:\n {model.params}\n')
+            outfile.write(f'Weights:\n {model.weights}\n')
+            outfile.write(f'Best likelihood: {model.score(dat)}\n')
+            outfile.write(f'BIC: {bic}\n')
+            outfile.write('\n')
+        # only consider a 3.2 point difference via Kass and Raftery 1995
+        if bic < (best_bic - 3.2):
+            best_bic = bic
+            best_n = p
+            best_model = model
+    predictions = best_model.predict(dat)
+    if outfile is not None:
+        outfile.close()
+    plot_title = f'{model_type.capitalize()} Mixture Fit to Allele Balance Data ({ind_name})'
+    if renderer is None:
+        from popopolus.fit_mixtures.plot_mixtures import plot_mixture_fit
+        plot_mixture_fit(dat, best_model, output_dir, plot_name=f'{ind_name}.fit', title=plot_title)
+    elif renderer.wants('individual'):
+        renderer.submit(mixture_plot_payload(dat, best_model, f'{ind_name}.fit', plot_title))
+
+    if return_models:
+        return(best_n, predictions, fits)
+    return(best_n, predictions)
@@ -36,10 +36,12 @@ The means are fixed based on n_components to match the expected ploidy distribut
 #OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 #OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from numbers import Real
+
 import numpy as np
 from scipy import linalg
 from sklearn.utils import check_array
-from sklearn.utils._param_validation import StrOptions
+from sklearn.utils._param_validation import Interval, StrOptions
 from sklearn.utils.extmath import row_norms
 from sklearn.mixture._base import BaseMixture, _check_shape
 
@@ -323,6 +325,9 @@ def _estimate_gaussian_parameters(X, resp, reg_covar, covariance_type, fixed_mea
         The covariance matrix of the current components.
         The shape depends of the covariance_type.
     """
+    # Keep the responsibilities in the precision of the data so that a float32
+    # input is not silently promoted to float64 by the kmeans initialization
+    resp = resp.astype(X.dtype, copy=False)
     nk = resp.sum(axis=0) + 10 * np.finfo(resp.dtype).eps
     means = fixed_means
     covariances = {
@@ -334,6 +339,87 @@ def _estimate_gaussian_parameters(X, resp, reg_covar, covariance_type, fixed_mea
     return fixed_weights, means, covariances
 
 
+def _estimate_gaussian_statistics(X, resp, covariance_type, fixed_means):
+    """Estimate the per-sample sufficient statistics of a block of samples.
+
+    These are the statistics blended across blocks by the stepwise EM in
+    `partial_fit`. Because the means are fixed, only the component
+    proportions and the scatter around the fixed means are needed.
+
+    Parameters
+    ----------
+    X : array-like of shape (n_samples, n_features)
+
+    resp : array-like of shape (n_samples, n_components)
+
+    covariance_type : {'full', 'tied', 'diag', 'spherical'}
+
+    fixed_means : array-like of shape (n_components, n_features)
+
+    Returns
+    -------
+    s0 : array, shape (n_components,)
+        The average responsibility of each component.
+
+    s2 : array-like
+        The average scatter around the fixed means, without regularization.
+        The shape depends of the covariance_type.
+    """
+    n_samples, _ = X.shape
+    resp = resp.astype(X.dtype, copy=False)
+    nk = resp.sum(axis=0) + 10 * np.finfo(resp.dtype).eps
+    covariances = {
+        "full": _estimate_gaussian_covariances_full,
+        "tied": _estimate_gaussian_covariances_tied,
+        "diag": _estimate_gaussian_covariances_diag,
+        "spherical": _estimate_gaussian_covariances_spherical,
+    }[covariance_type](resp, X, nk, fixed_means, 0.0)
+    s0 = nk / n_samples
+    if covariance_type == "full":
+        s2 = covariances * s0[:, np.newaxis, np.newaxis]
+    elif covariance_type == "diag":
+        s2 = covariances * s0[:, np.newaxis]
+    elif covariance_type == "spherical":
+        s2 = covariances * s0
+    else:
+        s2 = covariances
+    return s0, s2
+
+
+def _covariances_from_statistics(s0, s2, reg_covar, covariance_type):
+    """Recover regularized covariances from blended sufficient statistics.
+
+    Parameters
+    ----------
+    s0 : array-like of shape (n_components,)
+
+    s2 : array-like
+        The shape depends of the covariance_type.
+
+    reg_covar : float
+
+    covariance_type : {'full', 'tied', 'diag', 'spherical'}
+
+    Returns
+    -------
+    covariances : array-like
+        The shape depends of the covariance_type.
+    """
+    if covariance_type == "full":
+        covariances = s2 / s0[:, np.newaxis, np.newaxis]
+        n_features = covariances.shape[1]
+        for k in range(len(covariances)):
+            covariances[k].flat[:: n_features + 1] += reg_covar
+    elif covariance_type == "tied":
+        covariances = s2.copy()
+        covariances.flat[:: len(covariances) + 1] += reg_covar
+    elif covariance_type == "diag":
+        covariances = s2 / s0[:, np.newaxis] + reg_covar
+    else:
+        covariances = s2 / s0 + reg_covar
+    return covariances
+
+
 def _compute_precision_cholesky(covariances, covariance_type):
     """Compute the Cholesky decomposition of the precisions.
 
@@ -653,6 +739,15 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
     verbose_interval : int, default=10
         Number of iteration done before the next print.
 
+    learning_decay : float, default=0.7
+        Exponent of the decaying step size used by `partial_fit`. The step
+        size of the t-th block is ``(t + learning_offset) ** -learning_decay``.
+        Values in (0.5, 1.0] guarantee convergence of the stepwise EM.
+
+    learning_offset : float, default=1.0
+        Offset of the decaying step size used by `partial_fit`. Larger
+        values downweight the early blocks.
+
     Attributes
     ----------
     weights_ : array-like of shape (n_components,)
@@ -712,6 +807,9 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
         The list of lower bound values on the log-likelihood from each
         iteration of the best fit of EM.
 
+    n_batches_ : int
+        Number of blocks seen by `partial_fit`.
+
     n_features_in_ : int
         Number of features seen during :term:`fit`.
 
@@ -750,6 +848,8 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
         "weights_init": ["array-like", None],
         "means_init": ["array-like", None],
         "precisions_init": ["array-like", None],
+        "learning_decay": [Interval(Real, 0, 1, closed="right")],
+        "learning_offset": [Interval(Real, 1, None, closed="left")],
     }
 
     def __init__(
@@ -769,6 +869,8 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
         warm_start=False,
         verbose=0,
         verbose_interval=10,
+        learning_decay=0.7,
+        learning_offset=1.0,
     ):
         super().__init__(
             n_components=n_components,
@@ -787,18 +889,22 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
         self.weights_init = weights_init
         self.means_init = means_init
         self.precisions_init = precisions_init
+        self.learning_decay = learning_decay
+        self.learning_offset = learning_offset
 
     def _check_parameters(self, X):
         """Check the Gaussian mixture parameters are well defined."""
         _, n_features = X.shape
 
         if self.weights_init is not None:
-            self.weights_init = _check_weights(self.weights_init, self.n_components)
+            self.weights_init = _check_weights(
+                self.weights_init, self.n_components
+            ).astype(X.dtype, copy=False)
 
         if self.means_init is not None:
             self.means_init = _check_means(
                 self.means_init, self.n_components, n_features
-            )
+            ).astype(X.dtype, copy=False)
 
         if self.precisions_init is not None:
             self.precisions_init = _check_precisions(
@@ -872,6 +978,69 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
             self.covariances_, self.covariance_type
         )
 
+    def partial_fit(self, X, y=None):
+        """Update the model with a block of samples using stepwise EM.
+
+        The first call fits the block with the full EM to initialize the
+        parameters. Every later call runs a single E-step on its block and
+        blends the block's sufficient statistics into the running
+        statistics with the decaying step size
+        ``(n_batches_ + learning_offset) ** -learning_decay``, followed by
+        an M-step (Cappe and Moulines, 2009). The means are never updated,
+        so blocks of sites can be streamed through the model without
+        holding all of them in memory.
+
+        Parameters
+        ----------
+        X : array-like of shape (n_samples, n_features)
+            A block of n_features-dimensional data points. The first block
+            must contain at least n_components samples.
+
+        y : Ignored
+            Not used, present for API consistency by convention.
+
+        Returns
+        -------
+        self : object
+            The updated mixture.
+        """
+        X = check_array(X, dtype=[np.float64, np.float32])
+        first_call = not hasattr(self, "n_batches_")
+        if first_call:
+            self.fit(X)
+            self.n_batches_ = 0
+        elif X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has {X.shape[1]} features, but {self.__class__.__name__} "
+                f"is expecting {self.n_features_in_} features as input."
+            )
+
+        log_prob_norm, log_resp = self._e_step(X)
+        s0, s2 = _estimate_gaussian_statistics(
+            X, np.exp(log_resp), self.covariance_type, self.means_
+        )
+        if first_call:
+            self.stats_ = (s0, s2)
+        else:
+            step = (self.n_batches_ + self.learning_offset) ** -self.learning_decay
+            self.stats_ = (
+                (1.0 - step) * self.stats_[0] + step * s0,
+                (1.0 - step) * self.stats_[1] + step * s2,
+            )
+        self.n_batches_ += 1
+
+        # Avoid updating weights
+        self.weights_ = self.weights_init
+        self.covariances_ = _covariances_from_statistics(
+            self.stats_[0], self.stats_[1], self.reg_covar, self.covariance_type
+        )
+        self.precisions_cholesky_ = _compute_precision_cholesky(
+            self.covariances_, self.covariance_type
+        )
+        self._set_parameters(self._get_parameters())
+        self.lower_bound_ = log_prob_norm
+        return self
+
     def _estimate_log_prob(self, X):
         return _estimate_log_gaussian_prob(
             X, self.means_, self.precisions_cholesky_, self.covariance_type
@@ -0,0 +1,50 @@
+import logging
+import numpy as np
+
+####
+# Individual-major layout of the sites used for fitting
+# ab_dat is site-major, so the column of one individual is a strided read over the whole matrix.
+# compact_individuals reads the matrix once in blocks of sites and packs the allele balance and depth of the sites
+# every individual is fitted on into contiguous buffers, with the sites of individual i at offsets[i]:offsets[i + 1].
+####
+def compact_individuals(ab_dat, block_size=10000, lower=0.05, upper=0.95):
+    '''
+    Packs the sites passing filters with lower < allele balance < upper of every individual into contiguous buffers, in site order.
+
+    Parameters:
+        ab_dat (np.array): allele balance data returned from get_ind_freqs
+        block_size (int): the number of sites read at once
+        lower (float): sites at or below this allele balance are dropped
+        upper (float): sites at or above this allele balance are dropped
+
+    Returns:
+        allele_balance (np.array): allele balance of the kept sites of all individuals, individual by individual
+        depth (np.array): read depth of the same sites
+        offsets (np.array): the kept sites of individual i are at offsets[i]:offsets[i + 1]
+    '''
+    n_sites, n_tax = ab_dat.shape[1], ab_dat.shape[2]
+    def kept(start):
+        ab = ab_dat[0, start:start + block_size]
+        return(ab, (ab_dat[3, start:start + block_size] == 1) & (ab > lower) & (ab < upper))
+    # First pass counts the kept sites of every individual, the second fills the buffers
+    counts = np.zeros(n_tax, dtype=np.int64)
+    for start in range(0, n_sites, block_size):
+        counts += kept(start)[1].sum(axis=0)
+    offsets = np.zeros(n_tax + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    allele_balance = np.empty(offsets[-1], dtype=ab_dat.dtype)
+    depth = np.empty(offsets[-1], dtype=ab_dat.dtype)
+    cursor = offsets[:-1].copy()
+    for start in range(0, n_sites, block_size):
+        ab, keep = kept(start)
+        # The transposed mask lists the kept sites of the block individual by individual
+        keep = keep.T
+        individual = np.nonzero(keep)[0]
+        block_counts = keep.sum(axis=1)
+        block_starts = np.cumsum(block_counts) - block_counts
+        destination = cursor[individual] + np.arange(len(individual)) - block_starts[individual]
+        allele_balance[destination] = ab.T[keep]
+        depth[destination] = ab_dat[1, start:start + block_size].T[keep]
+        cursor += block_counts
+    logging.info(f'Compacted {offsets[-1]} sites of {n_tax} individuals into {(allele_balance.nbytes + depth.nbytes) / 1024 / 1024:.2f} MB')
+    return(allele_balance, depth, offsets)
@@ -1,8 +1,121 @@
 import numpy as np
-import statsmodels.formula.api as smf
-import pandas as pd
-from scipy.stats import chi2
-from popopolus.fit_mixtures.plot_mixtures import plot_lmm_fit
+from scipy.optimize import minimize_scalar
+from scipy.stats import chi2, norm
+from popopolus.fit_mixtures.render import lmm_plot_payload
+
+####
+# Closed-form random intercept LMM from per-group sufficient statistics
+####
+class RandomInterceptLMMResult:
+    """
+    Results of the NumPy random intercept LMM with the attributes of a statsmodels MixedLMResults used in popopolus.
+    llf is the REML log-likelihood, matching MixedLM.fit() with its default reml=True.
+    """
+    def __init__(self, llf, fe_params, cov_fe, scale, group_var, random_effects, n_obs, group_sizes):
+        import pandas as pd
+        self.llf = llf
+        self.fe_params = fe_params
+        self.cov_fe = cov_fe
+        self.bse_fe = pd.Series(np.sqrt(np.diag(cov_fe)), index=fe_params.index)
+        self.scale = scale
+        self.cov_re = pd.DataFrame([[group_var]], index=['Group'], columns=['Group'])
+        self.random_effects = random_effects
+        self.nobs = n_obs
+        self.group_sizes = group_sizes
+        # Fixed effects, the random intercept variance, and the residual scale
+        self.df_modelwc = len(fe_params) + 1
+
+    def conf_int(self, alpha=0.05):
+        import pandas as pd
+        z = norm.ppf(1 - alpha / 2)
+        return(pd.DataFrame({0: self.fe_params - z * self.bse_fe, 1: self.fe_params + z * self.bse_fe}))
+
+    def summary(self):
+        conf_int = self.conf_int()
+        lines = [
+            'Random Intercept Linear Mixed Model (REML, closed form)',
+            f'No. Observations: {self.nobs}\tNo. Groups: {len(self.group_sizes)}',
+            f'Scale: {self.scale:.4f}\tLog-Likelihood: {self.llf:.4f}',
+            f'Group sizes: min {min(self.group_sizes)}, max {max(self.group_sizes)}',
+            'Coef.\tStd.Err.\t[0.025\t0.975]'
+        ]
+        for name in self.fe_params.index:
+            lines.append(f'{name}\t{self.fe_params[name]:.3f}\t{self.bse_fe[name]:.3f}\t{conf_int.loc[name, 0]:.3f}\t{conf_int.loc[name, 1]:.3f}')
+        lines.append(f'Group Var\t{self.cov_re.iloc[0, 0]:.3f}')
+        return('\n'.join(lines))
+
+def _profile_random_intercept(gamma, XtX, Xty, yty, sizes, sum_x, sum_y, n_obs, reml=True):
+    """
+    Evaluate the profile log-likelihood of a random intercept model at a variance ratio gamma = group variance / residual variance.
+    Every term comes from the per-group sufficient statistics because V_g^-1 = (I - c_g J) / scale with c_g = gamma / (1 + n_g gamma).
+    """
+    n_fe = len(Xty)
+    c = gamma / (1 + sizes * gamma)
+    XtWX = XtX - (sum_x * c[:, np.newaxis]).T @ sum_x
+    XtWy = Xty - (sum_x * c[:, np.newaxis]).T @ sum_y
+    beta = np.linalg.solve(XtWX, XtWy)
+    # Residual quadratic form r'Wr expanded in terms of the sufficient statistics
+    sum_r = sum_y - sum_x @ beta
+    rtr = yty - 2 * beta @ Xty + beta @ XtX @ beta
+    quad = rtr - np.sum(c * sum_r ** 2)
+    m = n_obs - n_fe if reml else n_obs
+    scale = quad / m
+    llf = -0.5 * (m * np.log(2 * np.pi * scale) + np.sum(np.log1p(sizes * gamma)) + m)
+    if reml:
+        llf -= 0.5 * np.linalg.slogdet(XtWX)[1]
+    return(llf, beta, scale, XtWX, c * sum_r)
+
+def fit_random_intercept_lmm(y, x, groups, reml=True):
+    """
+    Fit y ~ x with a random intercept for each group from per-group sufficient statistics.
+    The variance ratio is found by a bounded one-dimensional search on the profile likelihood, so the cost after one pass over the data depends only on the number of groups.
+
+    Parameters:
+        y (np.array): Response, for example alternate allele counts
+        x (np.array): Single covariate, for example reference allele counts
+        groups (np.array): Group label of each observation
+        reml (bool): Use restricted maximum likelihood as statsmodels does by default
+
+    Returns:
+        result (RandomInterceptLMMResult): Log-likelihood, fixed effects, random intercepts, and variance components
+    """
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    group_labels, group_index = np.unique(groups, return_inverse=True)
+    n_obs = len(y)
+    X = np.column_stack([np.ones(n_obs), x])
+    sizes = np.bincount(group_index).astype(np.float64)
+    sum_x = np.column_stack([np.bincount(group_index, weights=X[:, j]) for j in range(X.shape[1])])
+    sum_y = np.bincount(group_index, weights=y)
+    stats = (X.T @ X, X.T @ y, y @ y, sizes, sum_x, sum_y, n_obs, reml)
+    search = minimize_scalar(lambda t: -_profile_random_intercept(np.exp(t), *stats)[0], bounds=(-30, 30), method='bounded')
+    gamma = np.exp(search.x)
+    # The boundary gamma = 0 is not reachable on the log scale
+    if _profile_random_intercept(0.0, *stats)[0] > -search.fun:
+        gamma = 0.0
+    llf, beta, scale, XtWX, blups = _profile_random_intercept(gamma, *stats)
+    import pandas as pd
+    fe_names = ['Intercept', 'ref_counts']
+    random_effects = {label: pd.Series([blups[k]], index=['Group']) for k, label in enumerate(group_labels)}
+    return(RandomInterceptLMMResult(
+        llf = llf,
+        fe_params = pd.Series(beta, index=fe_names),
+        cov_fe = scale * np.linalg.inv(XtWX),
+        scale = scale,
+        group_var = gamma * scale,
+        random_effects = random_effects,
+        n_obs = n_obs,
+        group_sizes = sizes.astype(int).tolist()
+    ))
+
+def ols_loglik(y, x):
+    """
+    Returns the maximum log-likelihood of the ordinary least squares fit of y ~ x.
+    """
+    X = np.column_stack([np.ones(len(y)), x])
+    beta = np.linalg.lstsq(X, y, rcond=None)[0]
+    rss = np.sum((y - X @ beta) ** 2)
+    return(-0.5 * len(y) * (np.log(2 * np.pi * rss / len(y)) + 1))
 
 ####
 # Fit a linear mixed model to ab as a function of depth to assess model fit
@@ -11,7 +124,11 @@ def fit_mixed_model_ab(ind_name: str,
                        allele_balance_data: np.ndarray, 
                       site_depth_data: np.ndarray, 
                       gmm_predictions: np.ndarray,
-                      output_dir: str):
+                      output_dir: str,
+                      engine: str = 'numpy',
+                      renderer = None,
+                      store = None,
+                      quiet: bool = False):
     """
     Fit separate linear mixed models for each individual's allele balance data
     using depth as fixed effect and GMM component assignments as random effects.
@@ -20,6 +137,10 @@ def fit_mixed_model_ab(ind_name: str,
         allele_balance_data: np.array of allele balance values per individual
         site_depth_data: np.array of read depths per individual
         gmm_predictions: np.array of GMM component assignments per individual
+        engine: 'numpy' for the closed-form random intercept model or 'statsmodels' to validate against MixedLM
+        renderer: PlotRenderer that queues the LMM plot for background rendering. None draws it before returning.
+        store: ResultsStore that records the fit and the likelihood ratio test
+        quiet: Do not print the test to stdout
     
     Returns:
         Tuple of (model_result, random_effects, fixed_effects, p_value)
@@ -29,63 +150,81 @@ def fit_mixed_model_ab(ind_name: str,
     #print(alt_count_data)
     ref_count_data = np.array(site_depth_data - alt_count_data)
     #print(ref_count_data)
-    df = pd.DataFrame({
-        'allele_balance': allele_balance_data[:],
-        'depth': site_depth_data[:],
-        'alt_counts': alt_count_data[:],
-        'ref_counts': ref_count_data[:],
-        'site_class': pd.Categorical(gmm_predictions[:])
-    })
-        
-    # Remove any rows with NaN values
-    df = df.dropna()
-                
-    # Fit model for this individual
-    # Random effect is now just component-based
-    model = smf.mixedlm(
-        "alt_counts ~ ref_counts",
-        data=df,
-        groups="site_class",
-        re_formula = "~1"
-    )
-        
-    result = model.fit()
+    if engine == 'numpy':
+        # Remove any rows with NaN values
+        keep = ~(np.isnan(alt_count_data) | np.isnan(ref_count_data))
+        result = fit_random_intercept_lmm(alt_count_data[keep], ref_count_data[keep], np.asarray(gmm_predictions)[keep])
+        null_llf = ols_loglik(alt_count_data[keep], ref_count_data[keep])
+        null_df_model = 1
+    elif engine == 'statsmodels':
+        import pandas as pd
+        import statsmodels.formula.api as smf
+        df = pd.DataFrame({
+            'allele_balance': allele_balance_data[:],
+            'depth': site_depth_data[:],
+            'alt_counts': alt_count_data[:],
+            'ref_counts': ref_count_data[:],
+            'site_class': pd.Categorical(gmm_predictions[:])
+        })
+            
+        # Remove any rows with NaN values
+        df = df.dropna()
+                    
+        # Fit model for this individual
+        # Random effect is now just component-based
+        model = smf.mixedlm(
+            "alt_counts ~ ref_counts",
+            data=df,
+            groups="site_class",
+            re_formula = "~1"
+        )
+            
+        result = model.fit()
+
+        # Test if the group effect is significantly better than no group effect
+        # This is to beat down fitting of noise
+        null_model = smf.ols(
+            "alt_counts ~ ref_counts",
+            data=df
+        )
+        null_result = null_model.fit()
+        null_llf = null_result.llf
+        null_df_model = null_result.df_model
+    else:
+        raise ValueError(f"Unsupported LMM engine {engine}. Use 'numpy' or 'statsmodels'.")
     random_effects = result.random_effects
     fixed_effects = result.fe_params
     #print(type(result))
-    plot_lmm_fit(ind_name, alt_count_data, ref_count_data, gmm_predictions, result, output_dir)
-
-    # Test if the group effect is significantly better than no group effect
-    # This is to beat down fitting of noise
-    null_model = smf.ols(
-        "alt_counts ~ ref_counts",
-        data=df
-    )
-    null_result = null_model.fit()
+    if renderer is None:
+        from popopolus.fit_mixtures.plot_mixtures import plot_lmm_fit
+        plot_lmm_fit(ind_name, alt_count_data, ref_count_data, gmm_predictions, result, output_dir)
+    elif renderer.wants('individual'):
+        renderer.submit(lmm_plot_payload(ind_name, alt_count_data, ref_count_data, gmm_predictions, result))
     
-    print(f"Full Model Log-Likelihood: {result.llf}")
-    print(f"Restricted Model Log-Likelihood: {null_result.llf}")
-    
-    lrt_statistic = -2 * (null_result.llf - result.llf)
+    lrt_statistic = -2 * (null_llf - result.llf)
 
     # Calculate degrees of freedom (difference in number of parameters)
     # This requires knowing how many parameters differ between the two models
-    degrees_of_freedom = result.df_modelwc - null_result.df_model
+    degrees_of_freedom = result.df_modelwc - null_df_model
 
     # Calculate p-value
     p_value = chi2.sf(lrt_statistic, degrees_of_freedom)
+    if store is not None:
+        store.add_lmm(ind_name, result, null_llf, lrt_statistic, degrees_of_freedom, p_value)
 
-    print(f"\nLR Statistic: {lrt_statistic}")
-    print(f"P-value: {p_value}")
-    print(f"Degrees of Freedom: {degrees_of_freedom}")
+    if not quiet:
+        print(f"Full Model Log-Likelihood: {result.llf}")
+        print(f"Restricted Model Log-Likelihood: {null_llf}")
+        print(f"\nLR Statistic: {lrt_statistic}")
+        print(f"P-value: {p_value}")
+        print(f"Degrees of Freedom: {degrees_of_freedom}")
 
-    # Interpret the results
-    alpha = 0.05
-    if p_value < alpha:
-        print("\nReject the null hypothesis. The full model is a significantly better fit.")
-    else:
-        print("\nFail to reject the null hypothesis. The restricted model is sufficient.")
+        # Interpret the results
+        alpha = 0.05
+        if p_value < alpha:
+            print("\nReject the null hypothesis. The full model is a significantly better fit.")
+        else:
+            print("\nFail to reject the null hypothesis. The restricted model is sufficient.")
 
     
-    return(result, random_effects, fixed_effects, p_value)
-
+    return(result, random_effects, fixed_effects, p_value)
\ No newline at end of file
@@ -0,0 +1,374 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from popopolus.utils import open_vcf, check_individuals
+from popopolus.calculate_frequencies.vcf_blocks import vcf_sample_name, parse_ind_block
+from popopolus.calculate_frequencies.calculate_frequencies import write_ind_freqs
+from popopolus.fit_mixtures.fit_mixtures import fit_individual, open_results, check_gmm_options
+from popopolus.fit_mixtures.gmm2 import MIXTURE_MODELS
+from popopolus.fit_mixtures.cache import FitCache
+from popopolus.fit_mixtures.render import PlotRenderer, summary_plot_payload
+from popopolus.fit_mixtures.results import ResultsStore
+from popopolus.checkpoint import IndividualCheckpoints
+from popopolus.shared import SharedArray, attach
+
+####
+# Pipelined estimate_ploidy
+# A reader thread passes raw blocks of VCF lines through a bounded queue to parser workers while it reads the next blocks.
+# Once every site is parsed the individuals go to fitting workers, and a writer thread writes the allele frequency files,
+# ploidy.txt, the database rows, and the plot payloads of finished individuals while later individuals are fitted.
+# An individual needs all of its sites before it can be fitted, so reading overlaps parsing and fitting overlaps writing.
+# Every queue holds at most queue_depth items, which bounds the memory held between stages.
+# With several fitting workers the parsed arrays are placed in shared memory and a task is the index of an individual.
+####
+class StageStats:
+    '''
+    Busy time of the workers of one pipeline stage.
+
+    Parameters:
+        name (string): the stage
+        n_workers (int): the number of workers of the stage
+    '''
+    def __init__(self, name, n_workers=1):
+        self.name = name
+        self.n_workers = n_workers
+        self.busy = 0.0
+        self.items = 0
+
+    def add(self, seconds, items=1):
+        self.busy += seconds
+        self.items += items
+
+    def utilisation(self, wall):
+        '''
+        Returns the fraction of wall seconds the workers of the stage were busy.
+        '''
+        return(self.busy / (wall * self.n_workers) if wall > 0 else 0.0)
+
+    def report(self, wall):
+        return(f'{self.name}: {self.items} items, {self.busy:.2f} s busy on {self.n_workers} workers, {100 * self.utilisation(wall):.1f}% utilised')
+
+class _PayloadRecorder(PlotRenderer):
+    '''Keeps the plot payloads of a fitting worker so the writer thread hands them to the real renderer'''
+    def __init__(self, mode):
+        self.mode = mode
+        self.payloads = []
+
+    def submit(self, payload):
+        self.payloads.append(payload)
+
+    def close(self):
+        pass
+
+class _RowRecorder(ResultsStore):
+    '''Keeps the database rows of a fitting worker so the writer thread adds them to the real store'''
+    def __init__(self):
+        self.run_id = None
+        self.rows = []
+
+    def _add(self, table, row):
+        self.rows.append((table, row))
+
+    def flush(self):
+        pass
+
+def _put(item_queue, item, stop):
+    '''Puts an item on a bounded queue unless the pipeline is stopped while waiting for space. Returns whether it was put.'''
+    while not stop.is_set():
+        try:
+            item_queue.put(item, timeout=0.1)
+            return(True)
+        except queue.Full:
+            continue
+    return(False)
+
+def _bounded_map(function, arguments, n_workers, depth):
+    '''
+    Yields function(*args) for every tuple of arguments in order.
+    With more than one worker the calls run in a process pool with at most depth calls submitted ahead of the result being yielded.
+    '''
+    if n_workers <= 1:
+        for args in arguments:
+            yield(function(*args))
+        return
+    with ProcessPoolExecutor(max_workers = n_workers) as executor:
+        pending = deque()
+        for args in arguments:
+            pending.append(executor.submit(function, *args))
+            if len(pending) >= max(depth, n_workers):
+                yield(pending.popleft().result())
+        while pending:
+            yield(pending.popleft().result())
+
+def _read_stage(vcf_file, lines_per_block, raw_queue, stats, stop, errors):
+    '''Reader thread: puts the sample columns of the #CHROM line and then blocks of data lines on raw_queue, and None at the end'''
+    try:
+        block = []
+        header = False
+        with open_vcf(vcf_file) as fh:
+            start = time.perf_counter()
+            for line in fh:
+                if line.startswith('#'):
+                    if line.startswith('#CHROM'):
+                        header = True
+                        if not _put(raw_queue, line.split()[9:], stop):
+                            return
+                    continue
+                if not header:
+                    raise ValueError(f'No #CHROM header line found before the first site of {vcf_file}')
+                block.append(line)
+                if len(block) == lines_per_block:
+                    stats.add(time.perf_counter() - start)
+                    if not _put(raw_queue, block, stop):
+                        return
+                    block = []
+                    start = time.perf_counter()
+            stats.add(time.perf_counter() - start, 1 if block else 0)
+        if block and not _put(raw_queue, block, stop):
+            return
+    except BaseException as error:
+        errors.append(error)
+    _put(raw_queue, None, stop)
+
+def _parse_arguments(raw_queue, tax_list, ind_map, pate_flag, min_depth, min_count, min_qual):
+    '''Turns the items of raw_queue into parser arguments. The sample columns that come first set the individuals read.'''
+    columns = None
+    while True:
+        item = raw_queue.get()
+        if item is None:
+            return
+        if columns is None:
+            sample_names = [vcf_sample_name(column, pate_flag) for column in item]
+            columns = np.array([i for i, name in enumerate(sample_names) if name in ind_map], dtype=np.int64)
+            tax_list.extend(sample_names[i] for i in columns)
+            continue
+        yield((item, columns, pate_flag, min_depth, min_count, min_qual))
+
+def _parse_worker(lines, columns, pate_flag, min_depth, min_count, min_qual):
+    '''Parser worker: the allele balance arrays of the filter-passing lines of a block and the seconds spent'''
+    start = time.perf_counter()
+    records = []
+    for line in lines:
+        temp = line.split()
+        if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')):
+            records.append(temp)
+    return(parse_ind_block(records, columns, min_depth, min_count, min_qual), time.perf_counter() - start)
+
+def _fit_arguments(tax_list, ab_dat, n_sites, completed, settings, plots, record_rows, cache_dir, cache_size, quiet):
+    '''Fitting worker arguments of the unfinished individuals'''
+    for i, ind_name in enumerate(tax_list):
+        if ind_name not in completed:
+            yield((i, ind_name, ab_dat, n_sites, settings, plots, record_rows, cache_dir, cache_size, quiet))
+
+def _fit_worker(ind_index, ind_name, ab_dat, n_sites, settings, plots, record_rows, cache_dir, cache_size, quiet):
+    '''
+    Fitting worker: the record, plot payloads, and database rows of one individual and the seconds spent.
+    ab_dat is the array itself or the handle of a SharedArray holding it, of which the first n_sites sites are filled.
+    '''
+    start = time.perf_counter()
+    if isinstance(ab_dat, tuple):
+        ab_dat = attach(ab_dat)[:, :n_sites]
+    renderer = _PayloadRecorder(plots)
+    store = _RowRecorder() if record_rows else None
+    cache = FitCache(cache_dir, cache_size) if cache_dir is not None else None
+    record = fit_individual(ind_name, ab_dat[0, :, ind_index], ab_dat[1, :, ind_index], ab_dat[3, :, ind_index] == 1, settings, None, cache, renderer, store, quiet)
+    return(ind_name, record, renderer.payloads, store.rows if store is not None else [], False, time.perf_counter() - start)
+
+def _write_stage(write_queue, outfile, store, renderer, checkpoints, ploidy_dict, site_counts, freqs, stats, stop, errors):
+    '''Writer thread: writes the allele frequency files and then the results of every individual taken from write_queue until None'''
+    try:
+        if freqs is not None:
+            start = time.perf_counter()
+            write_ind_freqs(*freqs)
+            stats.add(time.perf_counter() - start)
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            start = time.perf_counter()
+            ind_name, record, payloads, rows, resumed, _ = item
+            ploidy_dict[ind_name] = record['ploidy']
+            if record['line'] is not None:
+                outfile.write(record['line'])
+                site_counts[ind_name] = record['n_sites']
+            if not resumed:
+                for payload in payloads:
+                    renderer.submit(payload)
+                if store is not None:
+                    for table, row in rows:
+                        store._add(table, row)
+                    store.add_call(ind_name, record['ploidy'], record['n_sites'], record['p_value'], record['bootstrap'])
+                if checkpoints is not None:
+                    # Results of a checkpointed individual must be in the database before its record says it is done
+                    if store is not None:
+                        store.flush()
+                    checkpoints.write(ind_name, {'ploidy': record['ploidy'], 'n_sites': record['n_sites'], 'line': record['line']})
+            stats.add(time.perf_counter() - start)
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+
+def _grow_sites(ab_dat, n_sites, n_needed, n_tax, use_shared, shared_dir):
+    '''
+    Returns a new ab_dat with room for at least n_needed sites, at least doubling the capacity and keeping the first n_sites,
+    and the SharedArray holding it if use_shared, or None.
+    '''
+    capacity = max(n_needed, 2 * (ab_dat.shape[1] if ab_dat is not None else 0))
+    grown_shared = None
+    if use_shared:
+        grown_shared = SharedArray.create((4, capacity, n_tax), np.float32, shared_dir)
+        grown = grown_shared.array
+    else:
+        grown = np.empty((4, capacity, n_tax), dtype=np.float32)
+    if ab_dat is not None:
+        grown[:, :n_sites] = ab_dat[:, :n_sites]
+    return(grown, grown_shared)
+
+def est_ploidy_pipeline(ind_map, vcf_file, min_depth, min_count, min_qual, pate_flag, method, ploidy_levels, minimum_sites, model_constraints, output_dir, precision='float64', selection='full', prescreen=False, lmm_engine='numpy', n_bootstrap=0, block_size=100, cache_dir=None, cache_size=1024 ** 3, plots='all', dpi=300, results_db=None, quiet=False, checkpoint_dir=None, resume=False, parse_jobs=1, fit_jobs=1, lines_per_block=10000, queue_depth=4, shared_dir=None):
+    """
+    Reads a VCF and estimates the ploidy of every individual as get_ind_freqs followed by est_ploidy does, with the stages overlapped.
+    Writes the same allele frequency files, ploidy.txt, plots, database rows, and checkpoints, and logs the utilisation of every stage.
+
+    Parameters:
+        ind_map (dict): A dictionary mapping individuals in the VCF to their sample sheet row
+        vcf_file (str): A multisample VCF file uncompressed, or '-' for standard input
+        min_depth (int): The minimum depth of a site to be considered high-quality
+        min_count (int): The minimum number of reads supporting the alternate allele. Also truncates the beta-binomial components.
+        min_qual (int): The minimum phred-scaled genotype quality
+        pate_flag (bool): Is the VCF a direct product of the PATE pipeline
+        method ... resume: As for est_ploidy. Bootstrap replicates and EM restarts of an individual run in its fitting worker.
+        parse_jobs (int): The number of parser processes
+        fit_jobs (int): The number of fitting processes
+        lines_per_block (int): The number of VCF lines the reader passes to a parser at once
+        queue_depth (int): The most blocks or individuals waiting between two stages
+        shared_dir (str): Directory for a memory-mapped file that shares the arrays with several fitting workers. None uses shared memory.
+
+    Returns:
+        ploidy_df: DataFrame containing estimated ploidy for each individual.
+        stats (dict): StageStats of the read, parse, fit, and write stages
+    """
+    if (method not in ['gmm', 'betabinom']) and (method not in MIXTURE_MODELS):
+        logging.error('Terminated due to unavailable estimation method!\n')
+        raise ValueError("Unsupported method. Use 'gmm', 'normal', 'gamma', 'lognormal', or 'betabinom'.")
+    check_gmm_options(method, precision, selection, cache_dir)
+    wall_start = time.perf_counter()
+    stats = {
+        'read': StageStats('read', 1), 'parse': StageStats('parse', parse_jobs),
+        'fit': StageStats('fit', fit_jobs), 'write': StageStats('write', 1)
+    }
+    stop = threading.Event()
+    errors = []
+
+    #### Read and parse
+    raw_queue = queue.Queue(maxsize = queue_depth)
+    reader = threading.Thread(target = _read_stage, args = (vcf_file, lines_per_block, raw_queue, stats['read'], stop, errors), daemon = True)
+    reader.start()
+    tax_list = []
+    # Parsed blocks are copied into ab_dat as they arrive, so no parsed block waits outside the bounded queues.
+    # Fitting workers attach a shared ab_dat by name instead of receiving pickled columns of every individual.
+    ab_dat = None
+    shared = None
+    n_sites = 0
+    try:
+        arguments = _parse_arguments(raw_queue, tax_list, ind_map, pate_flag, min_depth, min_count, min_qual)
+        for block, seconds in _bounded_map(_parse_worker, arguments, parse_jobs, queue_depth):
+            stats['parse'].add(seconds)
+            n_block = len(block[0])
+            if (ab_dat is None) or (n_sites + n_block > ab_dat.shape[1]):
+                grown, grown_shared = _grow_sites(ab_dat, n_sites, n_sites + n_block, len(tax_list), fit_jobs > 1, shared_dir)
+                if shared is not None:
+                    # Views of a shared array must be released before it is removed
+                    ab_dat = None
+                    shared.unlink()
+                ab_dat, shared = grown, grown_shared
+            for k in range(4):
+                ab_dat[k, n_sites:n_sites + n_block] = block[k]
+            n_sites += n_block
+    except BaseException:
+        stop.set()
+        if shared is not None:
+            ab_dat = None
+            shared.unlink()
+        raise
+    reader.join()
+    if errors:
+        if shared is not None:
+            ab_dat = None
+            shared.unlink()
+        raise errors[0]
+    check_individuals(ind_map, tax_list)
+    n_tax = len(tax_list)
+    if ab_dat is None:
+        ab_dat = np.empty((4, 0, n_tax), dtype=np.float32)
+    # Sites beyond n_sites are unused capacity of the grown array
+    ab_dat = ab_dat[:, :n_sites]
+    logging.info(f'Parsed {ab_dat.shape[1]} sites of {n_tax} individuals from {vcf_file} in {stats["parse"].items} blocks')
+
+    #### Fit and write
+    ploidy = [int(p) for p in ploidy_levels.split(',')]
+    logging.info(f'Testing for ploidy with the following values:\n{ploidy}\n')
+    run_settings = {
+        'individuals': n_tax, 'sites': ab_dat.shape[1], 'method': method, 'ploidy_levels': ploidy, 'minimum_sites': minimum_sites,
+        'model_constraints': model_constraints, 'output_dir': output_dir, 'precision': precision, 'selection': selection,
+        'prescreen': prescreen, 'lmm_engine': lmm_engine, 'n_bootstrap': n_bootstrap, 'block_size': block_size, 'minimum_count': min_count
+    }
+    checkpoints = None
+    completed = {}
+    if checkpoint_dir is not None:
+        checkpoints = IndividualCheckpoints(checkpoint_dir, {**run_settings, 'tax_list': list(tax_list)}, resume)
+        if resume:
+            completed = checkpoints.completed()
+            logging.info(f'Resuming from {checkpoint_dir}: {len(completed)} of {n_tax} individuals already finished')
+    store = None
+    if results_db is not None:
+        store = open_results(results_db, run_settings, checkpoints, completed if resume else None)
+    ploidy_dict = {}
+    site_counts = {}
+    outfile = open(f'{output_dir}/ploidy.txt', 'w')
+    renderer = PlotRenderer(output_dir, plots, dpi, n_workers = max(1, fit_jobs // 2))
+    write_queue = queue.Queue(maxsize = queue_depth)
+    writer = threading.Thread(target = _write_stage, daemon = True, args = (write_queue, outfile, store, renderer, checkpoints,
+                              ploidy_dict, site_counts, (tax_list, ab_dat, output_dir), stats['write'], stop, errors))
+    writer.start()
+    try:
+        arguments = _fit_arguments(tax_list, ab_dat if shared is None else shared.handle, n_sites, completed, run_settings, plots, store is not None, cache_dir, cache_size, quiet)
+        results = _bounded_map(_fit_worker, arguments, fit_jobs, queue_depth)
+        for ind_name in tax_list:
+            if ind_name in completed:
+                item = (ind_name, completed[ind_name], [], [], True, 0.0)
+            else:
+                item = next(results)
+                stats['fit'].add(item[-1])
+            if not _put(write_queue, item, stop):
+                break
+        results.close()
+    finally:
+        _put(write_queue, None, stop)
+        writer.join()
+        outfile.close()
+        if shared is not None:
+            ab_dat = None
+            shared.unlink()
+    if errors:
+        renderer.close()
+        raise errors[0]
+    if renderer.wants('summary'):
+        renderer.submit(summary_plot_payload(ploidy_dict, site_counts))
+    renderer.close()
+    if store is not None:
+        store.finish_run()
+        store.close()
+
+    wall = time.perf_counter() - wall_start
+    logging.info(f'Pipeline finished in {wall:.2f} s with queues of {queue_depth}')
+    for stage in stats.values():
+        logging.info(stage.report(wall))
+    import pandas as pd
+    ploidy_df = pd.DataFrame.from_dict(ploidy_dict, orient = 'index')
+    ploidy_df.reset_index(inplace=True)
+    ploidy_df.columns = ['Individual','Ploidy']
+    return(ploidy_df, stats)
@@ -1,106 +1,79 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.stats import norm
-import pandas as pd
 import seaborn as sns
 import logging
+from popopolus.fit_mixtures.render import gmm_plot_payload, mixture_plot_payload, betabinom_plot_payload, lmm_plot_payload
 
-def plot_gmm_fit_sklearn(data, gmm, output_dir, plot_name="result.fit.png", n_points=1000, title="GMM Fit to Data"):
+def render_plot(payload, output_dir, dpi=300):
     """
-    Plot histogram of observed data with fitted GMM components from sklearn.
-    
+    Draw a plot payload from popopolus.fit_mixtures.render and save it to {output_dir}/{plot_name}.png.
+
     Parameters:
-        data (np.array): Original data used to fit the GMM
-        gmm (GaussianMixtureModel): Fitted GMM model wrapper class
-        n_points (int): Number of points for plotting the GMM curves
-        title (str): Plot title
+        payload (dict): Plot data with a kind of 'mixture', 'lmm', or 'summary'
+        output_dir (str): Directory to save plot
+        dpi (int): Resolution of the PNG file
     """
-    # Create figure
+    renderers = {'mixture': _render_mixture, 'lmm': _render_lmm, 'summary': _render_summary}
+    if payload['kind'] not in renderers:
+        raise ValueError(f"Unknown plot kind {payload['kind']}")
+    renderers[payload['kind']](payload, output_dir, dpi)
+
+def _render_mixture(payload, output_dir, dpi):
+    """Histogram of observed data with the fitted mixture components and their sum"""
     plt.figure(figsize=(10, 6))
-    
-    # Plot histogram of observed data
-    plt.hist(data, bins=50, density=True, alpha=0.5, label='Observed Data')
-    
-    # Generate points for plotting the GMM components
-    x = np.linspace(min(data), max(data), n_points).reshape(-1, 1)
-    
-    # Plot individual components
-    for i in range(gmm.n_components):
-        # Get parameters for this component
-        mu = gmm.means_[i][0]
-        sigma = np.sqrt(gmm.covariances_[i][0][0])
-        weight = gmm.weights_[i]
-        
-        # Calculate component distribution
-        component = weight * norm.pdf(x, mu, sigma)
-        plt.plot(x, component, '--', label=f'Component {i+1}')
-    
-    # Plot total mixture
-    log_prob = gmm.score_samples(x)
-    total = np.exp(log_prob)
-    plt.plot(x, total, 'r-', label='Total Mixture', linewidth=2)
-    
+    histogram = payload['histogram']
+    edges = histogram['edges']
+    plt.bar(edges[:-1], histogram['counts'], width=np.diff(edges), align='edge', alpha=0.5, label='Observed Data')
+    x = payload['x']
+    component_pdf = payload['component_pdf']
+    for i in range(component_pdf.shape[1]):
+        plt.plot(x, component_pdf[:, i], '--', label=f'Component {i+1}')
+    plt.plot(x, component_pdf.sum(axis=1), 'r-', label='Total Mixture', linewidth=2)
     plt.xlabel('Allele Balance')
     plt.ylabel('Density')
-    plt.title(title)
+    plt.title(payload['title'])
     plt.legend()
     plt.grid(True, alpha=0.3)
-    plt.savefig(f'{output_dir}/{plot_name}.png', dpi=300)
+    plt.savefig(f"{output_dir}/{payload['plot_name']}.png", dpi=dpi)
     plt.close('all')
 
-
-def plot_lmm_fit(ind_name, alt_count_data, ref_count_data, site_class, lmm_result, output_dir):
+def plot_gmm_fit_sklearn(data, gmm, output_dir, plot_name="result.fit.png", n_points=1000, title="GMM Fit to Data", dpi=300):
     """
-    Create scatter plot of allele balance vs depth, colored by GMM component,
-    with fitted LMM regression lines and confidence intervals.
+    Plot histogram of observed data with fitted GMM components from sklearn.
     
     Parameters:
-        ind_name: Name of individual for plot title
-        alt_count_data: Array of counts for alternate allele
-        ref_count_data: Array of counts for reference allele
-        site_class: Array of GMM component assignments
-        lmm_result: Fitted statsmodels MixedLM object
-        output_dir: Directory to save plot
+        data (np.array): Original data used to fit the GMM
+        gmm (GaussianMixtureModel): Fitted GMM model wrapper class
+        n_points (int): Number of points for plotting the GMM curves
+        title (str): Plot title
+        dpi (int): Resolution of the PNG file
     """
-    print(f'Creating lmm figure for {ind_name} in {output_dir}')
-    # Create figure
-    plt.figure(figsize=(12, 6))
-    
-    # Create DataFrame for plotting
-    plot_df = pd.DataFrame({
-        'Alt Counts': alt_count_data,
-        'Ref Counts': ref_count_data,
-        'Component': [f'Component {x}' for x in site_class]})
-    print(plot_df.head())
+    render_plot(gmm_plot_payload(data, gmm, plot_name, title, n_points), output_dir, dpi)
 
-    # Get unique components in sorted order
-    unique_components = sorted(plot_df['Component'].unique())
-    n_colors = len(unique_components)
 
-    # Create color palette with explicit ordering
-    sns_colors = sns.color_palette('tab10', n_colors)
-    component_colors = dict(zip(unique_components, sns_colors))
+def _render_lmm(payload, output_dir, dpi):
+    """Scatter plot of alternate against reference counts by component with the LMM fixed effect, its CI, and group lines"""
+    plt.figure(figsize=(12, 6))
 
-    # Create base scatter plot
-    sns.scatterplot(data=plot_df, 
-                    x='Alt Counts', 
-                    y='Ref Counts',
-                    hue='Component',
-                    hue_order=unique_components,
-                    palette=component_colors,
-                    alpha=0.5)
+    # One rasterized scatter per component code keeps the cost to the number of points drawn
+    components = [f'Component {c}' for c in payload['components']]
+    sns_colors = sns.color_palette('tab10', len(components))
+    component_colors = dict(zip(components, sns_colors))
+    codes = payload['codes']
+    for i, component in enumerate(components):
+        in_component = codes == i
+        plt.scatter(payload['alt'][in_component], payload['ref'][in_component],
+                    s=12, color=component_colors[component], alpha=0.5, linewidths=0,
+                    label=component, rasterized=True)
     
     # Generate prediction lines
-    ref_count_range = np.linspace(ref_count_data.min(), ref_count_data.max(), 100)
-    
-    # Get fixed effect coefficients
-    intercept = lmm_result.fe_params['Intercept']
-    ref_count_effect = lmm_result.fe_params['ref_counts']
+    ref_count_range = np.linspace(payload['ref'].min(), payload['ref'].max(), 100)
     
-    # Calculate confidence intervals
-    conf_int = lmm_result.conf_int()
-    lower_intercept, upper_intercept = conf_int.loc['Intercept']
-    lower_ref_count, upper_ref_count = conf_int.loc['ref_counts']
+    # Fixed effect coefficients and their confidence intervals
+    intercept = payload['intercept']
+    ref_count_effect = payload['slope']
+    lower_intercept, upper_intercept = payload['intercept_ci']
+    lower_ref_count, upper_ref_count = payload['slope_ci']
     
     # Plot overall fixed effect line
     plt.plot(ref_count_range, 
@@ -113,48 +86,86 @@ def plot_lmm_fit(ind_name, alt_count_data, ref_count_data, site_class, lmm_resul
                     upper_intercept + upper_ref_count * ref_count_range,
                     color='gray', alpha=0.2, label='95% CI')
     
-    # Plot group-specific prediction lines
-    #print(lmm_result.random_effects)
-    if len(lmm_result.random_effects) > 1:
-        # Color map is now created up above to ensure correct ordering of components by seaborn
-        #n_colors = len(lmm_result.random_effects)
-        #color_map = dict(zip(
-        #    lmm_result.random_effects.keys(),
-        #    sns_colors
-        #))
-        
-        # Plot each group's prediction line
-        for group, effect in lmm_result.random_effects.items():
-            # Get random effect for this group
-            #print(f'Successfull accessed random intercept for group {group}')
-            #print(group)
-            #print(effect)
-            group_effect = effect.iloc[0]  # First value is the random intercept
-                
-            # Calculate group-specific prediction
-            group_prediction = (intercept - group_effect) + ref_count_effect * ref_count_range
-            #print(f'Group prediction is {group_prediction}')
-            # Plot with color from map
-            component_key = f'Component {group}'
-            plt.plot(ref_count_range, group_prediction,
-                    '--', color=component_colors[component_key], alpha=0.8,
-                    label=f'{component_key} Prediction',
-                    linewidth=1.5)
+    # Plot each group's prediction line with its random intercept
+    for group, group_effect in payload['group_effects'].items():
+        group_prediction = (intercept - group_effect) + ref_count_effect * ref_count_range
+        component_key = f'Component {group}'
+        plt.plot(ref_count_range, group_prediction,
+                '--', color=component_colors[component_key], alpha=0.8,
+                label=f'{component_key} Prediction',
+                linewidth=1.5)
     
     # Adjust legend to show both points and lines
     handles, labels = plt.gca().get_legend_handles_labels()
     plt.xlabel('Reference Allele Count')
     plt.ylabel('Alternate Allele Count')
-    plt.title(f'Ref Vs. Alt Counts - {ind_name}')
+    plt.title(payload['title'])
     plt.legend(handles, labels, 
               bbox_to_anchor=(1.05, 1),
               loc='upper left',
               title='Components')
     
-    output_file = f'{output_dir}/{ind_name}.lmm.png'
+    output_file = f"{output_dir}/{payload['plot_name']}.png"
     plt.savefig(output_file, 
-                dpi=300, 
+                dpi=dpi, 
                 bbox_inches='tight',  # This ensures the legend is included
                 pad_inches=0.5)      # Add padding around the plot
     plt.close('all')
-    logging.info("Scatterplot of ref versus alt counts saved successfully")
\ No newline at end of file
+    logging.info("Scatterplot of ref versus alt counts saved successfully")
+
+def plot_lmm_fit(ind_name, alt_count_data, ref_count_data, site_class, lmm_result, output_dir, dpi=300):
+    """
+    Create scatter plot of allele balance vs depth, colored by GMM component,
+    with fitted LMM regression lines and confidence intervals.
+    
+    Parameters:
+        ind_name: Name of individual for plot title
+        alt_count_data: Array of counts for alternate allele
+        ref_count_data: Array of counts for reference allele
+        site_class: Array of GMM component assignments
+        lmm_result: Fitted statsmodels MixedLM object
+        output_dir: Directory to save plot
+        dpi: Resolution of the PNG file
+    """
+    render_plot(lmm_plot_payload(ind_name, alt_count_data, ref_count_data, site_class, lmm_result), output_dir, dpi)
+
+def plot_mixture_fit(data, model, output_dir, plot_name="result.fit.png", n_points=1000, title="Mixture Fit to Data", dpi=300):
+    """
+    Plot histogram of observed data with fitted components from a gmm2 mixture model.
+
+    Parameters:
+        data (np.array): Original data used to fit the mixture
+        model (MixtureModel): Fitted normal, gamma, or lognormal mixture
+        n_points (int): Number of points for plotting the mixture curves
+        title (str): Plot title
+        dpi (int): Resolution of the PNG file
+    """
+    render_plot(mixture_plot_payload(data, model, plot_name, title, n_points), output_dir, dpi)
+
+def plot_betabinom_fit(counts, model, output_dir, plot_name="result.fit.png", title="Beta-binomial Mixture Fit to Data", dpi=300):
+    """
+    Plot histogram of observed allele balance with fitted components from a beta-binomial mixture.
+
+    Parameters:
+        counts (np.array): Alternate allele counts (column 0) and read depths (column 1) the mixture was fitted to
+        model (BetaBinomialMixture): Fitted beta-binomial mixture
+        title (str): Plot title
+        dpi (int): Resolution of the PNG file
+    """
+    render_plot(betabinom_plot_payload(counts, model, plot_name, title), output_dir, dpi)
+
+def _render_summary(payload, output_dir, dpi):
+    """Number of individuals called at each ploidy and the sites each call rests on"""
+    fig, (count_ax, site_ax) = plt.subplots(1, 2, figsize=(12, 5))
+    levels, counts = np.unique(payload['ploidy'], return_counts=True)
+    count_ax.bar(levels, counts, color='steelblue')
+    count_ax.set_xticks(levels)
+    count_ax.set_xlabel('Ploidy')
+    count_ax.set_ylabel('Individuals')
+    site_ax.scatter(payload['ploidy'], payload['n_sites'], alpha=0.5)
+    site_ax.set_xticks(levels)
+    site_ax.set_xlabel('Ploidy')
+    site_ax.set_ylabel('Sites Fitted')
+    fig.suptitle(payload['title'])
+    fig.savefig(f"{output_dir}/{payload['plot_name']}.png", dpi=dpi, bbox_inches='tight')
+    plt.close('all')
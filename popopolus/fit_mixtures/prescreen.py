@@ -0,0 +1,100 @@
+import numpy as np
+import logging
+from scipy.signal import find_peaks
+from popopolus.fit_mixtures.gmm import get_fixed_params
+
+####
+# Cheap histogram pre-screen to skip ploidies that cannot explain the allele balance peaks
+####
+def smooth_ab_density(dat, n_bins=200, bandwidth=0.03):
+    """
+    Returns a kernel-smoothed density of allele balance on a regular grid between zero and one.
+    The density is a binned Gaussian KDE: a fine histogram convolved with a Gaussian kernel.
+
+    Parameters:
+        dat (np.array): Allele balance data for one individual
+        n_bins (int): The number of grid points between zero and one
+        bandwidth (float): The kernel standard deviation. It should be wide enough to hide the lattice of allele balance values at low depth.
+
+    Returns:
+        centers (np.array): The grid of allele balance values
+        density (np.array): The smoothed density at each grid value
+    """
+    counts, edges = np.histogram(np.ravel(dat), bins=n_bins, range=(0.0, 1.0))
+    centers = (edges[:-1] + edges[1:]) / 2
+    sigma = bandwidth * n_bins
+    radius = int(np.ceil(4 * sigma))
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    kernel /= kernel.sum()
+    density = np.convolve(counts, kernel, mode='same') * n_bins / max(counts.sum(), 1)
+    return(centers, density)
+
+def find_ab_peaks(centers, density, min_height=0.2, min_prominence=0.1):
+    """
+    Returns the allele balance values of the peaks of a smoothed density.
+
+    Parameters:
+        centers (np.array): The grid of allele balance values
+        density (np.array): The smoothed density at each grid value
+        min_height (float): Peaks lower than this fraction of the highest peak are ignored
+        min_prominence (float): Peaks that rise less than this fraction of the highest peak above their surrounding valleys are ignored
+
+    Returns:
+        peaks (np.array): Allele balance values of the peaks
+    """
+    peak_index, _ = find_peaks(density, height=min_height * density.max(), prominence=min_prominence * density.max())
+    return(centers[peak_index])
+
+def prescreen_ploidy(ind_name, dat, ploidy, depth=None, tolerance=0.075, merge_distance=0.2, min_support=0.05, min_sites=1000):
+    """
+    Drop candidate ploidies that are incompatible with the peaks of the allele balance density.
+    A ploidy is skipped if an observed peak is further than tolerance from all of its expected allele balances,
+    or if the density at one of its expected allele balances is below min_support of the highest peak, which would leave that component empty.
+    Components closer than merge_distance blur into a single peak between them at moderate depth,
+    so a peak lying between two such components is treated as explained.
+    At low depth allele balance only takes a few values, so when depth is given each value is spread
+    uniformly over its 1/depth cell before smoothing to keep that lattice from producing spurious peaks.
+    If every candidate would be skipped, all are kept.
+
+    Parameters:
+        ind_name (string): The name of the individual
+        dat (np.array): Filtered and truncated allele balance data for one individual
+        ploidy (list): The ploidies to test
+        depth (np.array): Read depth of each site, used to remove the lattice of low-depth allele balance values
+        tolerance (float): The largest distance between a peak and an expected allele balance that still explains it
+        merge_distance (float): Adjacent expected allele balances at most this far apart can explain any peak between them
+        min_support (float): The smallest relative density at an expected allele balance
+        min_sites (int): Individuals with fewer sites are not pre-screened because their histograms are too noisy
+
+    Returns:
+        plausible (list): The ploidies worth fitting, in their original order
+    """
+    if len(dat) < min_sites:
+        logging.info(f'Individual {ind_name}: too few sites for the pre-screen. Fitting all candidates.')
+        return(list(ploidy))
+    dat = np.ravel(dat)
+    if depth is not None:
+        dither = np.random.default_rng(0).uniform(-0.5, 0.5, len(dat))
+        dat = dat + dither / np.maximum(np.ravel(depth), 1)
+    centers, density = smooth_ab_density(dat)
+    peaks = find_ab_peaks(centers, density)
+    logging.info(f'Individual {ind_name}: allele balance peaks at {np.round(peaks, 3)}')
+    plausible = []
+    for p in ploidy:
+        expected, _ = get_fixed_params(p - 1)
+        expected = expected.ravel()
+        distance = np.abs(peaks[:, np.newaxis] - expected[np.newaxis, :]).min(axis=1)
+        right = np.clip(np.searchsorted(expected, peaks), 1, len(expected) - 1)
+        merged = (peaks >= expected[right - 1]) & (peaks <= expected[right]) & (expected[right] - expected[right - 1] <= merge_distance)
+        distance[merged] = 0
+        support = np.interp(expected, centers, density) / density.max()
+        if np.any(distance > tolerance):
+            logging.info(f'Individual {ind_name}: ploidy {p} skipped by pre-screen. Peak at {peaks[np.argmax(distance)]:.3f} is not near any expected allele balance {np.round(expected, 3)}')
+        elif np.any(support < min_support):
+            logging.info(f'Individual {ind_name}: ploidy {p} skipped by pre-screen. No density near expected allele balance {expected[np.argmin(support)]:.3f}')
+        else:
+            plausible.append(p)
+    if len(plausible) == 0:
+        logging.warning(f'Individual {ind_name}: no ploidy is compatible with the allele balance peaks. Fitting all candidates.')
+        plausible = list(ploidy)
+    return(plausible)
@@ -0,0 +1,212 @@
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from scipy.stats import norm
+
+####
+# Plot payloads and the background render pool
+# Fitting code reduces every figure to a small dictionary of plot data (histogram counts, curves evaluated on a grid,
+# fitted coefficients) and hands it to a PlotRenderer. Worker processes import matplotlib and draw the PNGs,
+# so fitting never waits on rendering and no model objects cross process boundaries.
+####
+PLOT_MODES = ['none', 'summary', 'all']
+
+# Scatter plots with more sites than this draw a seeded uniform subsample of this size
+MAX_SCATTER_POINTS = 50000
+
+def histogram_payload(data, bins=50):
+    """
+    Returns the density histogram of data as counts and bin edges.
+    """
+    counts, edges = np.histogram(np.ravel(data), bins=bins, density=True)
+    return({'counts': counts.astype(np.float32), 'edges': edges.astype(np.float32)})
+
+def gmm_plot_payload(data, gmm, plot_name, title, n_points=1000):
+    """
+    Plot data of a histogram of allele balance with the fitted components of a Gaussian mixture.
+    The data is binned here, so the payload has the same size for any number of sites.
+
+    Parameters:
+        data (np.array): Data the mixture was fitted to
+        gmm (GaussianMixture): Fitted sklearn style mixture with means_, covariances_, and weights_
+        plot_name (str): File name of the plot without the .png extension
+        title (str): Plot title
+        n_points (int): Number of points the curves are evaluated at
+
+    Returns:
+        payload (dict): Plot data for render_plot
+    """
+    x = np.linspace(np.min(data), np.max(data), n_points)
+    means = np.ravel(gmm.means_)
+    sigmas = np.sqrt(np.ravel(gmm.covariances_))
+    component_pdf = gmm.weights_[np.newaxis, :] * norm.pdf(x[:, np.newaxis], means[np.newaxis, :], sigmas[np.newaxis, :])
+    return({'kind': 'mixture', 'plot_name': plot_name, 'title': title, 'histogram': histogram_payload(data),
+            'x': x.astype(np.float32), 'component_pdf': component_pdf.astype(np.float32)})
+
+def mixture_plot_payload(data, model, plot_name, title, n_points=1000):
+    """
+    Plot data of a histogram of allele balance with the fitted components of a gmm2 mixture model.
+    """
+    x = np.linspace(np.min(data), np.max(data), n_points)
+    component_pdf = np.exp(model._log_component_pdf(x, model.params)) * model.weights[np.newaxis, :]
+    return({'kind': 'mixture', 'plot_name': plot_name, 'title': title, 'histogram': histogram_payload(data),
+            'x': x.astype(np.float32), 'component_pdf': component_pdf.astype(np.float32)})
+
+def betabinom_plot_payload(counts, model, plot_name, title, bins=50):
+    """
+    Plot data of a histogram of allele balance with the fitted components of a beta-binomial mixture.
+    The components are drawn at the centres of the histogram bins, as the allele balance density they give at the observed depths.
+    """
+    counts = np.asarray(counts)
+    histogram = histogram_payload(counts[:, 0] / counts[:, 1], bins)
+    edges = histogram['edges'].astype(np.float64)
+    component_pdf = model.ab_density(counts, edges)
+    return({'kind': 'mixture', 'plot_name': plot_name, 'title': title, 'histogram': histogram,
+            'x': ((edges[:-1] + edges[1:]) / 2).astype(np.float32), 'component_pdf': component_pdf.astype(np.float32)})
+
+def lmm_plot_payload(ind_name, alt_count_data, ref_count_data, site_class, lmm_result, max_points=MAX_SCATTER_POINTS, random_state=0):
+    """
+    Plot data of alternate against reference counts by mixture component with the fitted LMM lines.
+    Components are stored as integer codes into a list of labels and the fit as its coefficients only.
+    Above max_points sites a seeded uniform subsample is kept, which preserves the density of points and of every component,
+    so the payload size and drawing time do not grow with the number of sites.
+
+    Parameters:
+        ind_name (str): Name of individual for plot title
+        alt_count_data (np.array): Counts of the alternate allele
+        ref_count_data (np.array): Counts of the reference allele
+        site_class (np.array): Mixture component of every site
+        lmm_result: Fitted RandomInterceptLMMResult or statsmodels MixedLM result
+        max_points (int): The largest number of points drawn
+        random_state (int): Seed for the subsample
+
+    Returns:
+        payload (dict): Plot data for render_plot
+    """
+    components, codes = np.unique(np.asarray(site_class), return_inverse=True)
+    alt = np.asarray(alt_count_data, dtype=np.float32)
+    ref = np.asarray(ref_count_data, dtype=np.float32)
+    n_sites = len(alt)
+    if n_sites > max_points:
+        keep = np.sort(np.random.default_rng(random_state).choice(n_sites, max_points, replace=False))
+        alt, ref, codes = alt[keep], ref[keep], codes[keep]
+    conf_int = lmm_result.conf_int()
+    group_effects = {}
+    if len(lmm_result.random_effects) > 1:
+        group_effects = {str(group): float(effect.iloc[0]) for group, effect in lmm_result.random_effects.items()}
+    return({
+        'kind': 'lmm',
+        'plot_name': f'{ind_name}.lmm',
+        'title': f'Ref Vs. Alt Counts - {ind_name}' if n_sites <= max_points else f'Ref Vs. Alt Counts - {ind_name} ({max_points} of {n_sites} sites)',
+        'alt': alt,
+        'ref': ref,
+        'codes': codes.astype(np.int16),
+        'components': [str(c) for c in components],
+        'intercept': float(lmm_result.fe_params['Intercept']),
+        'slope': float(lmm_result.fe_params['ref_counts']),
+        'intercept_ci': tuple(float(v) for v in conf_int.loc['Intercept']),
+        'slope_ci': tuple(float(v) for v in conf_int.loc['ref_counts']),
+        'group_effects': group_effects
+    })
+
+def summary_plot_payload(ploidy_dict, site_counts):
+    """
+    Plot data of the ploidy calls of a whole run, written once as ploidy_summary.png.
+
+    Parameters:
+        ploidy_dict (dict): Called ploidy of every individual, None where it was skipped
+        site_counts (dict): Number of sites each called individual was fitted on
+    """
+    called = [name for name in ploidy_dict if ploidy_dict[name] is not None]
+    return({
+        'kind': 'summary',
+        'plot_name': 'ploidy_summary',
+        'title': f'Ploidy Calls ({len(called)} of {len(ploidy_dict)} individuals)',
+        'ploidy': np.array([ploidy_dict[name] for name in called], dtype=np.int16),
+        'n_sites': np.array([site_counts[name] for name in called], dtype=np.int64)
+    })
+
+def _init_render_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _render_worker(payload, output_dir, dpi):
+    from popopolus.fit_mixtures.plot_mixtures import render_plot
+    render_plot(payload, output_dir, dpi)
+    return(payload['plot_name'])
+
+class PlotRenderer:
+    """
+    Renders plot payloads to PNG files in background worker processes.
+
+    Parameters:
+        output_dir (str): Directory the plots are written to
+        mode (str): 'none' draws nothing, 'summary' only the run summary, and 'all' also one plot per individual and model
+        dpi (int): Resolution of the PNG files
+        n_workers (int): Number of render processes
+        max_pending (int): Payloads queued beyond this wait for the oldest render, which bounds the memory held by payloads
+    """
+    def __init__(self, output_dir, mode='all', dpi=300, n_workers=1, max_pending=None):
+        if mode not in PLOT_MODES:
+            raise ValueError(f"Unsupported plot mode {mode}. Use 'none', 'summary', or 'all'.")
+        self.output_dir = output_dir
+        self.mode = mode
+        self.dpi = dpi
+        self.max_pending = max_pending if max_pending is not None else 4 * n_workers
+        self.pending = deque()
+        self.n_rendered = 0
+        self.n_failed = 0
+        self.executor = None
+        if mode != 'none':
+            self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_render_worker)
+
+    def wants(self, level):
+        """
+        Returns whether plots of a level, 'individual' or 'summary', are drawn in this mode.
+        """
+        if level == 'individual':
+            return(self.mode == 'all')
+        return(self.mode != 'none')
+
+    def submit(self, payload):
+        """
+        Queues a payload for rendering and returns without waiting for it.
+        """
+        if self.executor is None:
+            return
+        while len(self.pending) >= self.max_pending:
+            wait([self.pending[0]], return_when=FIRST_COMPLETED)
+            self._collect()
+        self.pending.append(self.executor.submit(_render_worker, payload, self.output_dir, self.dpi))
+        self._collect()
+
+    def _collect(self):
+        """Counts finished renders from the front of the queue. A failed render is logged and does not stop the run."""
+        while self.pending and self.pending[0].done():
+            future = self.pending.popleft()
+            error = future.exception()
+            if error is None:
+                self.n_rendered += 1
+            else:
+                self.n_failed += 1
+                logging.warning(f'Plot rendering failed: {error}')
+
+    def close(self):
+        """
+        Waits for all queued plots and stops the render processes.
+        """
+        if self.executor is None:
+            return
+        wait(list(self.pending))
+        self._collect()
+        self.executor.shutdown()
+        self.executor = None
+        logging.info(f'Rendered {self.n_rendered} plots at {self.dpi} dpi to {self.output_dir} ({self.n_failed} failed)')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+        return(False)
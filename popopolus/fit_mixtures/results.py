@@ -0,0 +1,199 @@
+import json
+import sqlite3
+import logging
+import uuid
+from datetime import datetime
+import numpy as np
+
+####
+# SQLite results store
+# One database file holds every run, the fitted model of every individual and ploidy, the ploidy calls, and the LMM tests,
+# instead of one text file per individual. Rows are buffered and written in one transaction per batch,
+# so a cohort costs a handful of commits on a shared filesystem rather than thousands of small files.
+####
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started TEXT,
+    finished TEXT,
+    command TEXT,
+    parameters TEXT
+);
+CREATE TABLE IF NOT EXISTS models (
+    run_id TEXT,
+    individual TEXT,
+    ploidy INTEGER,
+    model_type TEXT,
+    n_sites INTEGER,
+    lnl REAL,
+    bic REAL,
+    params TEXT
+);
+CREATE TABLE IF NOT EXISTS calls (
+    run_id TEXT,
+    individual TEXT,
+    ploidy INTEGER,
+    n_sites INTEGER,
+    lmm_p_value REAL,
+    support REAL,
+    dbic_lower REAL,
+    dbic_median REAL,
+    dbic_upper REAL
+);
+CREATE TABLE IF NOT EXISTS lmm (
+    run_id TEXT,
+    individual TEXT,
+    llf REAL,
+    null_llf REAL,
+    lrt_statistic REAL,
+    df INTEGER,
+    p_value REAL,
+    intercept REAL,
+    slope REAL,
+    scale REAL,
+    group_var REAL,
+    random_effects TEXT
+);
+CREATE INDEX IF NOT EXISTS models_individual ON models (individual);
+CREATE INDEX IF NOT EXISTS models_ploidy ON models (ploidy);
+CREATE INDEX IF NOT EXISTS models_run ON models (run_id);
+CREATE INDEX IF NOT EXISTS calls_individual ON calls (individual);
+CREATE INDEX IF NOT EXISTS calls_ploidy ON calls (ploidy);
+CREATE INDEX IF NOT EXISTS calls_run ON calls (run_id);
+CREATE INDEX IF NOT EXISTS lmm_individual ON lmm (individual);
+CREATE INDEX IF NOT EXISTS lmm_run ON lmm (run_id);
+'''
+
+TABLE_COLUMNS = {
+    'models': ['run_id', 'individual', 'ploidy', 'model_type', 'n_sites', 'lnl', 'bic', 'params'],
+    'calls': ['run_id', 'individual', 'ploidy', 'n_sites', 'lmm_p_value', 'support', 'dbic_lower', 'dbic_median', 'dbic_upper'],
+    'lmm': ['run_id', 'individual', 'llf', 'null_llf', 'lrt_statistic', 'df', 'p_value', 'intercept', 'slope', 'scale', 'group_var', 'random_effects']
+}
+
+def _to_json(value):
+    """JSON text of parameters that may hold numpy arrays and scalars"""
+    def convert(item):
+        if isinstance(item, np.ndarray):
+            return(item.tolist())
+        if isinstance(item, np.generic):
+            return(item.item())
+        raise TypeError(f'Cannot store {type(item)} as JSON')
+    return(json.dumps(value, default=convert))
+
+def _to_float(value):
+    """A float for SQLite, or None for missing values"""
+    if value is None:
+        return(None)
+    value = float(value)
+    return(None if np.isnan(value) else value)
+
+class ResultsStore:
+    """
+    Batched writer of ploidy estimation results to an indexed SQLite database.
+
+    Parameters:
+        db_file (str): Path of the database. Created with its tables and indexes if it does not exist.
+        batch_size (int): Rows buffered before they are written in one transaction
+    """
+    def __init__(self, db_file, batch_size=1000):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(db_file)
+        self.connection.executescript(SCHEMA)
+        self.run_id = None
+        self.buffers = {table: [] for table in TABLE_COLUMNS}
+        self.n_buffered = 0
+
+    def start_run(self, command, parameters, run_id=None):
+        """
+        Records the start of a run and returns its run ID, which is attached to every row written until finish_run.
+        Given the ID of a run already in the database, that run is continued instead of starting a new one.
+        """
+        if run_id is not None:
+            if self.connection.execute('SELECT 1 FROM runs WHERE run_id = ?', (run_id,)).fetchone() is not None:
+                self.run_id = run_id
+                with self.connection:
+                    self.connection.execute('UPDATE runs SET finished = NULL WHERE run_id = ?', (run_id,))
+                logging.info(f'Continuing run {run_id} in {self.db_file}')
+                return(self.run_id)
+            logging.warning(f'Run {run_id} is not in {self.db_file}. Starting a new run.')
+        self.run_id = f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        with self.connection:
+            self.connection.execute('INSERT INTO runs (run_id, started, command, parameters) VALUES (?, ?, ?, ?)',
+                                    (self.run_id, datetime.now().isoformat(), command, _to_json(parameters)))
+        return(self.run_id)
+
+    def discard_unfinished(self, finished):
+        """
+        Deletes the rows of the current run for individuals not in finished.
+        A resumed run calls this so an individual interrupted after some of its rows were written is not recorded twice.
+        """
+        with self.connection:
+            for table in TABLE_COLUMNS:
+                individuals = [row[0] for row in self.connection.execute(f'SELECT DISTINCT individual FROM {table} WHERE run_id = ?', (self.run_id,))]
+                self.connection.executemany(f'DELETE FROM {table} WHERE run_id = ? AND individual = ?',
+                                            [(self.run_id, individual) for individual in individuals if individual not in finished])
+
+    def _add(self, table, row):
+        self.buffers[table].append((self.run_id,) + row)
+        self.n_buffered += 1
+        if self.n_buffered >= self.batch_size:
+            self.flush()
+
+    def add_model(self, individual, ploidy, model_type, n_sites, lnl, bic, params):
+        """
+        Queues one fitted model of an individual. params is a dict of the fitted parameters and may hold numpy arrays.
+        """
+        self._add('models', (individual, int(ploidy), model_type, int(n_sites), _to_float(lnl), _to_float(bic), _to_json(params)))
+
+    def add_call(self, individual, ploidy, n_sites, lmm_p_value=None, bootstrap=None):
+        """
+        Queues the ploidy call of an individual with its LMM p-value and bootstrap summary where they were computed.
+        """
+        bootstrap = bootstrap if bootstrap is not None else {}
+        self._add('calls', (individual, None if ploidy is None else int(ploidy), int(n_sites), _to_float(lmm_p_value),
+                            _to_float(bootstrap.get('support')), _to_float(bootstrap.get('dbic_lower')),
+                            _to_float(bootstrap.get('dbic_median')), _to_float(bootstrap.get('dbic_upper'))))
+
+    def add_lmm(self, individual, result, null_llf, lrt_statistic, df, p_value):
+        """
+        Queues the LMM test of an individual from a RandomInterceptLMMResult or statsmodels MixedLM result.
+        """
+        random_effects = {str(group): float(effect.iloc[0]) for group, effect in result.random_effects.items()}
+        self._add('lmm', (individual, _to_float(result.llf), _to_float(null_llf), _to_float(lrt_statistic), int(df), _to_float(p_value),
+                          _to_float(result.fe_params['Intercept']), _to_float(result.fe_params['ref_counts']),
+                          _to_float(result.scale), _to_float(result.cov_re.iloc[0, 0]), _to_json(random_effects)))
+
+    def flush(self):
+        """
+        Writes all buffered rows in a single transaction.
+        """
+        if self.n_buffered == 0:
+            return
+        with self.connection:
+            for table, rows in self.buffers.items():
+                if rows:
+                    columns = TABLE_COLUMNS[table]
+                    self.connection.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+        self.buffers = {table: [] for table in TABLE_COLUMNS}
+        self.n_buffered = 0
+
+    def finish_run(self):
+        """
+        Writes the remaining rows and the finish time of the run.
+        """
+        self.flush()
+        with self.connection:
+            self.connection.execute('UPDATE runs SET finished = ? WHERE run_id = ?', (datetime.now().isoformat(), self.run_id))
+        logging.info(f'Results of run {self.run_id} written to {self.db_file}')
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+        return(False)
@@ -0,0 +1,215 @@
+import numpy as np
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from scipy.special import logsumexp
+from popopolus.fit_mixtures.gmm import get_fixed_params
+from popopolus.fit_mixtures.bootstrap import select_ploidy_bic
+
+####
+# Genome window scanning for aneuploidy and segmental ploidy changes
+# Sites are summarized per step-sized bin as a histogram of allele balance. Window histograms are differences
+# of cumulative sums over bins, so sliding windows cost no more than disjoint ones, and fixed-means mixtures
+# are fitted to the histograms of all windows of an individual at once.
+####
+
+# Histogram bins of allele balance between the truncation bounds used by est_ploidy
+AB_BINS = 50
+AB_TRUNCATION = (0.05, 0.95)
+
+def window_bins(chrom_index, positions, window_size, step):
+    """
+    Assign every site to a step-sized bin and lay out the windows over those bins.
+    Bins are numbered consecutively across chromosomes and windows never span two chromosomes.
+
+    Parameters:
+        chrom_index (np.array): The chromosome code of every site
+        positions (np.array): The position of every site
+        window_size (int): Window length in base pairs. Must be a multiple of step.
+        step (int): Distance between the starts of consecutive windows in base pairs
+
+    Returns:
+        site_bin (np.array): The bin of every site
+        n_bins (int): The total number of bins
+        windows (pd.DataFrame): chrom code, start, and end of every window plus its first and one-past-last bin
+    """
+    if window_size % step != 0:
+        raise ValueError(f'Window size {window_size} must be a multiple of the step {step}')
+    bins_per_window = window_size // step
+    n_chrom = int(chrom_index.max()) + 1
+    bins_per_chrom = np.zeros(n_chrom, dtype=np.int64)
+    np.maximum.at(bins_per_chrom, chrom_index, positions // step + 1)
+    offsets = np.concatenate([[0], np.cumsum(bins_per_chrom)])
+    site_bin = offsets[chrom_index] + positions // step
+    # Chromosomes shorter than a window get one window over all of their bins
+    n_windows = np.maximum(bins_per_chrom - bins_per_window + 1, 1)
+    window_chrom = np.repeat(np.arange(n_chrom), n_windows)
+    local_start = np.arange(n_windows.sum()) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+    first_bin = offsets[window_chrom] + local_start
+    last_bin = np.minimum(first_bin + bins_per_window, offsets[window_chrom + 1])
+    import pandas as pd
+    windows = pd.DataFrame({
+        'chrom': window_chrom,
+        'start': local_start * step,
+        'end': (last_bin - offsets[window_chrom]) * step,
+        'first_bin': first_bin,
+        'last_bin': last_bin
+    })
+    return(site_bin, int(offsets[-1]), windows)
+
+def window_histograms(ab, keep, site_bin, n_bins, first_bin, last_bin, n_ab_bins=AB_BINS, truncation=AB_TRUNCATION):
+    """
+    Returns the allele balance histogram of every window for one individual.
+
+    Parameters:
+        ab (np.array): Allele balance of every site
+        keep (np.array): Sites passing filters
+        site_bin (np.array): The bin of every site from window_bins
+        n_bins (int): The total number of bins
+        first_bin (np.array): The first bin of every window
+        last_bin (np.array): One past the last bin of every window
+        n_ab_bins (int): Number of allele balance bins between the truncation bounds
+        truncation (tuple): Sites with allele balance outside this open interval are dropped
+
+    Returns:
+        hist (np.array): Site counts of every window (rows) in every allele balance bin (columns)
+    """
+    keep = keep & (ab > truncation[0]) & (ab < truncation[1])
+    ab_bin = ((ab[keep] - truncation[0]) / (truncation[1] - truncation[0]) * n_ab_bins).astype(np.int64)
+    ab_bin = np.clip(ab_bin, 0, n_ab_bins - 1)
+    counts = np.bincount(site_bin[keep] * n_ab_bins + ab_bin, minlength=n_bins * n_ab_bins).reshape(n_bins, n_ab_bins)
+    cumulative = np.zeros((n_bins + 1, n_ab_bins), dtype=np.int64)
+    np.cumsum(counts, axis=0, out=cumulative[1:])
+    return(cumulative[last_bin] - cumulative[first_bin])
+
+def fit_binned_fixed_means(hist, centers, means, weights, fixed_weights=False, max_iter=200, tol=1e-6):
+    """
+    EM for Gaussian mixtures with fixed means on binned data, vectorized over many histograms.
+    Every histogram gets its own weights and component variances.
+
+    Parameters:
+        hist (np.array): Counts of every histogram (rows) in every bin (columns)
+        centers (np.array): The bin centres
+        means (np.array): The fixed component means
+        weights (np.array): Starting weights, or the fixed weights when fixed_weights is True
+        fixed_weights (bool): Keep the weights fixed
+        max_iter (int): Maximum number of EM iterations
+        tol (float): EM stops when no histogram improves its mean log likelihood by more than tol
+
+    Returns:
+        log_likelihood (np.array): The log likelihood of every histogram
+        n_parameters (int): The number of free parameters of each fit
+    """
+    hist = hist.astype(np.float64)
+    n_sites = np.maximum(hist.sum(axis=1), 1)
+    n_components = len(means)
+    # Sheppard's correction keeps variances from collapsing below the bin resolution
+    min_var = (centers[1] - centers[0]) ** 2 / 12
+    sq_dist = (centers[:, np.newaxis] - means[np.newaxis, :]) ** 2
+    log_weights = np.tile(np.log(weights), (hist.shape[0], 1))
+    var = np.full((hist.shape[0], n_components), max(np.diff(means).min() / 4 if n_components > 1 else 0.1, np.sqrt(min_var)) ** 2)
+    log_likelihood = np.full(hist.shape[0], -np.inf)
+    for _ in range(max_iter):
+        weighted = -0.5 * (np.log(2 * np.pi * var)[:, np.newaxis, :] + sq_dist[np.newaxis, :, :] / var[:, np.newaxis, :]) + log_weights[:, np.newaxis, :]
+        log_norm = logsumexp(weighted, axis=2)
+        new_log_likelihood = (hist * log_norm).sum(axis=1)
+        resp = np.exp(weighted - log_norm[:, :, np.newaxis]) * hist[:, :, np.newaxis]
+        nk = resp.sum(axis=1) + 10 * np.finfo(np.float64).eps
+        if not fixed_weights:
+            log_weights = np.log(nk / nk.sum(axis=1, keepdims=True))
+        var = np.einsum('wbk,bk->wk', resp, sq_dist) / nk + min_var
+        converged = np.all(np.abs(new_log_likelihood - log_likelihood) / n_sites < tol)
+        log_likelihood = new_log_likelihood
+        if converged:
+            break
+    n_parameters = n_components + (0 if fixed_weights else n_components - 1)
+    return(log_likelihood, n_parameters)
+
+def scan_individual_windows(ab, keep, site_bin, n_bins, first_bin, last_bin, ploidy, model_constraints, minimum_sites):
+    """
+    Select the ploidy of every window for one individual with the BIC rule of fit_gmm_to_ab.
+
+    Parameters:
+        ab (np.array): Allele balance of every site
+        keep (np.array): Sites passing filters
+        site_bin (np.array): The bin of every site from window_bins
+        n_bins (int): The total number of bins
+        first_bin (np.array): The first bin of every window
+        last_bin (np.array): One past the last bin of every window
+        ploidy (list): The ploidies to test
+        model_constraints (int): 2 fixes the weights to the expected dosage frequencies. Means are always fixed.
+        minimum_sites (int): Windows with fewer sites get no ploidy
+
+    Returns:
+        calls (np.array): The ploidy of every window, 0 where the window has too few sites
+        n_sites (np.array): The number of sites in every window
+    """
+    hist = window_histograms(ab, keep, site_bin, n_bins, first_bin, last_bin)
+    n_sites = hist.sum(axis=1)
+    edges = np.linspace(AB_TRUNCATION[0], AB_TRUNCATION[1], AB_BINS + 1)
+    centers = (edges[:-1] + edges[1:]) / 2
+    bics = np.empty((hist.shape[0], len(ploidy)))
+    for m, p in enumerate(ploidy):
+        means, weights = get_fixed_params(p - 1)
+        log_likelihood, n_parameters = fit_binned_fixed_means(hist, centers, means.ravel(), weights.ravel(), fixed_weights = model_constraints == 2)
+        bics[:, m] = -2 * log_likelihood + n_parameters * np.log(np.maximum(n_sites, 1))
+    calls = select_ploidy_bic(bics, ploidy)
+    calls[n_sites < minimum_sites] = 0
+    return(calls.astype(np.int8), n_sites)
+
+# Per-process copy of the site layout, set once when a worker starts so only allele balances are sent per task
+_layout = {}
+
+def _init_worker(site_bin, n_bins, first_bin, last_bin):
+    _layout.update(site_bin=site_bin, n_bins=n_bins, first_bin=first_bin, last_bin=last_bin)
+
+def _scan_worker(ab, keep, ploidy, model_constraints, minimum_sites):
+    return(scan_individual_windows(ab, keep, _layout['site_bin'], _layout['n_bins'], _layout['first_bin'], _layout['last_bin'], ploidy, model_constraints, minimum_sites))
+
+def scan_windows(tax_list, ab_dat, coordinates, ploidy_levels, model_constraints, output_dir, window_size=1000000, step=None, minimum_sites=50, n_jobs=1):
+    """
+    Estimate ploidy in genome windows for every individual and write a window by individual table to windows.txt.
+
+    Parameters:
+        tax_list (list): A list of individual names corresponding to the individual order of ab_dat
+        ab_dat (np.array): Allele balance data returned from get_ind_freqs
+        coordinates (tuple): Chromosome names, chromosome codes, and positions returned from get_ind_freqs with keep_coordinates
+        ploidy_levels (str): The ploidies to test passed as a comma-separated list
+        model_constraints (int): 2 fixes the weights to the expected dosage frequencies. Means are always fixed.
+        output_dir (str): The output directory where all results will be directed
+        window_size (int): Window length in base pairs
+        step (int): Distance between window starts in base pairs. None gives non-overlapping windows.
+        minimum_sites (int): Windows with fewer sites get NA
+        n_jobs (int): The number of worker processes, each scanning one individual at a time
+
+    Returns:
+        window_df (pd.DataFrame): chrom, start, and end of every window and the ploidy of every individual
+    """
+    chrom_names, chrom_index, positions = coordinates
+    ploidy = [int(p) for p in ploidy_levels.split(',')]
+    step = window_size if step is None else step
+    site_bin, n_bins, windows = window_bins(chrom_index, positions, window_size, step)
+    first_bin = windows['first_bin'].to_numpy()
+    last_bin = windows['last_bin'].to_numpy()
+    logging.info(f'Scanning {len(windows)} windows of {window_size} bp every {step} bp for ploidies {ploidy}')
+    n_tax = ab_dat.shape[2]
+    ind_abs = (ab_dat[0, :, i] for i in range(n_tax))
+    keeps = (ab_dat[3, :, i] == 1 for i in range(n_tax))
+    args = ([ploidy] * n_tax, [model_constraints] * n_tax, [minimum_sites] * n_tax)
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers = n_jobs, initializer = _init_worker, initargs = (site_bin, n_bins, first_bin, last_bin)) as executor:
+            results = list(executor.map(_scan_worker, ind_abs, keeps, *args))
+    else:
+        _init_worker(site_bin, n_bins, first_bin, last_bin)
+        results = list(map(_scan_worker, ind_abs, keeps, *args))
+    import pandas as pd
+    window_df = pd.DataFrame({
+        'chrom': np.array(chrom_names)[windows['chrom'].to_numpy()],
+        'start': windows['start'].to_numpy(),
+        'end': windows['end'].to_numpy()
+    })
+    calls = pd.DataFrame(np.column_stack([r[0] for r in results]), columns = tax_list).astype('Int8')
+    window_df = pd.concat([window_df, calls.mask(calls == 0)], axis = 1)
+    for i in range(n_tax):
+        logging.info(f'Individual {tax_list[i]}: {np.sum(results[i][0] > 0)} of {len(windows)} windows with at least {minimum_sites} sites')
+    window_df.to_csv(f'{output_dir}/windows.txt', sep = '\t', index = False, na_rep = 'NA')
+    return(window_df)
@@ -0,0 +1,6 @@
+"""
+Summarize differentiation and structure among populations
+"""
+from popopolus.population_structure.fst import calculate_fst
+from popopolus.population_structure.pca import randomized_pca
+from popopolus.population_structure.distance import accumulate_distances
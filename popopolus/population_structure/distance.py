@@ -0,0 +1,97 @@
+import numpy as np
+import logging
+
+####
+# Pairwise distance and kinship between individuals of any ploidy
+# Every block of sites adds masked numerators and valid-site counts to individual x individual sums
+# through matrix products, so the run time is spent in GEMM. Blocks are streamed from the VCF,
+# so memory is quadratic in individuals and does not grow with the number of sites.
+####
+def individual_ploidy(tax_list, ind_map, ploidy_key='ploidy', default_ploidy=2):
+    '''
+    Returns the ploidy of every individual from the sample sheet, or default_ploidy where it is not given.
+    '''
+    ploidy = np.full(len(tax_list), default_ploidy, dtype=np.int32)
+    for i, tax in enumerate(tax_list):
+        value = ind_map[tax].get(ploidy_key)
+        if (value is not None) and not (isinstance(value, float) and np.isnan(value)):
+            ploidy[i] = int(value)
+    return(ploidy)
+
+def accumulate_distances(blocks, ploidy, use_dosage=False):
+    '''
+    Accumulates allele balance distances and kinship between all pairs of individuals over blocks of sites.
+    Only sites where both individuals have valid genotypes count towards a pair, and homozygous genotypes count with an allele balance of 0 or 1.
+    The distance is the root mean squared difference in allele balance, which estimates allele dosage divided by ploidy
+    and so is comparable between ploidies. Kinship is the ratio of sums of (x_i - p)(x_j - p) and p(1 - p),
+    with p the mean over valid individuals, so an outbred individual of ploidy k has a self-kinship of 1/k.
+    Allele balance varies around the dosage of an individual by read sampling, which adds about x(1 - x)/depth to its own
+    squared deviation, so the unbiased estimate x(1 - x)/(depth - 1) of that variance is subtracted from the self-kinship.
+
+    Parameters:
+        blocks (iterable): blocks of sites as (chrom, pos, allele_balance, depth, valid) from iter_genotype_blocks or array_genotype_blocks
+        ploidy (np.array): the ploidy of every individual
+        use_dosage (bool): round allele balance to the nearest dosage of each individual's ploidy first. Rounding removes the
+            read sampling variance, so no correction is made.
+
+    Returns:
+        distance (np.array): individual x individual distances, NaN for pairs without shared sites
+        kinship (np.array): individual x individual kinship
+        n_shared (np.array): the number of sites where both individuals have valid genotypes
+    '''
+    n_tax = len(ploidy)
+    n_sites = 0
+    squared_difference = np.zeros((n_tax, n_tax))
+    n_shared = np.zeros((n_tax, n_tax))
+    kinship_numerator = np.zeros((n_tax, n_tax))
+    kinship_denominator = np.zeros((n_tax, n_tax))
+    read_variance = np.zeros(n_tax)
+    for _, _, allele_balance, depth, valid in blocks:
+        n_sites += len(allele_balance)
+        ab = np.asarray(allele_balance, dtype=np.float64)
+        mask = np.asarray(valid, dtype=np.float64)
+        if use_dosage:
+            ab = np.rint(ab * ploidy[np.newaxis, :]) / ploidy[np.newaxis, :]
+        else:
+            read_variance += (mask * ab * (1 - ab) / np.maximum(np.asarray(depth, dtype=np.float64) - 1, 1)).sum(axis=0)
+        ab *= mask
+        ab_squared = ab * ab
+        # sum over shared sites of (x_i - x_j)^2 = sum m_j x_i^2 + sum m_i x_j^2 - 2 sum x_i x_j
+        cross = ab.T @ ab
+        squared_sum = ab_squared.T @ mask
+        squared_difference += squared_sum + squared_sum.T - 2 * cross
+        n_shared += mask.T @ mask
+        with np.errstate(divide='ignore', invalid='ignore'):
+            site_mean = ab.sum(axis=1) / mask.sum(axis=1)
+        site_mean = np.nan_to_num(site_mean)
+        deviation = (ab - site_mean[:, np.newaxis]) * mask
+        kinship_numerator += deviation.T @ deviation
+        kinship_denominator += (mask * (site_mean * (1 - site_mean))[:, np.newaxis]).T @ mask
+    kinship_numerator[np.diag_indices(n_tax)] -= read_variance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance = np.sqrt(np.maximum(squared_difference, 0) / n_shared)
+        kinship = kinship_numerator / kinship_denominator
+    np.fill_diagonal(distance, 0)
+    logging.info(f'Accumulated distances and kinship of {n_tax} individuals over {n_sites} sites')
+    return(distance, kinship, n_shared.astype(np.int64))
+
+def write_distances(tax_list, ploidy, distance, kinship, n_shared, output_dir):
+    '''
+    Writes distance.txt and kinship.txt as labelled individual x individual matrices, and inbreeding.txt with the
+    self-kinship of every individual and the inbreeding coefficient F = (k * self-kinship - 1) / (k - 1) for its ploidy k.
+    '''
+    import pandas as pd
+    pd.DataFrame(distance, index=tax_list, columns=tax_list).to_csv(f'{output_dir}/distance.txt', sep='\t', na_rep='NA', float_format='%.6g')
+    pd.DataFrame(kinship, index=tax_list, columns=tax_list).to_csv(f'{output_dir}/kinship.txt', sep='\t', na_rep='NA', float_format='%.6g')
+    self_kinship = np.diag(kinship)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inbreeding = (ploidy * self_kinship - 1) / (ploidy - 1)
+    inbreeding_df = pd.DataFrame({
+        'individual': tax_list,
+        'ploidy': ploidy,
+        'self_kinship': self_kinship,
+        'inbreeding': inbreeding,
+        'n_sites': np.diag(n_shared)
+    })
+    inbreeding_df.to_csv(f'{output_dir}/inbreeding.txt', sep='\t', index=False, na_rep='NA', float_format='%.6g')
+    return(inbreeding_df)
@@ -0,0 +1,137 @@
+import numpy as np
+import logging
+from popopolus.calculate_frequencies.vcf_blocks import read_vcf_samples, population_index, iter_pop_count_blocks
+
+####
+# Hudson Fst between all pairs of populations
+# Numerators and denominators of Bhatia et al. (2013) are computed for every pair at once by indexing the
+# population columns with the upper triangle of pairs, then summed over sites (ratio of averages).
+# Only the running sums and the current window are kept, so memory is bounded by the block size.
+####
+def sample_ploidy(sample_names, columns, ind_map, ploidy_key='ploidy', default_ploidy=2):
+    '''
+    Returns the ploidy of every selected sample column from the sample sheet, or default_ploidy where it is not given.
+    '''
+    ploidy = np.full(len(columns), default_ploidy, dtype=np.int32)
+    for k, column in enumerate(columns):
+        value = ind_map[sample_names[column]].get(ploidy_key)
+        if (value is not None) and not (isinstance(value, float) and np.isnan(value)):
+            ploidy[k] = int(value)
+    return(ploidy)
+
+def hudson_fst_components(pop_alt, pop_depth, pop_n, pairs):
+    '''
+    Hudson Fst numerator and denominator at every site for every population pair.
+    Allele frequencies come from pooled reads and the sample size of a population is its number of sampled chromosomes.
+
+    Parameters:
+        pop_alt (np.array): alternate counts of every site (rows) and population (columns)
+        pop_depth (np.array): total counts
+        pop_n (np.array): sampled chromosomes
+        pairs (tuple): first and second population of every pair, as from np.triu_indices
+
+    Returns:
+        numerator (np.array): numerator of every site (rows) and pair (columns), zero where a pair is not comparable
+        denominator (np.array): denominator, zero where a pair is not comparable
+        comparable (np.array): sites where both populations have reads from at least two chromosomes
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freq = pop_alt / pop_depth
+        within = freq * (1 - freq) / (pop_n - 1)
+    first, second = pairs
+    p1 = freq[:, first]
+    p2 = freq[:, second]
+    comparable = (pop_n[:, first] >= 2) & (pop_n[:, second] >= 2) & (pop_depth[:, first] > 0) & (pop_depth[:, second] > 0)
+    numerator = (p1 - p2) ** 2 - within[:, first] - within[:, second]
+    denominator = p1 * (1 - p2) + p2 * (1 - p1)
+    numerator = np.where(comparable, numerator, 0)
+    denominator = np.where(comparable, denominator, 0)
+    return(numerator, denominator, comparable)
+
+def _window_runs(chrom, window):
+    '''Start of every run of consecutive sites sharing a chromosome and window'''
+    changed = np.ones(len(window), dtype=bool)
+    changed[1:] = (chrom[1:] != chrom[:-1]) | (window[1:] != window[:-1])
+    return(np.flatnonzero(changed))
+
+def calculate_fst(ind_map, vcf_file, min_depth, min_count, output_dir, pate_flag=False, min_qual=0, window_size=1000000, block_size=10000):
+    '''
+    Computes Hudson Fst between every pair of populations genome-wide and in non-overlapping windows.
+    Writes fst.txt with one row per pair and fst.windows.txt with one row per window and one column per pair.
+    The VCF must be sorted by chromosome and position for windows to be contiguous.
+
+    Parameters:
+        ind_map (dict): a dictionary mapping individuals in the VCF to their sample sheet row. Needs a population column and may have a ploidy column.
+        vcf_file (string): a multisample vcf file uncompressed
+        min_depth (int): the minimum depth of an individual at a site for its reads to be counted
+        min_count (int): the minimum number of pooled reads supporting the minor allele for a site to be used
+        output_dir (string): the directory where all results will be written
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        min_qual (int): the minimum phred-scaled genotype quality of an individual at a site for its reads to be counted
+        window_size (int): window length in base pairs
+        block_size (int): the number of sites processed at once
+
+    Returns:
+        fst_df (pd.DataFrame): genome-wide Fst and the number of comparable sites of every pair
+    '''
+    sample_names = read_vcf_samples(vcf_file, pate_flag)
+    populations, columns, starts = population_index(sample_names, ind_map)
+    ploidy = sample_ploidy(sample_names, columns, ind_map)
+    pairs = np.triu_indices(len(populations), k=1)
+    pair_names = [f'{populations[i]}:{populations[j]}' for i, j in zip(*pairs)]
+    logging.info(f'Calculating Fst for {len(pair_names)} pairs of {len(populations)} populations')
+    total_numerator = np.zeros(len(pair_names))
+    total_denominator = np.zeros(len(pair_names))
+    total_sites = np.zeros(len(pair_names), dtype=np.int64)
+    # The window still being filled when a block ends
+    current_key = None
+    current = None
+    with open(f'{output_dir}/fst.windows.txt', 'w') as window_file:
+        window_file.write('chrom\tstart\tend\tn_sites\t' + '\t'.join(pair_names) + '\n')
+
+        def write_window(key, numerator, denominator, n_sites):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                window_fst = numerator / denominator
+            values = '\t'.join('NA' if np.isnan(v) else f'{v:.6g}' for v in window_fst)
+            window_file.write(f'{key[0]}\t{key[1] * window_size}\t{(key[1] + 1) * window_size}\t{n_sites}\t{values}\n')
+
+        for chrom, pos, pop_alt, pop_depth, pop_n in iter_pop_count_blocks(vcf_file, columns, starts, pate_flag, min_depth, min_qual, block_size, ploidy):
+            total_alt = pop_alt.sum(axis=1)
+            keep = np.minimum(total_alt, pop_depth.sum(axis=1) - total_alt) >= min_count
+            if not keep.any():
+                continue
+            numerator, denominator, comparable = hudson_fst_components(pop_alt[keep], pop_depth[keep], pop_n[keep], pairs)
+            total_numerator += numerator.sum(axis=0)
+            total_denominator += denominator.sum(axis=0)
+            total_sites += comparable.sum(axis=0)
+            chrom = np.array(chrom)[keep]
+            window = pos[keep] // window_size
+            runs = _window_runs(chrom, window)
+            run_numerator = np.add.reduceat(numerator, runs, axis=0)
+            run_denominator = np.add.reduceat(denominator, runs, axis=0)
+            run_sites = np.diff(np.append(runs, len(window)))
+            for r, start in enumerate(runs):
+                key = (chrom[start], int(window[start]))
+                if key == current_key:
+                    current[0] += run_numerator[r]
+                    current[1] += run_denominator[r]
+                    current[2] += run_sites[r]
+                    continue
+                if current_key is not None:
+                    write_window(current_key, *current)
+                current_key = key
+                current = [run_numerator[r].copy(), run_denominator[r].copy(), run_sites[r]]
+        if current_key is not None:
+            write_window(current_key, *current)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        genome_fst = total_numerator / total_denominator
+    import pandas as pd
+    fst_df = pd.DataFrame({
+        'pop1': [populations[i] for i in pairs[0]],
+        'pop2': [populations[j] for j in pairs[1]],
+        'fst': genome_fst,
+        'n_sites': total_sites
+    })
+    fst_df.to_csv(f'{output_dir}/fst.txt', sep='\t', index=False, na_rep='NA', float_format='%.6g')
+    logging.info(f'Genome-wide Fst written to {output_dir}/fst.txt and windowed Fst to {output_dir}/fst.windows.txt')
+    return(fst_df)
@@ -0,0 +1,121 @@
+import numpy as np
+import logging
+
+####
+# Randomized PCA of individuals from allele balance
+# The centred sites x individuals matrix is never formed. Every pass streams blocks of sites, from the VCF or from
+# allele balance arrays that may be memory mapped, and only individual-sized matrices are kept between passes (Halko et al. 2011).
+####
+def centred_block(allele_balance, valid, scale=True):
+    '''
+    Returns a block of sites of the centred allele balance matrix.
+    Each site is centred on the mean of the individuals with valid genotypes, homozygotes included, and invalid genotypes are set to zero, the centred mean.
+
+    Parameters:
+        allele_balance (np.array): allele balance of every site (rows) and individual (columns)
+        valid (np.array): genotypes passing the depth and quality filters
+        scale (bool): divide every site by sqrt(p(1-p)) of its mean p (Patterson et al. 2006)
+
+    Returns:
+        block (np.array): centred allele balance of every site (rows) and individual (columns)
+    '''
+    ab = np.asarray(allele_balance, dtype=np.float64)
+    n_valid = valid.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(valid, ab, 0).sum(axis=1) / n_valid
+        block = np.where(valid, ab - mean[:, np.newaxis], 0)
+        if scale:
+            block /= np.sqrt(mean * (1 - mean))[:, np.newaxis]
+    block[~np.isfinite(block)] = 0
+    return(block)
+
+def _gram_product(blocks, basis, scale):
+    '''One pass over all sites returning M^T M basis, the squared Frobenius norm of M, and the number of sites'''
+    product = np.zeros_like(basis)
+    total_variance = 0.0
+    n_sites = 0
+    for _, _, allele_balance, _, valid in blocks():
+        block = centred_block(allele_balance, valid, scale)
+        product += block.T @ (block @ basis)
+        total_variance += np.einsum('ij,ij->', block, block)
+        n_sites += len(block)
+    return(product, total_variance, n_sites)
+
+def randomized_pca(blocks, n_tax, n_components=10, n_oversamples=10, n_iter=1, scale=True, random_state=0, loadings_file=None):
+    '''
+    Top principal components of individuals by randomized SVD over streamed blocks of sites.
+    One pass finds the range of the individuals, n_iter power passes refine it, one pass projects onto it,
+    and an optional last pass writes the site loadings.
+
+    Parameters:
+        blocks (function): returns a new iterator over blocks of sites as (chrom, pos, allele_balance, depth, valid),
+            such as iter_genotype_blocks or array_genotype_blocks. It is called once per pass.
+        n_tax (int): number of individuals
+        n_components (int): number of principal components
+        n_oversamples (int): extra random directions that make the leading components accurate
+        n_iter (int): number of power iterations. Each costs one pass over the sites.
+        scale (bool): divide every site by sqrt(p(1-p)) of its mean p
+        random_state (int): seed for the random test matrix
+        loadings_file (string): if given, the loading of every site on every component is streamed to this file,
+            labelled by chromosome and position, or by site index where the blocks have no chromosomes
+
+    Returns:
+        scores (np.array): principal component scores of every individual (rows)
+        eigenvalues (np.array): variance of the centred matrix along each component
+        explained (np.array): fraction of the total variance explained by each component
+    '''
+    n_random = min(n_components + n_oversamples, n_tax)
+    rng = np.random.default_rng(random_state)
+    basis = rng.standard_normal((n_tax, n_random))
+    product, total_variance, n_sites = _gram_product(blocks, basis, scale)
+    basis, _ = np.linalg.qr(product)
+    for _ in range(n_iter):
+        product, _, _ = _gram_product(blocks, basis, scale)
+        basis, _ = np.linalg.qr(product)
+    # Rayleigh-Ritz: the small Gram matrix of the projected sites gives the singular values and right singular vectors
+    gram = np.zeros((n_random, n_random))
+    for _, _, allele_balance, _, valid in blocks():
+        projected = centred_block(allele_balance, valid, scale) @ basis
+        gram += projected.T @ projected
+    eigenvalues, rotation = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    eigenvalues = np.maximum(eigenvalues[order], 0)
+    right = basis @ rotation[:, order]
+    # Fix signs so the largest score on every component is positive
+    signs = np.sign(right[np.abs(right).argmax(axis=0), np.arange(right.shape[1])])
+    right *= np.where(signs == 0, 1, signs)
+    singular_values = np.sqrt(eigenvalues)
+    scores = right * singular_values
+    explained = eigenvalues / total_variance if total_variance > 0 else np.zeros_like(eigenvalues)
+    logging.info(f'PCA of {n_tax} individuals over {n_sites} sites in {3 + n_iter} passes. Variance explained: {np.round(explained, 4)}')
+    if loadings_file is not None:
+        import pandas as pd
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse_values = np.where(singular_values > 0, 1 / singular_values, 0)
+        components = [f'PC{i + 1}' for i in range(len(order))]
+        with open(loadings_file, 'w') as outfile:
+            header = False
+            for chrom, pos, allele_balance, _, valid in blocks():
+                loadings = pd.DataFrame((centred_block(allele_balance, valid, scale) @ right) * inverse_values, columns=components)
+                if chrom is not None:
+                    loadings.insert(0, 'pos', pos)
+                    loadings.insert(0, 'chrom', chrom)
+                else:
+                    loadings.insert(0, 'site', pos)
+                if not header:
+                    outfile.write('\t'.join(loadings.columns) + '\n')
+                    header = True
+                loadings.to_csv(outfile, sep='\t', header=False, index=False, float_format='%.6g')
+    return(scores, eigenvalues, explained)
+
+def write_pca(tax_list, scores, eigenvalues, explained, output_dir):
+    '''
+    Writes principal component scores of individuals to pca.eigenvec.txt and eigenvalues to pca.eigenval.txt.
+    '''
+    import pandas as pd
+    score_df = pd.DataFrame(scores, columns=[f'PC{i + 1}' for i in range(scores.shape[1])])
+    score_df.insert(0, 'individual', tax_list)
+    score_df.to_csv(f'{output_dir}/pca.eigenvec.txt', sep='\t', index=False, float_format='%.6g')
+    value_df = pd.DataFrame({'PC': [f'PC{i + 1}' for i in range(len(eigenvalues))], 'eigenvalue': eigenvalues, 'variance_explained': explained})
+    value_df.to_csv(f'{output_dir}/pca.eigenval.txt', sep='\t', index=False, float_format='%.6g')
+    return(score_df)
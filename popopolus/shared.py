@@ -0,0 +1,106 @@
+import os
+import uuid
+import logging
+from multiprocessing import shared_memory
+import numpy as np
+
+####
+# Arrays shared between processes
+# The ingestion arrays are written once into a named shared memory block, or a memory-mapped file where /dev/shm is small,
+# and worker processes attach zero-copy views by name. Tasks then carry a small handle and an index instead of pickled slices,
+# and memory does not grow with the number of workers.
+####
+_ATTACHED = {}
+
+class SharedArray:
+    '''
+    A numpy array in named shared memory or in a memory-mapped file.
+    Create it with SharedArray.create in the owning process and pass SharedArray.handle to workers, which call attach.
+
+    Parameters:
+        handle (tuple): where the array lives, as returned by the handle attribute
+        owner (bool): the array was created by this object, which removes it in unlink
+    '''
+    def __init__(self, handle, owner=False):
+        kind, location, shape, dtype = handle
+        self.handle = handle
+        self.owner = owner
+        self._shm = None
+        if kind == 'shm':
+            self._shm = shared_memory.SharedMemory(name=location, create=False)
+            self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        else:
+            self.array = np.memmap(location, dtype=dtype, mode='r+', shape=tuple(shape))
+
+    @classmethod
+    def create(cls, shape, dtype, directory=None):
+        '''
+        Returns a new zero-filled shared array.
+
+        Parameters:
+            shape (tuple): shape of the array
+            dtype (np.dtype): type of the array
+            directory (string): directory for a memory-mapped file. None uses shared memory.
+        '''
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        n_bytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        if directory is None:
+            shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+            handle = ('shm', shm.name, shape, dtype.str)
+            shm.close()
+        else:
+            path = os.path.join(os.path.abspath(directory), f'.shared-{uuid.uuid4().hex}.dat')
+            with open(path, 'wb') as fh:
+                fh.truncate(n_bytes)
+            handle = ('file', path, shape, dtype.str)
+        logging.info(f'Allocated {n_bytes / 1024 / 1024:.2f} MB shared array {handle[1]}')
+        shared = cls(handle, owner=True)
+        # Workers forked from the owner inherit its view instead of attaching again
+        _ATTACHED[handle] = shared
+        return(shared)
+
+    def close(self):
+        '''
+        Releases the view of this process. The array stays available to other processes until unlink.
+        Views taken from the array must be deleted first.
+        '''
+        self.array = None
+        if _ATTACHED.get(self.handle) is self:
+            del _ATTACHED[self.handle]
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        '''
+        Removes the array and closes it. Called once by the owner after every worker is finished with it.
+        Processes still attached keep their views until they close them.
+        '''
+        kind, location = self.handle[0], self.handle[1]
+        if kind == 'shm':
+            if self._shm is not None:
+                self._shm.unlink()
+            else:
+                shared_memory.SharedMemory(name=location, create=False).unlink()
+        elif os.path.exists(location):
+            os.remove(location)
+        self.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
+        return(False)
+
+def attach(handle):
+    '''
+    Returns the array of a SharedArray handle. Each process attaches a handle once and reuses the view for later tasks.
+    '''
+    if handle not in _ATTACHED:
+        _ATTACHED[handle] = SharedArray(handle)
+    return(_ATTACHED[handle].array)
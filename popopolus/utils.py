@@ -1,5 +1,6 @@
-import pandas as pd
+import csv
 import os
+import contextlib
 import logging
 import sys
 
@@ -10,12 +11,52 @@ def check_dir(my_dir):
         os.makedirs(my_dir)
         print(f'Output files will be written to: {my_dir}\n')
 
+@contextlib.contextmanager
+def open_vcf(vcf_file, binary=False):
+    '''
+    Opens a VCF for reading, where '-' is the standard input. The standard input is left open when the block ends
+    so header and records can be read by successive readers of the same stream.
+    '''
+    if vcf_file == '-':
+        yield(sys.stdin.buffer if binary else sys.stdin)
+    else:
+        with open(vcf_file, 'rb' if binary else 'r') as fh:
+            yield(fh)
+
+def check_individuals(ind_map, vcf_individuals):
+    '''
+    Stops the run if any individual of the mapping file is missing from the individuals found in the VCF.
+    '''
+    vcf_individuals = set(vcf_individuals)
+    if any(i not in vcf_individuals for i in ind_map.keys()):
+        logging.warning('Not all indivuals in mapping file are present in VCF. Checking for mismatches...')
+        for i in ind_map.keys():
+            if i not in vcf_individuals:
+                logging.warning(f'{i} found in mapping file but not VCF!')
+        logging.error('Stopping to make corrections to mapping file!')
+        sys.exit()
+
 def decompress_vcf(vcf_file):
     print(f'{vcf_file}\n')
 
+def _parse_cell(value):
+    '''
+    Returns a sample sheet cell as an int or float where it is numeric, None where it is empty or NA, and the stripped string otherwise.
+    '''
+    value = value.strip()
+    if value in ['', 'NA', 'NaN', 'nan']:
+        return(None)
+    for number_type in [int, float]:
+        try:
+            return(number_type(value))
+        except ValueError:
+            pass
+    return(value)
+
 def map_individuals(sample_sheet):
     '''
     Returns a dict mapping individual ids in the vcf to populations. Confirms individuals are present in VCF and warns if missing.
+    The sheet is read with the csv module so the CLI does not import pandas. Individual ids are always kept as strings.
 
     Parameters:
         sample_sheet (string): a sample sheet mapping individual ids to individual names and population names
@@ -24,18 +65,32 @@ def map_individuals(sample_sheet):
     Returns:
         ind_map (dict): a dictionary where keys are ids in the vcf and values are preferred names in downstream output
     '''
-    df = pd.read_csv(sample_sheet,header=0)
+    ind_map = {}
+    with open(sample_sheet, 'r', newline='') as fh:
+        reader = csv.DictReader(fh)
+        if (reader.fieldnames is None) or ('individual' not in [f.strip() for f in reader.fieldnames]):
+            raise ValueError(f'Sample sheet {sample_sheet} needs a header with an individual column')
+        reader.fieldnames = [f.strip() for f in reader.fieldnames]
+        for row in reader:
+            individual = row.pop('individual').strip()
+            if individual == '':
+                continue
+            ind_map[individual] = {key: _parse_cell(value if value is not None else '') for key, value in row.items() if key is not None}
     logging.info('')
-    logging.info(df.head())
-    ind_map = df.set_index('individual').to_dict('index')
-    #print(ind_map)
+    for individual in list(ind_map)[:5]:
+        logging.info(f'{individual}\t{ind_map[individual]}')
     return(ind_map)
 
 def get_vcf_dimensions(vcf_file, pate_flag, ind_map):
     """
     Get the number of individuals and number of sites from the vcf in order to get dimensions for allocation of numpy arrays.
     Perform an additional check to ensure that all individuals specified in the ind_map are present in the vcf.
+    A VCF on the standard input ('-') can only be read once, so no sites are counted and the individuals of ind_map are returned.
+    get_ind_freqs then grows its arrays as it reads and checks the individuals itself.
     """
+    if vcf_file == '-':
+        logging.info(f'Reading the VCF from standard input in a single pass for {len(ind_map)} individuals')
+        return 0,len(ind_map)
     n_tax = 0
     n_sites = 0
     skip_header = 1
@@ -68,11 +123,6 @@ def get_vcf_dimensions(vcf_file, pate_flag, ind_map):
                     if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')):
                         n_sites = n_sites + 1
     if n_tax < len(ind_map.keys()):
-        logging.warning('Not all indivuals in mapping file are present in VCF. Checking for mismatches...')
-        for i in ind_map.keys():
-            if i not in tax_list:
-                logging.warning(f'{i} found in mapping file but not VCF!')
-        logging.error('Stopping to make corrections to mapping file!')
-        sys.exit()
+        check_individuals(ind_map, tax_list)
     logging.info(f'Found {n_sites} sites and {n_tax} individuals')
     return n_sites,n_tax
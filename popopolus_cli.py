@@ -48,7 +48,7 @@ def cli():
 @cli.command(context_settings={'help_option_names': ['-h','--help']})
 @click.argument('sample_sheet',type=str)
 @click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
-              help = 'name of the input vcf file. should not be compressed.'
+              help = 'name of the input vcf file. should not be compressed. - reads the VCF from standard input in a single pass.'
 )
 @click.option('-i', '--imputation_method', type=str, default='drop', required=False,
               help = 'decide how to impute missing data if at all. options are: drop, mean, and popmean'
@@ -68,12 +68,18 @@ def cli():
 @click.option('-o', '--output_dir', type=str, default='dummy', required=False,
               help = 'name of the directory where . will be a matrix of allele frequencies'
 )
+@click.option('-x', '--max_missing', type=float, default=1.0, required=False,
+              help = 'With drop, sites where more than this fraction of individuals have missing genotypes are removed. A genotype is missing below the minimum depth or genotype quality. 1 keeps every site.'
+)
 
-def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, pate_flag, output_dir):
+def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, pate_flag, output_dir, max_missing):
     from popopolus.utils import map_individuals
     from popopolus.utils import check_dir
     from popopolus.utils import get_vcf_dimensions
     from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    from popopolus.calculate_frequencies.calculate_frequencies import write_ind_freqs
+    from popopolus.calculate_frequencies.impute import average_missing
+    from popopolus.calculate_frequencies.impute import remove_missing
 
     start_time = time.process_time()
     logging.info(f'Begin at {start_time}')
@@ -83,11 +89,19 @@ def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count,
     n_sites, n_tax = get_vcf_dimensions(vcf_file, pate_flag, ind_map)
     logging.info(f'Calculating individual allele frequencies from {vcf_file}')
     if (imputation_method == 'drop'):
+        tax_list, ab_mat = get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, 'dummy')
+        ab_mat = remove_missing(ab_mat, max_missing, min_depth = minimum_depth, min_qual = minimum_quality)
+        if (output_dir != 'dummy'):
+            check_dir(output_dir)
+            logging.info(f'Matrix of allele frequencies for each individual without sites missing in more than {max_missing} of individuals will be written to: {output_dir}')
+            write_ind_freqs(tax_list, ab_mat, output_dir)
+    elif (imputation_method in ['mean', 'popmean']):
+        tax_list, ab_mat = get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, 'dummy')
+        average_missing(ab_mat, tax_list, ind_map, imputation_method, min_depth = minimum_depth, min_qual = minimum_quality)
         if (output_dir != 'dummy'):
             check_dir(output_dir)
-            logging.info(f'Matrix of allele frequencies for each individual will be written to: {output_dir}')
-        get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir)
-        
+            logging.info(f'Matrix of allele frequencies for each individual with {imputation_method} imputation will be written to: {output_dir}')
+            write_ind_freqs(tax_list, ab_mat, output_dir)
     else:
         click.echo(f'Warning: Imputation method {imputation_method} is not supported. Skipping allele frequencies.')
     end_time = time.process_time()
@@ -100,10 +114,10 @@ def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count,
 @cli.command(context_settings={'help_option_names': ['-h','--help']})
 @click.argument('sample_sheet',type=str)
 @click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
-              help = 'name of the input vcf file. should not be compressed.'
+              help = 'name of the input vcf file. should not be compressed. - reads the VCF from standard input in a single pass.'
 )
 @click.option('-i', '--imputation_method', type=str, default='drop', required=False,
-              help = 'decide how to impute missing data if at all. options are: drop, mean, and popmean'
+              help = 'how missing data are handled. Ploidy is estimated from the sites passing filters of each individual, so only drop is supported.'
 )
 @click.option('-d', '--minimum_depth', type=int, default=10, required=False,
               help = 'The minimum depth of a site to be treated as data'
@@ -118,7 +132,7 @@ def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count,
               help = 'name of the directory where . will be a matrix of allele frequencies'
 )
 @click.option('-m', '--estimation_method', type=str, default='gmm', required=False,
-              help = 'Method for fitting a model to allele balance data. Only option currently is gmm'
+              help = 'Method for fitting a model to allele balance data. gmm fits Gaussian mixtures with scikit-learn. normal, gamma, and lognormal fit mixtures of that distribution by EM with seeded restarts spread over --n_jobs processes. betabinom fits beta-binomial mixtures directly to the read counts of each site.'
 )
 @click.option('-p', '--ploidy_levels', type=str, default='2,4,6', required=False,
               help = 'The ploidies you would like to test. Only values between two and six are valid.'
@@ -132,30 +146,186 @@ def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count,
 @click.option('-e', '--model_contraints', type=int, default=2, required=False,
               help = 'What parameters should be contrained in the model. 0 is none, 1 is means, and 2 is means and weights.'
 )
-def estimate_ploidy(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, estimation_method, ploidy_levels, pate_flag, minimum_sites, model_contraints, output_dir):
+@click.option('--precision', type=str, default='float64', required=False,
+              help = 'Floating point precision for mixture fitting. Options are float64 and float32. Only the gmm method takes float32, which halves memory traffic and gives BIC values within a relative 1e-4 of float64.'
+)
+@click.option('--selection_method', type=str, default='full', required=False,
+              help = 'How to choose among ploidies. full fits every ploidy on all sites. halving drops clearly worse ploidies on growing subsamples of sites first and is only available with the gmm method.'
+)
+@click.option('--prescreen', type=bool, default=False, required=False,
+              help = 'Skip ploidies that cannot explain the peaks of the allele balance histogram before fitting mixtures?'
+)
+@click.option('--lmm_engine', type=str, default='numpy', required=False,
+              help = 'Engine for the linear mixed model test of polyploid fits. numpy is a fast closed-form random intercept model and statsmodels is kept for validation.'
+)
+@click.option('-b', '--bootstrap_replicates', type=int, default=0, required=False,
+              help = 'Number of block bootstrap replicates used to report support for each ploidy call in ploidy.txt. 0 skips the bootstrap.'
+)
+@click.option('--block_size', type=int, default=100, required=False,
+              help = 'Number of consecutive sites resampled together as one bootstrap block'
+)
+@click.option('-j', '--n_jobs', type=int, default=1, required=False,
+              help = 'Number of worker processes'
+)
+@click.option('--cache_dir', type=str, default=None, required=False,
+              help = 'Directory to cache gmm fits in. Only used by the gmm method. Rerunning with overlapping ploidy levels reuses the cached fits instead of refitting.'
+)
+@click.option('--cache_size', type=int, default=1024, required=False,
+              help = 'The largest size of the fit cache in megabytes. The least recently used fits are removed beyond it.'
+)
+@click.option('--plots', type=click.Choice(['none', 'summary', 'all']), default='all', required=False,
+              help = 'Which plots to draw. none skips plotting, summary draws only ploidy_summary.png, and all also draws the fit and LMM plots of every individual. Plots are rendered in the background while fitting continues.'
+)
+@click.option('--dpi', type=int, default=300, required=False,
+              help = 'Resolution of the PNG plots'
+)
+@click.option('--results_db', type=str, default=None, required=False,
+              help = 'SQLite database for run metadata, fitted models, ploidy calls, and LMM tests. Replaces the per-individual .fit.txt files and is appended to by later runs.'
+)
+@click.option('--quiet', type=bool, default=False, required=False,
+              help = 'Do not print LMM summaries and tests to the terminal?'
+)
+@click.option('--checkpoint_dir', type=str, default=None, required=False,
+              help = 'Directory for checkpoints. The allele balance arrays are cached there after reading the VCF and a completion record is written as each individual is fitted.'
+)
+@click.option('--resume', type=bool, default=False, required=False,
+              help = 'Resume from --checkpoint_dir? The cached arrays are reused if the VCF and filters are unchanged and finished individuals are skipped. An interrupted VCF read continues from its last checkpoint.'
+)
+@click.option('--layout', type=click.Choice(['sites', 'individuals']), default='sites', required=False,
+              help = 'Memory layout for fitting. sites filters the column of each individual as it is fitted. individuals first packs the sites every individual is fitted on into contiguous buffers in one pass over the arrays. Not used with --pipeline.'
+)
+@click.option('--pipeline', type=bool, default=False, required=False,
+              help = 'Overlap reading, parsing, fitting, and writing? A reader thread feeds parser processes and a writer thread saves results while --n_jobs processes fit individuals. The VCF is always read again, so only the fits are checkpointed.'
+)
+@click.option('--parse_jobs', type=int, default=1, required=False,
+              help = 'Number of VCF parser processes with --pipeline'
+)
+@click.option('--queue_depth', type=int, default=4, required=False,
+              help = 'The most VCF blocks or fitted individuals waiting between two pipeline stages with --pipeline'
+)
+@click.option('--shared_dir', type=str, default=None, required=False,
+              help = 'Directory for a memory-mapped file that shares the allele balance arrays with the fitting processes of --pipeline. By default they are shared through /dev/shm.'
+)
+def estimate_ploidy(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, estimation_method, ploidy_levels, pate_flag, minimum_sites, model_contraints, precision, selection_method, prescreen, lmm_engine, bootstrap_replicates, block_size, n_jobs, cache_dir, cache_size, plots, dpi, results_db, quiet, checkpoint_dir, resume, layout, pipeline, parse_jobs, queue_depth, shared_dir, output_dir):
     from popopolus.utils import map_individuals
     from popopolus.utils import check_dir
     from popopolus.utils import get_vcf_dimensions
     from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
     from popopolus.fit_mixtures.fit_mixtures import est_ploidy
+    from popopolus.checkpoint import ingestion_fingerprint, save_ingestion, load_ingestion
+    from popopolus.calculate_frequencies.calculate_frequencies import ingestion_checkpoint
 
     start_time = time.process_time()
     logging.info(f'Begin at {start_time}')
+    if resume and (checkpoint_dir is None):
+        click.echo('Warning: --resume needs --checkpoint_dir. Starting from the beginning.')
+        resume = False
     logging.info(f'Checking all individuals in {sample_sheet} are present in {vcf_file}')
     ind_map = map_individuals(sample_sheet)
-    logging.info(f'Checking dimensions of VCF')
-    n_sites, n_tax = get_vcf_dimensions(vcf_file, pate_flag, ind_map)
-    logging.info(f'Calculating individual allele frequencies from {vcf_file}')
     if (imputation_method == 'drop'):
         if (output_dir != 'dummy'):
             check_dir(output_dir)
-            logging.info(f'Matrix of allele frequencies for each individual will be written to: {output_dir}')
-            tax_list, ab_mat = get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir)
-            ploidy_df = est_ploidy(tax_list, ab_mat, estimation_method, ploidy_levels, minimum_sites, model_contraints, output_dir)
-            logging.info('Ploidy estimates returned based on Gaussian mixture models')
+            if checkpoint_dir is not None:
+                check_dir(checkpoint_dir)
+            if pipeline:
+                from popopolus.fit_mixtures.pipeline import est_ploidy_pipeline
+                ploidy_df, _ = est_ploidy_pipeline(ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, estimation_method, ploidy_levels, minimum_sites, model_contraints, output_dir, precision, selection_method, prescreen, lmm_engine, bootstrap_replicates, block_size, cache_dir, cache_size * 1024 ** 2, plots, dpi, results_db, quiet, checkpoint_dir, resume, parse_jobs, n_jobs, queue_depth = queue_depth, shared_dir = shared_dir)
+            else:
+                cached = None
+                # A VCF on standard input cannot be read again, so only the fits are checkpointed
+                ingestion_dir = checkpoint_dir if vcf_file != '-' else None
+                if ingestion_dir is not None:
+                    fingerprint = ingestion_fingerprint(vcf_file, ind_map, minimum_depth=minimum_depth, minimum_count=minimum_count, minimum_quality=minimum_quality, pate_flag=pate_flag)
+                    if resume:
+                        cached = load_ingestion(ingestion_dir, fingerprint)
+                if cached is not None:
+                    tax_list, ab_mat = cached
+                else:
+                    # An interrupted read knows the dimensions of the VCF, so only the unread part is scanned again
+                    state = None
+                    if resume and (ingestion_dir is not None):
+                        state = ingestion_checkpoint(ingestion_dir, vcf_file, ind_map, minimum_depth, minimum_count, minimum_quality, pate_flag).load()
+                    if state is not None:
+                        n_sites, n_tax = state['n_sites_total'], state['n_tax_total']
+                    else:
+                        logging.info(f'Checking dimensions of VCF')
+                        n_sites, n_tax = get_vcf_dimensions(vcf_file, pate_flag, ind_map)
+                    logging.info(f'Calculating individual allele frequencies from {vcf_file}')
+                    logging.info(f'Matrix of allele frequencies for each individual will be written to: {output_dir}')
+                    tax_list, ab_mat = get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir, checkpoint_dir = ingestion_dir, resume = resume)
+                    if ingestion_dir is not None:
+                        save_ingestion(ingestion_dir, tax_list, ab_mat, fingerprint)
+                ploidy_df = est_ploidy(tax_list, ab_mat, estimation_method, ploidy_levels, minimum_sites, model_contraints, output_dir, precision, selection_method, prescreen, lmm_engine, bootstrap_replicates, block_size, n_jobs, minimum_count, cache_dir, cache_size * 1024 ** 2, plots, dpi, results_db, quiet, checkpoint_dir, resume, layout)
+            logging.info(f'Ploidy estimates returned based on {estimation_method} mixture models')
             logging.info(ploidy_df.head())
     else:
-        click.echo(f'Warning: Imputation method {imputation_method} is not supported. Skipping allele frequencies.')
+        click.echo(f'Warning: Imputation method {imputation_method} is not supported for ploidy estimation. Use drop. Skipping ploidy estimation.')
+    end_time = time.process_time()
+    logging.info(f'End at {end_time}')
+    compute_time = (end_time - start_time) / 60
+    logging.info(f'Total compute time was {compute_time} minutes')
+
+
+
+@cli.command(context_settings={'help_option_names': ['-h','--help']})
+@click.argument('sample_sheet',type=str)
+@click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
+              help = 'name of the input vcf file. should not be compressed. - reads the VCF from standard input in a single pass.'
+)
+@click.option('-d', '--minimum_depth', type=int, default=10, required=False,
+              help = 'The minimum depth of a site to be treated as data'
+)
+@click.option('-c', '--minimum_count', type=int, default=3, required=False,
+              help = 'The minimum count of the minor allele for a site to be treated as data'
+)
+@click.option('-q', '--minimum_quality', type=int, default=40, required=False,
+              help = 'The minimum phred-scaled genotype quality score'
+)
+@click.option('-o', '--output_dir', type=str, default='dummy', required=False,
+              help = 'name of the directory where windows.txt will be a table of ploidy in each window for each individual'
+)
+@click.option('-p', '--ploidy_levels', type=str, default='2,3,4', required=False,
+              help = 'The ploidies you would like to test in each window. Only values between two and six are valid.'
+)
+@click.option('-f', '--pate_flag', type=bool, default=False, required=False,
+              help = 'Is the VCF a product of the PATE pipeline?'
+)
+@click.option('-s', '--minimum_sites', type=int, default=50, required=False,
+              help = 'What are the minimum number of data points in a window needed to fit a mixture model?'
+)
+@click.option('-e', '--model_contraints', type=int, default=1, required=False,
+              help = 'What parameters should be contrained in the model. Means are always fixed. 1 estimates weights and 2 fixes them.'
+)
+@click.option('-w', '--window_size', type=int, default=1000000, required=False,
+              help = 'Window length in base pairs'
+)
+@click.option('--step', type=int, default=None, required=False,
+              help = 'Distance between the starts of consecutive windows in base pairs. Defaults to the window size. The window size must be a multiple of it.'
+)
+@click.option('-j', '--n_jobs', type=int, default=1, required=False,
+              help = 'Number of worker processes'
+)
+def scan_windows(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, ploidy_levels, pate_flag, minimum_sites, model_contraints, window_size, step, n_jobs, output_dir):
+    from popopolus.utils import map_individuals
+    from popopolus.utils import check_dir
+    from popopolus.utils import get_vcf_dimensions
+    from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    from popopolus.fit_mixtures.windows import scan_windows as scan_genome_windows
+
+    start_time = time.process_time()
+    logging.info(f'Begin at {start_time}')
+    logging.info(f'Checking all individuals in {sample_sheet} are present in {vcf_file}')
+    ind_map = map_individuals(sample_sheet)
+    logging.info(f'Checking dimensions of VCF')
+    n_sites, n_tax = get_vcf_dimensions(vcf_file, pate_flag, ind_map)
+    if (output_dir != 'dummy'):
+        check_dir(output_dir)
+        logging.info(f'Calculating individual allele frequencies and site coordinates from {vcf_file}')
+        tax_list, ab_mat, coordinates = get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, 'dummy', keep_coordinates = True)
+        window_df = scan_genome_windows(tax_list, ab_mat, coordinates, ploidy_levels, model_contraints, output_dir, window_size, step, minimum_sites, n_jobs)
+        logging.info(f'Ploidy estimated in {len(window_df)} windows written to {output_dir}/windows.txt')
+    else:
+        click.echo('Warning: No output directory given. Skipping window scan.')
     end_time = time.process_time()
     logging.info(f'End at {end_time}')
     compute_time = (end_time - start_time) / 60
@@ -164,12 +334,200 @@ def estimate_ploidy(sample_sheet, vcf_file, minimum_depth, minimum_count, minimu
 ##----------------
 ## Calculate population-level allele frequencies for fst and genotype-environment association analyses
 ##----------------
-#@click.argument('sample_sheet',type=str)
-#@click.option('-v', '--vcf_file', type=str, default='dummy.vcf',
-#              help = 'name of the input vcf file. should not be compressed.'
-#)
-#@click.option('-o', '--output_file', type=str, default='samples.vcf',
-#              help = 'name of the output text file. will be a matrix of allele frequencies'
-#)
-#def population_frequencies(sample_sheet, vcf_file, output_file):
-#    pass
+@cli.command(context_settings={'help_option_names': ['-h','--help']})
+@click.argument('sample_sheet',type=str)
+@click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
+              help = 'name of the input vcf file. should not be compressed. - reads the VCF from standard input in a single pass.'
+)
+@click.option('-o', '--output_file', type=str, default='population_frequencies.txt', required=False,
+              help = 'name of the output text file. will be a matrix of allele frequencies with a column for each population in the sample sheet'
+)
+@click.option('-d', '--minimum_depth', type=int, default=10, required=False,
+              help = 'The minimum depth of an individual at a site for its reads to be counted'
+)
+@click.option('-c', '--minimum_count', type=int, default=3, required=False,
+              help = 'The minimum count of the minor allele across all populations for a site to be written'
+)
+@click.option('-q', '--minimum_quality', type=int, default=20, required=False,
+              help = 'The minimum phred-scaled genotype quality score of an individual at a site for its reads to be counted'
+)
+@click.option('-f', '--pate_flag', type=bool, default=False, required=False,
+              help = 'Is the VCF a product of the PATE pipeline?'
+)
+@click.option('-b', '--block_size', type=int, default=10000, required=False,
+              help = 'Number of sites read and written at once'
+)
+def population_frequencies(sample_sheet, vcf_file, output_file, minimum_depth, minimum_count, minimum_quality, pate_flag, block_size):
+    from popopolus.utils import map_individuals
+    from popopolus.calculate_frequencies.calculate_frequencies import get_pop_freqs
+
+    start_time = time.process_time()
+    logging.info(f'Begin at {start_time}')
+    ind_map = map_individuals(sample_sheet)
+    logging.info(f'Calculating population allele frequencies from {vcf_file}')
+    populations, n_written = get_pop_freqs(ind_map, vcf_file, minimum_depth, minimum_count, output_file, pate_flag, minimum_quality, block_size)
+    logging.info(f'Allele frequencies of {len(populations)} populations at {n_written} sites written to {output_file}')
+    end_time = time.process_time()
+    logging.info(f'End at {end_time}')
+    compute_time = (end_time - start_time) / 60
+    logging.info(f'Total compute time was {compute_time} minutes')
+
+
+
+##----------------
+## Differentiation among populations
+##----------------
+@cli.command(context_settings={'help_option_names': ['-h','--help']})
+@click.argument('sample_sheet',type=str)
+@click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
+              help = 'name of the input vcf file. should not be compressed. sites must be sorted for windowed Fst.'
+)
+@click.option('-o', '--output_dir', type=str, default='dummy', required=False,
+              help = 'name of the directory where fst.txt and fst.windows.txt will be written'
+)
+@click.option('-d', '--minimum_depth', type=int, default=10, required=False,
+              help = 'The minimum depth of an individual at a site for its reads to be counted'
+)
+@click.option('-c', '--minimum_count', type=int, default=3, required=False,
+              help = 'The minimum count of the minor allele across all populations for a site to be used'
+)
+@click.option('-q', '--minimum_quality', type=int, default=20, required=False,
+              help = 'The minimum phred-scaled genotype quality score of an individual at a site for its reads to be counted'
+)
+@click.option('-f', '--pate_flag', type=bool, default=False, required=False,
+              help = 'Is the VCF a product of the PATE pipeline?'
+)
+@click.option('-w', '--window_size', type=int, default=1000000, required=False,
+              help = 'Window length in base pairs for windowed Fst'
+)
+@click.option('-b', '--block_size', type=int, default=10000, required=False,
+              help = 'Number of sites read at once'
+)
+def fst(sample_sheet, vcf_file, output_dir, minimum_depth, minimum_count, minimum_quality, pate_flag, window_size, block_size):
+    from popopolus.utils import map_individuals
+    from popopolus.utils import check_dir
+    from popopolus.population_structure.fst import calculate_fst
+
+    start_time = time.process_time()
+    logging.info(f'Begin at {start_time}')
+    ind_map = map_individuals(sample_sheet)
+    if (output_dir != 'dummy'):
+        check_dir(output_dir)
+        logging.info(f'Calculating Hudson Fst between populations in {sample_sheet} from {vcf_file}')
+        fst_df = calculate_fst(ind_map, vcf_file, minimum_depth, minimum_count, output_dir, pate_flag, minimum_quality, window_size, block_size)
+        logging.info(fst_df.head())
+    else:
+        click.echo('Warning: No output directory given. Skipping Fst.')
+    end_time = time.process_time()
+    logging.info(f'End at {end_time}')
+    compute_time = (end_time - start_time) / 60
+    logging.info(f'Total compute time was {compute_time} minutes')
+
+
+
+@cli.command(context_settings={'help_option_names': ['-h','--help']})
+@click.argument('sample_sheet',type=str)
+@click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
+              help = 'name of the input vcf file. should not be compressed. The file is read once per pass, so standard input is not supported.'
+)
+@click.option('-o', '--output_dir', type=str, default='dummy', required=False,
+              help = 'name of the directory where pca.eigenvec.txt, pca.eigenval.txt, and pca.loadings.txt will be written'
+)
+@click.option('-d', '--minimum_depth', type=int, default=10, required=False,
+              help = 'The minimum depth of a genotype to be treated as data. Homozygous genotypes count as data.'
+)
+@click.option('-q', '--minimum_quality', type=int, default=20, required=False,
+              help = 'The minimum phred-scaled genotype quality score'
+)
+@click.option('-f', '--pate_flag', type=bool, default=False, required=False,
+              help = 'Is the VCF a product of the PATE pipeline?'
+)
+@click.option('-k', '--n_components', type=int, default=10, required=False,
+              help = 'Number of principal components'
+)
+@click.option('--n_iter', type=int, default=1, required=False,
+              help = 'Number of power iterations of the randomized SVD. Each one is an extra pass over the sites.'
+)
+@click.option('--scale', type=bool, default=True, required=False,
+              help = 'Scale every site by the square root of p(1-p) of its mean allele balance?'
+)
+@click.option('-b', '--block_size', type=int, default=10000, required=False,
+              help = 'Number of sites held in memory at once'
+)
+def pca(sample_sheet, vcf_file, output_dir, minimum_depth, minimum_quality, pate_flag, n_components, n_iter, scale, block_size):
+    from popopolus.utils import map_individuals
+    from popopolus.utils import check_dir
+    from popopolus.utils import check_individuals
+    from popopolus.calculate_frequencies.vcf_blocks import read_vcf_samples, individual_columns, iter_genotype_blocks
+    from popopolus.population_structure.pca import randomized_pca, write_pca
+
+    start_time = time.process_time()
+    logging.info(f'Begin at {start_time}')
+    ind_map = map_individuals(sample_sheet)
+    if (vcf_file == '-'):
+        click.echo('Error: PCA reads the VCF once per pass and cannot read it from standard input. Skipping PCA.')
+    elif (output_dir != 'dummy'):
+        check_dir(output_dir)
+        tax_list, columns = individual_columns(read_vcf_samples(vcf_file, pate_flag), ind_map)
+        check_individuals(ind_map, tax_list)
+        blocks = lambda: iter_genotype_blocks(vcf_file, columns, pate_flag, minimum_depth, minimum_quality, block_size)
+        scores, eigenvalues, explained = randomized_pca(blocks, len(tax_list), n_components, n_iter = n_iter, scale = scale, loadings_file = f'{output_dir}/pca.loadings.txt')
+        write_pca(tax_list, scores, eigenvalues, explained, output_dir)
+        logging.info(f'Principal components of {len(tax_list)} individuals written to {output_dir}')
+    else:
+        click.echo('Warning: No output directory given. Skipping PCA.')
+    end_time = time.process_time()
+    logging.info(f'End at {end_time}')
+    compute_time = (end_time - start_time) / 60
+    logging.info(f'Total compute time was {compute_time} minutes')
+
+
+
+@cli.command(context_settings={'help_option_names': ['-h','--help']})
+@click.argument('sample_sheet',type=str)
+@click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
+              help = 'name of the input vcf file. should not be compressed. - reads the VCF from standard input in a single pass.'
+)
+@click.option('-o', '--output_dir', type=str, default='dummy', required=False,
+              help = 'name of the directory where distance.txt, kinship.txt, and inbreeding.txt will be written'
+)
+@click.option('-d', '--minimum_depth', type=int, default=10, required=False,
+              help = 'The minimum depth of a genotype to be treated as data. Homozygous genotypes count as data.'
+)
+@click.option('-q', '--minimum_quality', type=int, default=20, required=False,
+              help = 'The minimum phred-scaled genotype quality score'
+)
+@click.option('-f', '--pate_flag', type=bool, default=False, required=False,
+              help = 'Is the VCF a product of the PATE pipeline?'
+)
+@click.option('--use_dosage', type=bool, default=False, required=False,
+              help = 'Round allele balance to the nearest allele dosage of each individual before comparing? Ploidy is read from a ploidy column of the sample sheet and defaults to 2.'
+)
+@click.option('-b', '--block_size', type=int, default=10000, required=False,
+              help = 'Number of sites held in memory at once'
+)
+def distance(sample_sheet, vcf_file, output_dir, minimum_depth, minimum_quality, pate_flag, use_dosage, block_size):
+    from popopolus.utils import map_individuals
+    from popopolus.utils import check_dir
+    from popopolus.utils import check_individuals
+    from popopolus.calculate_frequencies.vcf_blocks import read_vcf_samples, individual_columns, iter_genotype_blocks
+    from popopolus.population_structure.distance import individual_ploidy, accumulate_distances, write_distances
+
+    start_time = time.process_time()
+    logging.info(f'Begin at {start_time}')
+    ind_map = map_individuals(sample_sheet)
+    if (output_dir != 'dummy'):
+        check_dir(output_dir)
+        tax_list, columns = individual_columns(read_vcf_samples(vcf_file, pate_flag), ind_map)
+        check_individuals(ind_map, tax_list)
+        ploidy = individual_ploidy(tax_list, ind_map)
+        blocks = iter_genotype_blocks(vcf_file, columns, pate_flag, minimum_depth, minimum_quality, block_size)
+        distance_mat, kinship_mat, n_shared = accumulate_distances(blocks, ploidy, use_dosage)
+        write_distances(tax_list, ploidy, distance_mat, kinship_mat, n_shared, output_dir)
+        logging.info(f'Distance and kinship matrices of {len(tax_list)} individuals written to {output_dir}')
+    else:
+        click.echo('Warning: No output directory given. Skipping distances.')
+    end_time = time.process_time()
+    logging.info(f'End at {end_time}')
+    compute_time = (end_time - start_time) / 60
+    logging.info(f'Total compute time was {compute_time} minutes')
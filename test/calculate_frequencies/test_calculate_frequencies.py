@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+import tempfile
+from popopolus.calculate_frequencies.calculate_frequencies import get_pop_freqs
+
+def write_test_vcf(vcf_file, ref, alt, gq, sample_names, filters=None):
+    """
+    Write a minimal multisample VCF with allelic depths and genotype qualities
+    """
+    n_sites, n_samples = ref.shape
+    with open(vcf_file, 'w') as outfile:
+        outfile.write('##fileformat=VCFv4.2\n')
+        outfile.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(sample_names) + '\n')
+        for j in range(n_sites):
+            site_filter = 'PASS' if filters is None else filters[j]
+            genotypes = [f'0/1:{ref[j, k]},{alt[j, k]}:{ref[j, k] + alt[j, k]}:{gq[j, k]}:0,0,0' for k in range(n_samples)]
+            outfile.write(f'chr{1 + j // 50}\t{j + 1}\t.\tA\tT\t50\t{site_filter}\t.\tGT:AD:DP:GQ:PL\t' + '\t'.join(genotypes) + '\n')
+
+def test_get_pop_freqs():
+    """
+    Test that streamed population allele frequencies match pooling reads site by site, across block boundaries
+    """
+    rng = np.random.default_rng(7)
+    n_sites = 120
+    sample_names = ['a1', 'b1', 'a2', 'c1', 'b2', 'skip']
+    ind_map = {'a1': {'population': 'A'}, 'a2': {'population': 'A'}, 'b1': {'population': 'B'}, 'b2': {'population': 'B'}, 'c1': {'population': 'C'}}
+    ref = rng.integers(0, 20, (n_sites, 6))
+    alt = rng.integers(0, 20, (n_sites, 6))
+    gq = rng.integers(0, 60, (n_sites, 6))
+    filters = np.where(rng.random(n_sites) < 0.1, 'LowQual', 'PASS')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_test_vcf(f'{temp_dir}/test.vcf', ref, alt, gq, sample_names, filters)
+        populations, n_written = get_pop_freqs(ind_map, f'{temp_dir}/test.vcf', 10, 3, f'{temp_dir}/freqs.txt', min_qual = 20, block_size = 16)
+        freqs = pd.read_csv(f'{temp_dir}/freqs.txt', sep = '\t')
+    assert populations == ['A', 'B', 'C']
+    assert list(freqs.columns) == ['chrom', 'pos', 'A', 'B', 'C']
+    expected = []
+    for j in np.flatnonzero(filters == 'PASS'):
+        passing = ((ref[j] + alt[j]) >= 10) & (gq[j] >= 20)
+        pop_alt = {}
+        pop_depth = {}
+        for k, name in enumerate(sample_names):
+            if (name in ind_map) and passing[k]:
+                pop = ind_map[name]['population']
+                pop_alt[pop] = pop_alt.get(pop, 0) + alt[j, k]
+                pop_depth[pop] = pop_depth.get(pop, 0) + ref[j, k] + alt[j, k]
+        total_alt = sum(pop_alt.values())
+        if min(total_alt, sum(pop_depth.values()) - total_alt) >= 3:
+            expected.append([j + 1] + [pop_alt[p] / pop_depth[p] if p in pop_depth else np.nan for p in populations])
+    expected = np.array(expected)
+    assert n_written == len(freqs) == len(expected)
+    np.testing.assert_array_equal(freqs['pos'].to_numpy(), expected[:, 0])
+    np.testing.assert_allclose(freqs[populations].to_numpy(), expected[:, 1:], rtol = 1e-5)
+
+def test_parse_allele_counts():
+    """
+    Test that block parsing reads allelic depths and genotype qualities, counts malformed genotypes as zero reads,
+    and that population sums give zero for a population without columns
+    """
+    from popopolus.calculate_frequencies.vcf_blocks import parse_allele_counts, population_sums
+    genotypes = ['0/1:3,4:7:20:0,0,0', './.:.:.:.:.', '0/1:3,4:7:20', '0/1:3,4,2:9:35:0', '0/1:5,6:11:.:0', './.']
+    records = [['chr1', '1', '.', 'A', 'T', '50', 'PASS', '.', 'GT:AD:DP:GQ:PL'] + genotypes]
+    ref, alt, gq = parse_allele_counts(records, np.arange(6))
+    np.testing.assert_array_equal(ref, [[3, 0, 0, 3, 5, 0]])
+    np.testing.assert_array_equal(alt, [[4, 0, 0, 4, 6, 0]])
+    np.testing.assert_array_equal(gq, [[20, 0, 0, 35, 0, 0]])
+    values = np.arange(12).reshape(2, 6)
+    np.testing.assert_array_equal(population_sums(values, [0, 2, 2, 6]), [[1, 0, 14, 0], [13, 0, 38, 0]])
+
+def test_average_missing():
+    """
+    Test that mean and popmean imputation fill genotypes failing the depth or quality filters in place, that homozygous
+    genotypes count as data, and that remove_missing compacts in place
+    """
+    from popopolus.calculate_frequencies.impute import average_missing, remove_missing
+    from popopolus.calculate_frequencies.vcf_blocks import parse_ind_block
+    rng = np.random.default_rng(11)
+    tax_list = ['a1', 'a2', 'a3', 'b1', 'b2']
+    ind_map = {tax: {'population': tax[0]} for tax in tax_list}
+    ab = rng.random((25, 5)).astype(np.float32)
+    ab[rng.random((25, 5)) < 0.3] = 0
+    ab[rng.random((25, 5)) < 0.2] = 1
+    depth = np.where(rng.random((25, 5)) < 0.15, 5, 30)
+    gq = np.where(rng.random((25, 5)) < 0.15, 5, 60)
+    depth[3] = 5
+    gq[4, 3:] = 5
+    valid = (depth >= 10) & (gq >= 20)
+    # The passing row of get_ind_freqs only passes heterozygotes and must not decide what is missing
+    passing = valid & (ab > 0) & (ab < 1)
+    for method in ['mean', 'popmean']:
+        ab_dat = np.array([ab, depth, gq, passing]).astype(np.float32)
+        buffer = ab_dat.ctypes.data
+        n_imputed = average_missing(ab_dat, tax_list, ind_map, method, chunk_size = 7, min_depth = 10, min_qual = 20)
+        assert ab_dat.ctypes.data == buffer
+        assert n_imputed == (~valid).sum() - 5
+        np.testing.assert_array_equal(ab_dat[0][valid], ab[valid])
+        np.testing.assert_array_equal(ab_dat[0, 3], ab[3])
+        for j in range(25):
+            for i in np.flatnonzero(~valid[j]):
+                if valid[j].any():
+                    group = valid[j] & np.array([(method == 'mean') or (tax[0] == tax_list[i][0]) for tax in tax_list])
+                    if not group.any():
+                        group = valid[j]
+                    assert np.isclose(ab_dat[0, j, i], ab[j, group].mean())
+    ab_dat = np.array([ab, depth, gq, passing]).astype(np.float32)
+    compact = remove_missing(ab_dat, max_missing = 0.2, chunk_size = 4, min_depth = 10, min_qual = 20)
+    keep = (~valid).sum(axis = 1) <= 1
+    assert np.shares_memory(compact, ab_dat)
+    np.testing.assert_array_equal(compact[0], ab[keep])
+    np.testing.assert_array_equal(compact[3], passing[keep])
+    # Two homozygous reference genotypes, a heterozygote, and a homozygous alternate genotype, all well covered
+    records = [['chr1', '1', '.', 'A', 'T', '50', 'PASS', '.', 'GT:AD:DP:GQ:PL', '0/0:30,0:30:60:0', '0/0:30,0:30:60:0', '0/1:15,15:30:60:0', '1/1:0,30:30:60:0']]
+    ab_dat = np.array(parse_ind_block(records, np.arange(4), 10, 3, 20)).astype(np.float32)
+    assert average_missing(ab_dat, method = 'mean', min_depth = 10, min_qual = 20) == 0
+    np.testing.assert_array_equal(ab_dat[0, 0], [0, 0, 0.5, 1])
+    assert remove_missing(ab_dat, 0.5, min_depth = 10, min_qual = 20).shape[1] == 1
+
+def test_get_ind_freqs_resume():
+    """
+    Test that VCF ingestion interrupted after a checkpoint continues from the saved byte offset and gives the same arrays
+    """
+    import os
+    import pytest
+    import popopolus.checkpoint as checkpoint
+    from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    rng = np.random.default_rng(23)
+    n_sites = 130
+    sample_names = ['a1', 'a2', 'b1']
+    ind_map = {name: {'population': name[0]} for name in sample_names}
+    ref = rng.integers(0, 30, (n_sites, 3))
+    alt = rng.integers(0, 30, (n_sites, 3))
+    gq = rng.integers(0, 60, (n_sites, 3))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, ref, alt, gq, sample_names)
+        expected_tax, expected, expected_coordinates = get_ind_freqs(n_sites, 3, ind_map, vcf_file, 10, 3, 20, False, 'dummy', keep_coordinates = True)
+        original_save = checkpoint.IngestionCheckpoint.save
+        def save_then_fail(self, offset, n_sites, arrays, extra):
+            original_save(self, offset, n_sites, arrays, extra)
+            if n_sites >= 80:
+                raise KeyboardInterrupt
+        checkpoint.IngestionCheckpoint.save = save_then_fail
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                get_ind_freqs(n_sites, 3, ind_map, vcf_file, 10, 3, 20, False, 'dummy', checkpoint_dir = temp_dir, checkpoint_interval = 40)
+        finally:
+            checkpoint.IngestionCheckpoint.save = original_save
+        state = checkpoint.IngestionCheckpoint(temp_dir, vcf_file, {}).part_dir
+        assert len([name for name in os.listdir(state) if name.endswith('.npz')]) == 2
+        tax_list, ab_dat, coordinates = get_ind_freqs(n_sites, 3, ind_map, vcf_file, 10, 3, 20, False, 'dummy', keep_coordinates = True, checkpoint_dir = temp_dir, resume = True, checkpoint_interval = 40)
+        assert not os.path.exists(state)
+    assert tax_list == expected_tax
+    np.testing.assert_array_equal(ab_dat, expected)
+    assert coordinates[0] == expected_coordinates[0]
+    np.testing.assert_array_equal(coordinates[2], expected_coordinates[2])
+
+def test_read_vcf_from_stdin(monkeypatch):
+    """
+    Test that a VCF streamed on standard input gives the same arrays and population frequencies as the file, with arrays grown while reading
+    """
+    import io
+    import sys
+    from popopolus.utils import get_vcf_dimensions
+    from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    rng = np.random.default_rng(29)
+    n_sites = 90
+    sample_names = ['a1', 'b1', 'a2']
+    ind_map = {name: {'population': name[0]} for name in sample_names}
+    ref = rng.integers(0, 30, (n_sites, 3))
+    alt = rng.integers(0, 30, (n_sites, 3))
+    gq = rng.integers(0, 60, (n_sites, 3))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, ref, alt, gq, sample_names, np.where(rng.random(n_sites) < 0.2, 'LowQual', 'PASS'))
+        with open(vcf_file, 'rb') as fh:
+            vcf_bytes = fh.read()
+        n_pass, n_tax = get_vcf_dimensions(vcf_file, False, ind_map)
+        expected_tax, expected, expected_coordinates = get_ind_freqs(n_pass, n_tax, ind_map, vcf_file, 10, 3, 20, False, 'dummy', keep_coordinates = True)
+        get_pop_freqs(ind_map, vcf_file, 10, 3, f'{temp_dir}/file.txt', block_size = 16)
+        assert get_vcf_dimensions('-', False, ind_map) == (0, 3)
+        monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(io.BytesIO(vcf_bytes)))
+        tax_list, ab_dat, coordinates = get_ind_freqs(7, 3, ind_map, '-', 10, 3, 20, False, 'dummy', keep_coordinates = True)
+        monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(io.BytesIO(vcf_bytes)))
+        get_pop_freqs(ind_map, '-', 10, 3, f'{temp_dir}/stdin.txt', block_size = 16)
+        with open(f'{temp_dir}/file.txt') as file_freqs, open(f'{temp_dir}/stdin.txt') as stdin_freqs:
+            assert file_freqs.read() == stdin_freqs.read()
+    assert tax_list == expected_tax
+    np.testing.assert_array_equal(ab_dat, expected)
+    np.testing.assert_array_equal(coordinates[2], expected_coordinates[2])
+
+def test_est_ploidy_pipeline():
+    """
+    Test that the pipelined run writes the same ploidy calls and allele frequency files as get_ind_freqs followed by est_ploidy
+    """
+    import os
+    import sqlite3
+    from popopolus.utils import get_vcf_dimensions
+    from popopolus.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    from popopolus.fit_mixtures.fit_mixtures import est_ploidy
+    from popopolus.fit_mixtures.pipeline import est_ploidy_pipeline
+    rng = np.random.default_rng(31)
+    n_sites = 700
+    sample_names = ['d1', 't1', 'd2', 't2']
+    ind_map = {name: {'population': name[0]} for name in sample_names}
+    depth = rng.integers(30, 80, (n_sites, 4))
+    balance = np.full((n_sites, 4), 0.5)
+    balance[:, [1, 3]] = rng.choice([0.25, 0.5, 0.75], (n_sites, 2))
+    alt = rng.binomial(depth, balance)
+    gq = rng.integers(10, 60, (n_sites, 4))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, depth - alt, alt, gq, sample_names, np.where(rng.random(n_sites) < 0.1, 'LowQual', 'PASS'))
+        os.makedirs(f'{temp_dir}/sequential')
+        os.makedirs(f'{temp_dir}/pipeline')
+        n_pass, n_tax = get_vcf_dimensions(vcf_file, False, ind_map)
+        tax_list, ab_dat = get_ind_freqs(n_pass, n_tax, ind_map, vcf_file, 10, 3, 20, False, f'{temp_dir}/sequential')
+        expected_df = est_ploidy(tax_list, ab_dat, 'gmm', '2,4', 50, 1, f'{temp_dir}/sequential', minimum_count = 3, plots = 'none', quiet = True)
+        ploidy_df, stats = est_ploidy_pipeline(ind_map, vcf_file, 10, 3, 20, False, 'gmm', '2,4', 50, 1, f'{temp_dir}/pipeline', plots = 'none', quiet = True,
+                                               results_db = f'{temp_dir}/results.db', parse_jobs = 2, fit_jobs = 2, lines_per_block = 64, queue_depth = 2)
+        for name in [f'{tax}.txt' for tax in tax_list]:
+            with open(f'{temp_dir}/sequential/{name}') as sequential, open(f'{temp_dir}/pipeline/{name}') as pipelined:
+                assert sequential.read() == pipelined.read()
+        # GMM fits are initialized from the unseeded global numpy random state, so the LMM p-values differ in their last
+        # digits between any two runs on the same data, two sequential est_ploidy runs included. Only the calls are compared.
+        with open(f'{temp_dir}/sequential/ploidy.txt') as sequential, open(f'{temp_dir}/pipeline/ploidy.txt') as pipelined:
+            assert [line.split()[:2] for line in sequential] == [line.split()[:2] for line in pipelined]
+        connection = sqlite3.connect(f'{temp_dir}/results.db')
+        assert connection.execute('SELECT COUNT(*) FROM calls').fetchone()[0] == 4
+        assert connection.execute('SELECT COUNT(*) FROM models').fetchone()[0] == 8
+        connection.close()
+    assert ploidy_df.equals(expected_df)
+    assert list(ploidy_df['Ploidy']) == [2, 4, 2, 4]
+    assert stats['read'].items == stats['parse'].items == 11
+    assert stats['fit'].items == stats['write'].items - 1 == 4
+    assert all(0 <= stage.utilisation(1e6) <= 1 for stage in stats.values())
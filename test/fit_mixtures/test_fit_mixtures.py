@@ -1,7 +1,11 @@
 import numpy as np
+import pytest
 import tempfile
-from popopolus.fit_mixtures.gmm import fit_gmm_to_ab
+import os
+from popopolus.fit_mixtures.gmm import fit_gmm_to_ab, get_fixed_params, partial_fit_gmm_to_ab, select_ploidy_halving, FLOAT32_BIC_RTOL
+from popopolus.fit_mixtures.gmm_fixed_means import GaussianMixtureFixedMeans
 from popopolus.fit_mixtures.lmm import fit_mixed_model_ab
+from popopolus.fit_mixtures.prescreen import prescreen_ploidy
 
 def test_fit_gmm_to_ab():
     """
@@ -30,6 +34,74 @@ def test_fit_gmm_to_ab():
             ploidy_results.append(best_n)
         assert ploidy_results == [4,4,4,4]
 
+def test_fit_gmm_to_ab_float32():
+    """
+    Test that the float32 path stays in float32 and agrees with float64 on BIC and ploidy
+    """
+    np.random.seed(3232)
+    dat = np.concatenate([np.random.normal(0.25, 0.05, 500), np.random.normal(0.5, 0.05, 1000), np.random.normal(0.75, 0.05, 500)]).reshape(-1, 1)
+    for n_components in range(1, 6):
+        means, weights = get_fixed_params(n_components)
+        bics = []
+        for dtype in [np.float64, np.float32]:
+            gmm = GaussianMixtureFixedMeans(n_components = n_components, means_init = means, random_state = 0)
+            gmm.fit(dat.astype(dtype))
+            if dtype == np.float32:
+                assert gmm.covariances_.dtype == np.float32
+                assert gmm.weights_.dtype == np.float32
+                assert gmm.score_samples(dat.astype(dtype)).dtype == np.float32
+            bics.append(gmm.bic(dat.astype(dtype)))
+        assert np.isclose(bics[0], bics[1], rtol = FLOAT32_BIC_RTOL, atol = 0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        best_n, predictions = fit_gmm_to_ab(ind_name = 'float32', dat = dat, ploidy = [2,3,4,5,6], model_constraints = 1, output_dir = temp_dir, precision = 'float32')
+        assert best_n == 4
+
+def test_partial_fit_gmm_to_ab():
+    """
+    Test that streaming blocks of sites through stepwise EM recovers the batch fit
+    """
+    np.random.seed(3232)
+    dat = np.concatenate([np.random.normal(0.25, 0.05, 500), np.random.normal(0.5, 0.05, 1000), np.random.normal(0.75, 0.05, 500)])
+    np.random.shuffle(dat)
+    means, weights = get_fixed_params(3)
+    batch_gmm = GaussianMixtureFixedMeans(n_components = 3, means_init = means).fit(dat.reshape(-1, 1))
+    for model_constraints in [1, 2]:
+        gmms = {}
+        for start in range(0, len(dat), 200):
+            gmms = partial_fit_gmm_to_ab(gmms, dat[start:start + 200], [2,3,4,5,6], model_constraints)
+        bics = {p: gmm.bic(dat.reshape(-1, 1)) for p, gmm in gmms.items()}
+        assert min(bics, key = bics.get) == 4
+        assert gmms[4].n_batches_ == 10
+        assert np.allclose(gmms[4].covariances_.ravel(), batch_gmm.covariances_.ravel(), rtol = 0.1)
+    with pytest.raises(ValueError):
+        partial_fit_gmm_to_ab({}, dat, [2,3], 1, precision = 'float16')
+
+def test_select_ploidy_halving():
+    """
+    Test that successive halving keeps the true ploidy and agrees with the full selection
+    """
+    np.random.seed(3232)
+    dat = np.concatenate([np.random.normal(0.25, 0.05, 2000), np.random.normal(0.5, 0.05, 4000), np.random.normal(0.75, 0.05, 2000)]).reshape(-1, 1)
+    contenders, pruned = select_ploidy_halving('halving', dat, [2,3,4,5,6], 1, min_sites = 300)
+    assert 4 in contenders
+    assert sorted(contenders + list(pruned)) == [2,3,4,5,6]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        best_n, predictions = fit_gmm_to_ab(ind_name = 'halving', dat = dat, ploidy = [2,3,4,5,6], model_constraints = 1, output_dir = temp_dir, selection = 'halving')
+        assert best_n == 4
+        assert len(predictions) == len(dat)
+
+def test_prescreen_ploidy():
+    """
+    Test that the histogram pre-screen prunes an obvious diploid and keeps the true ploidy of a tetraploid
+    """
+    rng = np.random.default_rng(3232)
+    depth = rng.integers(30, 90, 5000)
+    diploid_ab = rng.binomial(depth, 0.5) / depth
+    assert prescreen_ploidy('diploid', diploid_ab, [2,3,4,5,6], depth) == [2]
+    tetraploid_ab = rng.binomial(depth, rng.integers(1, 4, 5000) / 4) / depth
+    assert 4 in prescreen_ploidy('tetraploid', tetraploid_ab, [2,3,4,5,6], depth)
+    assert prescreen_ploidy('few', diploid_ab[:100], [2,3,4,5,6], depth[:100]) == [2,3,4,5,6]
+
 #Place - holder function until working out some bugs
 def test_fit_mixed_model_ab():
     """
@@ -63,3 +135,303 @@ def test_fit_mixed_model_ab():
         assert lnLs == [-3736,-3728,-3716,-3825]
         assert pvalchecks == [1,1,1,1]
 
+
+def test_fit_mixed_model_ab_engines():
+    """
+    Test that the closed-form random intercept LMM matches statsmodels MixedLM
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        np.random.seed(3232)
+        allele_balance = np.concatenate([np.random.normal(0.25, 0.05, 500), np.random.normal(0.5, 0.05, 1000), np.random.normal(0.75, 0.05, 500)])
+        depth = np.random.randint(20, 100, size=2000)
+        predictions = np.repeat([0, 1, 2], [500, 1000, 500])
+        results = {}
+        for engine in ['numpy', 'statsmodels']:
+            results[engine] = fit_mixed_model_ab(ind_name = engine, allele_balance_data = allele_balance, site_depth_data = depth, gmm_predictions = predictions, output_dir = temp_dir, engine = engine)
+        fast_result, fast_rand_effects, fast_fixed_effects, fast_p_value = results['numpy']
+        sm_result, sm_rand_effects, sm_fixed_effects, sm_p_value = results['statsmodels']
+        assert np.isclose(fast_result.llf, sm_result.llf, rtol = 1e-6)
+        assert np.allclose(fast_fixed_effects.values, sm_fixed_effects.values, rtol = 1e-3)
+        for group in sm_rand_effects:
+            assert np.isclose(fast_rand_effects[group].iloc[0], sm_rand_effects[group].iloc[0], rtol = 1e-3)
+        assert np.isclose(fast_p_value, sm_p_value, rtol = 1e-3)
+
+def test_bootstrap_ploidy():
+    """
+    Test that block bootstrap support is high for a clear tetraploid and identical with worker processes
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from popopolus.fit_mixtures.bootstrap import bootstrap_ploidy
+    with tempfile.TemporaryDirectory() as temp_dir:
+        np.random.seed(3232)
+        dat = np.concatenate([np.random.normal(0.25, 0.05, 500), np.random.normal(0.5, 0.05, 1000), np.random.normal(0.75, 0.05, 500)])
+        np.random.shuffle(dat)
+        dat = dat.reshape(-1, 1)
+        best_n, predictions, fits = fit_gmm_to_ab(ind_name = 'boot', dat = dat, ploidy = [2,3,4,5,6], model_constraints = 1, output_dir = temp_dir, return_models = True)
+        boot = bootstrap_ploidy('boot', dat, fits, best_n, n_replicates = 200, block_size = 50, batch_size = 50)
+        assert best_n == 4
+        assert boot['support'] > 0.95
+        assert boot['dbic_lower'] > 0
+        with ProcessPoolExecutor(max_workers = 2) as executor:
+            parallel_boot = bootstrap_ploidy('boot', dat, fits, best_n, n_replicates = 200, block_size = 50, batch_size = 50, executor = executor)
+        assert parallel_boot == boot
+        # Ploidies pruned before the full fit are refitted so support is not conditional on the survivors
+        from popopolus.fit_mixtures.fit_mixtures import fit_bootstrap_candidates
+        settings = {'method': 'gmm', 'model_constraints': 1, 'ploidy_levels': [2,3,4,5,6], 'precision': 'float64', 'minimum_count': 1}
+        candidates = fit_bootstrap_candidates('boot', dat, {4: fits[4]}, settings)
+        assert list(candidates) == [2,3,4,5,6]
+        assert candidates[4] is fits[4]
+        candidate_boot = bootstrap_ploidy('boot', dat, candidates, best_n, n_replicates = 200, block_size = 50, batch_size = 50)
+        for key in boot:
+            assert np.isclose(candidate_boot[key], boot[key], rtol = 1e-3)
+
+def test_fit_mixture_to_ab():
+    """
+    Test that normal, gamma, and lognormal mixtures recover a tetraploid, that parallel restarts give the same fit, and that gmm-only options are rejected
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from popopolus.fit_mixtures.gmm2 import fit_mixture_to_ab, fit_mixture_model
+    np.random.seed(3232)
+    dat = np.concatenate([np.random.normal(0.25, 0.05, 500), np.random.normal(0.5, 0.05, 1000), np.random.normal(0.75, 0.05, 500)])
+    dat = dat[(dat > 0.05) & (dat < 0.95)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for model_type in ['normal', 'gamma', 'lognormal']:
+            best_n, predictions = fit_mixture_to_ab(ind_name = model_type, dat = dat, ploidy = [2,3,4,5,6], model_type = model_type, model_constraints = 1, output_dir = temp_dir)
+            assert best_n == 4
+            assert len(np.unique(predictions)) == 3
+    serial = fit_mixture_model(dat, 3, 'gamma', n_init = 4)
+    with ProcessPoolExecutor(max_workers = 2) as executor:
+        parallel = fit_mixture_model(dat, 3, 'gamma', n_init = 4, executor = executor, n_jobs = 2)
+    assert serial['log_likelihood'] == parallel['log_likelihood']
+    np.testing.assert_allclose(np.sort(serial['params'][0] * serial['params'][1]), [0.25, 0.5, 0.75], atol = 0.01)
+    from popopolus.fit_mixtures.fit_mixtures import est_ploidy
+    ab_dat = np.zeros((4, 10, 1), dtype = np.float32)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for options in [{'precision': 'float32'}, {'selection': 'halving'}, {'cache_dir': temp_dir}]:
+            with pytest.raises(ValueError):
+                est_ploidy(['a'], ab_dat, 'gamma', '2,4', 5, 1, temp_dir, plots = 'none', quiet = True, **options)
+
+def test_fit_betabinom_to_ab():
+    """
+    Test that beta-binomial mixtures on read counts recover simulated ploidies, match scipy on the distinct count pairs, and plot their fit
+    """
+    from scipy.stats import betabinom
+    from popopolus.fit_mixtures.betabinom import fit_betabinom_to_ab, betabinom_logpmf_table, BetaBinomialMixture
+    from scipy.special import gammaln
+    alt = np.array([1, 3, 5, 10, 20])
+    depth = np.array([10, 10, 30, 20, 40])
+    rho = 0.05
+    s = (1 - rho) / rho
+    table = betabinom_logpmf_table(alt, depth, np.array([0.25, 0.5]), rho, gammaln(np.arange(41) + 1))
+    expected = np.column_stack([betabinom.logpmf(alt, depth, m * s, (1 - m) * s) for m in [0.25, 0.5]])
+    np.testing.assert_allclose(table, expected)
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for ploidy in [2, 3, 4]:
+            dosage = rng.integers(1, ploidy, 5000) / ploidy
+            site_depth = rng.poisson(30, 5000) + 5
+            site_alt = rng.binomial(site_depth, rng.beta(dosage * 49, (1 - dosage) * 49))
+            ab = site_alt / site_depth
+            keep = (site_alt >= 1) & (site_alt <= site_depth - 1) & (ab > 0.05) & (ab < 0.95)
+            counts = np.column_stack([site_alt[keep], site_depth[keep]])
+            best_n, predictions, fits = fit_betabinom_to_ab(f'bb{ploidy}', counts, [2,3,4,5,6], 1, temp_dir, return_models = True)
+            assert best_n == ploidy
+            assert fits[ploidy].n_pairs_ < len(counts)
+            assert abs(fits[ploidy].rho - 0.02) < 0.01
+            assert os.path.exists(f'{temp_dir}/bb{ploidy}.fit.png')
+            edges = np.linspace(0, 1, 51)
+            np.testing.assert_allclose((fits[ploidy].ab_density(counts, edges) * np.diff(edges)[:, np.newaxis]).sum(axis = 0), fits[ploidy].weights)
+
+def test_fit_gmm_to_ab_cache():
+    """
+    Test that cached fits are reused across overlapping ploidy lists and that the cache stays under its size cap
+    """
+    import os
+    from popopolus.fit_mixtures.cache import FitCache
+    np.random.seed(3232)
+    dat = np.concatenate([np.random.normal(0.25, 0.05, 500), np.random.normal(0.5, 0.05, 1000), np.random.normal(0.75, 0.05, 500)]).reshape(-1, 1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = FitCache(f'{temp_dir}/cache')
+        best_n, predictions, fits = fit_gmm_to_ab('cache', dat, [2,3,4], 1, temp_dir, return_models = True, cache = cache)
+        assert (cache.hits, cache.misses) == (0, 3)
+        cached_n, cached_predictions, cached_fits = fit_gmm_to_ab('cache', dat, [2,4,6], 1, temp_dir, return_models = True, cache = cache)
+        assert (cache.hits, cache.misses) == (2, 4)
+        assert cached_n == best_n == 4
+        np.testing.assert_array_equal(cached_predictions, predictions)
+        assert cached_fits[4].bic(dat) == fits[4].bic(dat)
+        entry_size = max(os.path.getsize(f'{temp_dir}/cache/{name}') for name in os.listdir(f'{temp_dir}/cache'))
+        small_cache = FitCache(f'{temp_dir}/cache', max_bytes = 2 * entry_size)
+        small_cache.evict()
+        assert len(os.listdir(f'{temp_dir}/cache')) == 2
+
+def test_scan_windows():
+    """
+    Test that sliding windows find a triploid chromosome in an otherwise diploid individual
+    """
+    from popopolus.fit_mixtures.windows import scan_windows
+    rng = np.random.default_rng(0)
+    n_sites = 10000
+    chrom_index = np.repeat([0, 1], n_sites // 2)
+    positions = np.concatenate([np.sort(rng.integers(0, 3000000, n_sites // 2))] * 2)
+    ab = np.empty((n_sites, 2))
+    for i, chrom_ploidy in enumerate([[2, 2], [2, 3]]):
+        site_ploidy = np.array(chrom_ploidy)[chrom_index]
+        dosage = rng.integers(1, site_ploidy) / site_ploidy
+        ab[:, i] = np.clip(rng.normal(dosage, 0.05), 0.01, 0.99)
+    ab_dat = np.array([ab, np.full(ab.shape, 30), np.full(ab.shape, 50), np.ones(ab.shape)])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        window_df = scan_windows(['diploid', 'aneuploid'], ab_dat, (['chr1', 'chr2'], chrom_index, positions), '2,3,4', 1, temp_dir, window_size = 1000000, step = 500000)
+        written = np.loadtxt(f'{temp_dir}/windows.txt', skiprows = 1, usecols = (3, 4))
+    assert len(window_df) == 10
+    assert list(window_df.columns) == ['chrom', 'start', 'end', 'diploid', 'aneuploid']
+    assert (window_df['diploid'] == 2).all()
+    assert (window_df.loc[window_df['chrom'] == 'chr1', 'aneuploid'] == 2).all()
+    assert (window_df.loc[window_df['chrom'] == 'chr2', 'aneuploid'] == 3).all()
+    np.testing.assert_array_equal(written, window_df[['diploid', 'aneuploid']].to_numpy(dtype = float))
+
+def test_plot_renderer():
+    """
+    Test that queued fit plots are rendered in the background, that --plots none draws nothing, and that payloads stay small
+    """
+    import os
+    import pickle
+    from popopolus.fit_mixtures.render import PlotRenderer, gmm_plot_payload, summary_plot_payload
+    np.random.seed(41)
+    dat = np.concatenate([np.random.normal(0.33, 0.05, 20000), np.random.normal(0.67, 0.05, 20000)]).reshape(-1, 1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with PlotRenderer(temp_dir, 'none') as renderer:
+            best_n, predictions = fit_gmm_to_ab('none', dat, [2,3], 1, temp_dir, renderer = renderer)
+        assert not os.path.exists(f'{temp_dir}/none.fit.png')
+        with PlotRenderer(temp_dir, 'all', dpi = 50) as renderer:
+            best_n, predictions, fits = fit_gmm_to_ab('all', dat, [2,3], 1, temp_dir, return_models = True, renderer = renderer)
+            renderer.submit(summary_plot_payload({'all': best_n, 'skipped': None}, {'all': len(dat)}))
+        assert renderer.n_rendered == 2 and renderer.n_failed == 0
+        assert os.path.exists(f'{temp_dir}/all.fit.png')
+        assert os.path.exists(f'{temp_dir}/ploidy_summary.png')
+        assert len(pickle.dumps(gmm_plot_payload(dat, fits[3], 'size', 'size'))) < 20000
+
+def test_lmm_plot_payload():
+    """
+    Test that LMM plot payloads of many sites are a seeded subsample that keeps the share of every component
+    """
+    import pickle
+    from popopolus.fit_mixtures.lmm import fit_random_intercept_lmm
+    from popopolus.fit_mixtures.render import lmm_plot_payload
+    rng = np.random.default_rng(5)
+    n_sites = 500000
+    site_class = rng.choice([0, 1, 2], n_sites, p = [0.25, 0.5, 0.25])
+    ref = rng.poisson(30, n_sites).astype(float)
+    alt = (site_class + 1) / 4 * ref / (1 - (site_class + 1) / 4) + rng.normal(0, 2, n_sites)
+    result = fit_random_intercept_lmm(alt, ref, site_class)
+    payload = lmm_plot_payload('big', alt, ref, site_class, result, max_points = 20000)
+    assert len(payload['alt']) == len(payload['codes']) == 20000
+    assert payload['components'] == ['0', '1', '2']
+    np.testing.assert_allclose(np.bincount(payload['codes']) / 20000, [0.25, 0.5, 0.25], atol = 0.02)
+    assert len(pickle.dumps(payload)) < 300000
+    again = lmm_plot_payload('big', alt, ref, site_class, result, max_points = 20000)
+    np.testing.assert_array_equal(again['alt'], payload['alt'])
+
+def test_results_store(capsys):
+    """
+    Test that est_ploidy records every model, call, and LMM test in the SQLite store without .fit.txt files or prints in quiet mode
+    """
+    import os
+    import sqlite3
+    from popopolus.fit_mixtures.fit_mixtures import est_ploidy
+    rng = np.random.default_rng(13)
+    ab = np.concatenate([rng.normal(0.25, 0.04, (600, 3)), rng.normal(0.5, 0.04, (600, 3)), rng.normal(0.75, 0.04, (600, 3))])
+    ab[:, 0] = rng.normal(0.5, 0.05, 1800)
+    depth = rng.integers(20, 60, ab.shape).astype(float)
+    ab_dat = np.array([ab, depth, depth, np.ones(ab.shape)])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for run in range(2):
+            est_ploidy(['dip', 'tet1', 'tet2'], ab_dat, 'gmm', '2,4', 50, 1, temp_dir, plots = 'none', results_db = f'{temp_dir}/results.db', quiet = True)
+        assert 'Log-Likelihood' not in capsys.readouterr().out
+        assert not os.path.exists(f'{temp_dir}/dip.fit.txt')
+        connection = sqlite3.connect(f'{temp_dir}/results.db')
+        runs = connection.execute('SELECT run_id, finished FROM runs').fetchall()
+        assert len(runs) == 2 and all(finished is not None for _, finished in runs)
+        run_id = runs[1][0]
+        assert connection.execute('SELECT COUNT(*) FROM models WHERE run_id = ?', (run_id,)).fetchone()[0] == 6
+        calls = dict(connection.execute('SELECT individual, ploidy FROM calls WHERE run_id = ?', (run_id,)).fetchall())
+        assert calls == {'dip': 2, 'tet1': 4, 'tet2': 4}
+        lmm_individuals = [row[0] for row in connection.execute('SELECT individual FROM lmm WHERE run_id = ? ORDER BY individual', (run_id,))]
+        assert lmm_individuals == ['tet1', 'tet2']
+        plan = connection.execute('EXPLAIN QUERY PLAN SELECT * FROM models WHERE individual = ?', ('tet1',)).fetchall()
+        assert 'models_individual' in str(plan)
+        connection.close()
+
+def test_est_ploidy_resume(monkeypatch):
+    """
+    Test that a run killed midway resumes from the completion records, fits only the remaining individuals, and writes the same ploidy.txt
+    and the calls of every individual under one run of the results database
+    """
+    import pytest
+    import sqlite3
+    import popopolus.fit_mixtures.fit_mixtures as fit_mixtures
+    from popopolus.checkpoint import save_ingestion, load_ingestion
+    rng = np.random.default_rng(17)
+    ab = np.concatenate([rng.normal(0.25, 0.04, (600, 4)), rng.normal(0.5, 0.04, (600, 4)), rng.normal(0.75, 0.04, (600, 4))])
+    ab[:, 0] = rng.normal(0.5, 0.05, 1800)
+    depth = rng.integers(20, 60, ab.shape).astype(float)
+    ab_dat = np.array([ab, depth, depth, np.ones(ab.shape)]).astype(np.float32)
+    tax_list = ['a', 'b', 'c', 'd']
+    original_fit = fit_mixtures.fit_gmm_to_ab
+    fitted = []
+    def fit_until_c(ind_name, *args, **kwargs):
+        if ind_name == 'c':
+            raise RuntimeError('preempted')
+        fitted.append(ind_name)
+        return(original_fit(ind_name, *args, **kwargs))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fit_mixtures.est_ploidy(tax_list, ab_dat, 'gmm', '2,4', 50, 1, temp_dir, plots = 'none', quiet = True)
+        with open(f'{temp_dir}/ploidy.txt') as fh:
+            expected = fh.read()
+        save_ingestion(temp_dir, tax_list, ab_dat, {'vcf': 'x'})
+        cached_tax, cached_dat = load_ingestion(temp_dir, {'vcf': 'x'})
+        assert cached_tax == tax_list and np.array_equal(cached_dat, ab_dat)
+        assert load_ingestion(temp_dir, {'vcf': 'y'}) is None
+        monkeypatch.setattr(fit_mixtures, 'fit_gmm_to_ab', fit_until_c)
+        with pytest.raises(RuntimeError):
+            fit_mixtures.est_ploidy(tax_list, cached_dat, 'gmm', '2,4', 50, 1, temp_dir, plots = 'none', quiet = True, checkpoint_dir = temp_dir, results_db = f'{temp_dir}/results.db')
+        assert fitted == ['a', 'b']
+        with pytest.raises(ValueError):
+            fit_mixtures.est_ploidy(tax_list, cached_dat, 'gmm', '2,6', 50, 1, temp_dir, plots = 'none', quiet = True, checkpoint_dir = temp_dir, resume = True)
+        fitted.clear()
+        monkeypatch.setattr(fit_mixtures, 'fit_gmm_to_ab', lambda *args, **kwargs: (fitted.append(args[0]), original_fit(*args, **kwargs))[1])
+        fit_mixtures.est_ploidy(tax_list, cached_dat, 'gmm', '2,4', 50, 1, temp_dir, plots = 'none', quiet = True, checkpoint_dir = temp_dir, resume = True, results_db = f'{temp_dir}/results.db')
+        assert fitted == ['c', 'd']
+        with open(f'{temp_dir}/ploidy.txt') as fh:
+            assert fh.read() == expected
+        connection = sqlite3.connect(f'{temp_dir}/results.db')
+        runs = connection.execute('SELECT run_id, finished FROM runs').fetchall()
+        assert len(runs) == 1 and runs[0][1] is not None
+        assert connection.execute('SELECT individual, run_id FROM calls ORDER BY individual').fetchall() == [(tax, runs[0][0]) for tax in tax_list]
+        assert connection.execute('SELECT COUNT(*) FROM models').fetchone()[0] == 8
+        connection.close()
+
+def test_compact_individuals():
+    """
+    Test that the individual-major buffers hold the filtered and truncated sites of every individual and give the same ploidy calls
+    """
+    from popopolus.fit_mixtures.layout import compact_individuals
+    from popopolus.fit_mixtures.fit_mixtures import est_ploidy
+    rng = np.random.default_rng(37)
+    ab = np.concatenate([rng.normal(0.25, 0.04, (500, 3)), rng.normal(0.5, 0.04, (500, 3)), rng.normal(0.75, 0.04, (500, 3))])
+    ab[:, 1] = rng.normal(0.5, 0.05, 1500)
+    ab[rng.random(ab.shape) < 0.05] = 0.99
+    depth = rng.integers(20, 60, ab.shape).astype(float)
+    passing = rng.random(ab.shape) < 0.8
+    passing[:, 2] = False
+    passing[:30, 2] = True
+    ab_dat = np.array([ab, depth, depth, passing]).astype(np.float32)
+    compact_ab, compact_depth, offsets = compact_individuals(ab_dat, block_size = 128)
+    for i in range(3):
+        keep = passing[:, i] & (ab_dat[0, :, i] > 0.05) & (ab_dat[0, :, i] < 0.95)
+        np.testing.assert_array_equal(compact_ab[offsets[i]:offsets[i + 1]], ab_dat[0, keep, i])
+        np.testing.assert_array_equal(compact_depth[offsets[i]:offsets[i + 1]], ab_dat[1, keep, i])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        by_sites = est_ploidy(['a', 'b', 'c'], ab_dat, 'gmm', '2,4', 50, 1, temp_dir, plots = 'none', quiet = True)
+        by_individuals = est_ploidy(['a', 'b', 'c'], ab_dat, 'gmm', '2,4', 50, 1, temp_dir, plots = 'none', quiet = True, layout = 'individuals')
+    assert by_sites.equals(by_individuals)
+    assert list(by_individuals['Ploidy'][:2]) == [4, 2] and np.isnan(by_individuals['Ploidy'][2])
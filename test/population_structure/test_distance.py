@@ -0,0 +1,66 @@
+import numpy as np
+import tempfile
+from popopolus.calculate_frequencies.vcf_blocks import array_genotype_blocks, iter_genotype_blocks
+from popopolus.population_structure.distance import accumulate_distances, write_distances
+
+def simulate_ab_dat(rng, ploidy, n_sites, min_depth=10, min_count=3, min_qual=20):
+    """
+    Allele balance data as get_ind_freqs returns it for reads sampled from outbred individuals of the given ploidies.
+    The passing row keeps heterozygotes only, as get_ind_freqs does.
+    """
+    shape = (n_sites, len(ploidy))
+    p = rng.uniform(0.05, 0.95, n_sites)
+    dosage = rng.binomial(ploidy[np.newaxis, :], p[:, np.newaxis])
+    depth = rng.integers(15, 40, shape)
+    alt = rng.binomial(depth, dosage / ploidy[np.newaxis, :])
+    gq = np.where(rng.random(shape) < 0.1, 5, 50)
+    passing = (depth >= min_depth) & (depth - alt >= 1) & (alt >= min_count) & (gq >= min_qual)
+    return(np.array([alt / depth, depth, gq, passing]).astype(np.float32), alt)
+
+def test_accumulate_distances():
+    """
+    Test blockwise distances against pairwise loops, and that outbred diploids and tetraploids get a self-kinship near 1/ploidy
+    and an inbreeding coefficient near 0 when homozygotes count and read sampling variance is removed
+    """
+    rng = np.random.default_rng(4)
+    ploidy = np.repeat([2, 4], 30)
+    ab_dat, _ = simulate_ab_dat(rng, ploidy, 20000)
+    ab = ab_dat[0]
+    valid = ab_dat[2] >= 20
+    distance, kinship, n_shared = accumulate_distances(array_genotype_blocks(ab_dat, 10, 20, block_size = 3000), ploidy)
+    for i in range(0, 60, 7):
+        for j in range(0, 60, 5):
+            shared = valid[:, i] & valid[:, j]
+            assert n_shared[i, j] == shared.sum()
+            if i != j:
+                expected = np.sqrt(np.mean((ab[shared, i].astype(np.float64) - ab[shared, j]) ** 2))
+                assert np.isclose(distance[i, j], expected)
+    # p is estimated from the same 60 individuals, which biases kinship down by about 1/60
+    np.testing.assert_allclose(np.diag(kinship), 1 / ploidy, rtol = 0.1)
+    assert np.abs(kinship[~np.eye(60, dtype = bool)]).max() < 0.05
+    with tempfile.TemporaryDirectory() as temp_dir:
+        inbreeding = write_distances([f'i{i}' for i in range(60)], ploidy, distance, kinship, n_shared, temp_dir)
+    for k in [2, 4]:
+        assert abs(inbreeding['inbreeding'][ploidy == k].mean()) < 0.05
+    dosage_distance, _, _ = accumulate_distances(array_genotype_blocks(ab_dat, 10, 20, block_size = 3000), ploidy, use_dosage = True)
+    assert np.all(np.isfinite(dosage_distance))
+
+def test_distances_from_vcf():
+    """
+    Test that distances streamed from VCF blocks match those from the allele balance arrays of the same genotypes
+    """
+    rng = np.random.default_rng(8)
+    ploidy = np.array([2, 2, 4, 4, 2])
+    ab_dat, alt = simulate_ab_dat(rng, ploidy, 150)
+    depth = ab_dat[1].astype(int)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf'
+        with open(vcf_file, 'w') as outfile:
+            outfile.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(f'i{k}' for k in range(5)) + '\n')
+            for j in range(150):
+                genotypes = [f'0/1:{depth[j, k] - alt[j, k]},{alt[j, k]}:{depth[j, k]}:{int(ab_dat[2, j, k])}:0,0,0' for k in range(5)]
+                outfile.write(f'chr1\t{j + 1}\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ:PL\t' + '\t'.join(genotypes) + '\n')
+        streamed = accumulate_distances(iter_genotype_blocks(vcf_file, np.arange(5), False, 10, 20, block_size = 40), ploidy)
+    expected = accumulate_distances(array_genotype_blocks(ab_dat, 10, 20, block_size = 64), ploidy)
+    for streamed_mat, expected_mat in zip(streamed, expected):
+        np.testing.assert_allclose(streamed_mat, expected_mat, rtol = 1e-6)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import tempfile
+from popopolus.population_structure.fst import calculate_fst
+
+def test_calculate_fst():
+    """
+    Test genome-wide and windowed Hudson Fst against a site-by-site calculation, including a window split across blocks
+    """
+    rng = np.random.default_rng(5)
+    n_sites = 90
+    sample_names = ['a1', 'a2', 'b1', 'b2', 'c1', 'c2']
+    ind_map = {name: {'population': name[0], 'ploidy': 4 if name[0] == 'c' else np.nan} for name in sample_names}
+    freqs = np.column_stack([rng.random(n_sites), rng.random(n_sites), rng.random(n_sites)])
+    depth = rng.integers(5, 40, (n_sites, 6))
+    alt = rng.binomial(depth, np.repeat(freqs, 2, axis = 1))
+    positions = np.arange(n_sites) * 1000 + 1
+    chroms = np.where(np.arange(n_sites) < 60, 'chr1', 'chr2')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with open(f'{temp_dir}/test.vcf', 'w') as outfile:
+            outfile.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(sample_names) + '\n')
+            for j in range(n_sites):
+                genotypes = [f'0/1:{depth[j, k] - alt[j, k]},{alt[j, k]}:{depth[j, k]}:50:0,0,0' for k in range(6)]
+                outfile.write(f'{chroms[j]}\t{positions[j]}\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ:PL\t' + '\t'.join(genotypes) + '\n')
+        fst_df = calculate_fst(ind_map, f'{temp_dir}/test.vcf', 10, 1, temp_dir, window_size = 25000, block_size = 16)
+        window_df = pd.read_csv(f'{temp_dir}/fst.windows.txt', sep = '\t')
+    passing = depth >= 10
+    n_chrom = np.where(passing, np.array([2, 2, 2, 2, 4, 4]), 0)
+    pop_alt = np.add.reduceat(np.where(passing, alt, 0), [0, 2, 4], axis = 1)
+    pop_depth = np.add.reduceat(np.where(passing, depth, 0), [0, 2, 4], axis = 1)
+    pop_n = np.add.reduceat(n_chrom, [0, 2, 4], axis = 1)
+    window_index = np.array([f'{c}:{(p - 1) // 25000}' for c, p in zip(chroms, positions)])
+    assert list(window_df.columns) == ['chrom', 'start', 'end', 'n_sites', 'a:b', 'a:c', 'b:c']
+    assert window_df['n_sites'].sum() == n_sites
+    for m, (i, j) in enumerate([(0, 1), (0, 2), (1, 2)]):
+        numerator = np.zeros(n_sites)
+        denominator = np.zeros(n_sites)
+        for s in range(n_sites):
+            if min(pop_n[s, i], pop_n[s, j]) >= 2 and min(pop_depth[s, i], pop_depth[s, j]) > 0:
+                p1 = pop_alt[s, i] / pop_depth[s, i]
+                p2 = pop_alt[s, j] / pop_depth[s, j]
+                numerator[s] = (p1 - p2) ** 2 - p1 * (1 - p1) / (pop_n[s, i] - 1) - p2 * (1 - p2) / (pop_n[s, j] - 1)
+                denominator[s] = p1 * (1 - p2) + p2 * (1 - p1)
+        assert np.isclose(fst_df['fst'][m], numerator.sum() / denominator.sum(), rtol = 1e-5)
+        expected_windows = [numerator[window_index == w].sum() / denominator[window_index == w].sum() for w in pd.unique(window_index)]
+        np.testing.assert_allclose(window_df.iloc[:, 4 + m], expected_windows, rtol = 1e-4)
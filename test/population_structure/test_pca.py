@@ -0,0 +1,61 @@
+import numpy as np
+import tempfile
+from popopolus.calculate_frequencies.vcf_blocks import array_genotype_blocks, iter_genotype_blocks
+from popopolus.population_structure.pca import randomized_pca, centred_block
+
+def test_randomized_pca():
+    """
+    Test that streamed randomized PCA matches an in-memory SVD of the centred matrix with failing genotypes masked
+    and homozygous genotypes kept
+    """
+    rng = np.random.default_rng(2)
+    n_sites, n_tax = 3000, 40
+    pop_freqs = rng.uniform(0.1, 0.9, (n_sites, 3))
+    group = np.repeat([0, 1, 2], [15, 15, 10])
+    ab = np.clip(pop_freqs[:, group] + rng.normal(0, 0.05, (n_sites, n_tax)), 0.01, 0.99)
+    # A fifth of the genotypes are homozygous
+    ab = np.where(rng.random((n_sites, n_tax)) < 0.2, rng.integers(0, 2, (n_sites, n_tax)), ab).astype(np.float32)
+    gq = np.where(rng.random((n_sites, n_tax)) > 0.1, 50, 5)
+    passing = (gq >= 20) & (ab > 0) & (ab < 1)
+    ab_dat = np.array([ab, np.full(ab.shape, 20), gq, passing]).astype(np.float32)
+    blocks = lambda: array_genotype_blocks(ab_dat, 10, 20, block_size = 700)
+    # Homozygous genotypes raise the noise spectrum, so the power iterations need more passes to converge to the SVD
+    with tempfile.TemporaryDirectory() as temp_dir:
+        scores, eigenvalues, explained = randomized_pca(blocks, n_tax, n_components = 2, n_iter = 8, loadings_file = f'{temp_dir}/loadings.txt')
+        loadings = np.loadtxt(f'{temp_dir}/loadings.txt', skiprows = 1)
+    centred = centred_block(ab, gq >= 20)
+    u, s, vt = np.linalg.svd(centred, full_matrices = False)
+    np.testing.assert_allclose(eigenvalues, s[:2] ** 2, rtol = 1e-6)
+    np.testing.assert_allclose(explained, s[:2] ** 2 / (s ** 2).sum(), rtol = 1e-6)
+    np.testing.assert_allclose(np.abs(scores), np.abs(vt[:2].T * s[:2]), atol = 1e-6 * s[0])
+    np.testing.assert_allclose(np.abs(loadings[:, 1:]), np.abs(u[:, :2]), atol = 1e-6)
+    assert loadings.shape == (n_sites, 3)
+    # The two components separate the three simulated populations
+    for g in range(3):
+        assert np.ptp(scores[group == g, :2], axis = 0).max() < np.ptp(scores[:, :2], axis = 0).min() / 3
+
+def test_pca_from_vcf():
+    """
+    Test that PCA streamed from a VCF matches PCA of the allele balance arrays of the same genotypes, with loadings labelled by position
+    """
+    rng = np.random.default_rng(6)
+    n_sites, n_tax = 200, 6
+    depth = rng.integers(15, 40, (n_sites, n_tax))
+    alt = rng.binomial(depth, rng.uniform(0, 1, n_sites)[:, np.newaxis])
+    gq = np.where(rng.random((n_sites, n_tax)) > 0.1, 50, 5)
+    ab_dat = np.array([alt / depth, depth, gq, gq >= 20]).astype(np.float32)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf'
+        with open(vcf_file, 'w') as outfile:
+            outfile.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(f'i{k}' for k in range(n_tax)) + '\n')
+            for j in range(n_sites):
+                genotypes = [f'0/1:{depth[j, k] - alt[j, k]},{alt[j, k]}:{depth[j, k]}:{gq[j, k]}:0,0,0' for k in range(n_tax)]
+                outfile.write(f'chr1\t{j + 1}\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ:PL\t' + '\t'.join(genotypes) + '\n')
+        streamed = randomized_pca(lambda: iter_genotype_blocks(vcf_file, np.arange(n_tax), False, 10, 20, block_size = 64), n_tax, n_components = 2,
+                                  loadings_file = f'{temp_dir}/loadings.txt')
+        with open(f'{temp_dir}/loadings.txt') as infile:
+            assert infile.readline().split() == ['chrom', 'pos', 'PC1', 'PC2']
+            assert infile.readline().split()[:2] == ['chr1', '1']
+    expected = randomized_pca(lambda: array_genotype_blocks(ab_dat, 10, 20, block_size = 50), n_tax, n_components = 2)
+    for streamed_mat, expected_mat in zip(streamed, expected):
+        np.testing.assert_allclose(streamed_mat, expected_mat, rtol = 1e-5, atol = 1e-6)
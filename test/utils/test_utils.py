@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from popopolus.utils import map_individuals
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'sklearn', 'matplotlib', 'seaborn', 'statsmodels']
+
+def test_map_individuals():
+    """
+    Test that the csv sample sheet reader keeps ids as strings, parses numbers, and treats empty cells as missing
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with open(f'{temp_dir}/sheet.csv', 'w') as outfile:
+            outfile.write('individual, population,ploidy\n')
+            outfile.write('ind1,north,4\n')
+            outfile.write('007,south,\n')
+            outfile.write('ind3, south ,NA\n')
+        ind_map = map_individuals(f'{temp_dir}/sheet.csv')
+    assert list(ind_map) == ['ind1', '007', 'ind3']
+    assert ind_map['ind1'] == {'population': 'north', 'ploidy': 4}
+    assert ind_map['007']['ploidy'] is None
+    assert ind_map['ind3'] == {'population': 'south', 'ploidy': None}
+
+def test_import_time():
+    """
+    Import-time regression benchmark: the CLI and --help must not import heavy dependencies and must return quickly
+    """
+    check = f'import sys; import popopolus_cli, popopolus, popopolus.utils; print(",".join(m for m in {HEAVY_MODULES} if m in sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', check], cwd = REPO_DIR, capture_output = True, text = True, check = True)
+    assert loaded.stdout.strip() == ''
+    check = f'import sys; import popopolus.fit_mixtures.fit_mixtures; print(",".join(m for m in ["matplotlib", "seaborn", "statsmodels"] if m in sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', check], cwd = REPO_DIR, capture_output = True, text = True, check = True)
+    assert loaded.stdout.strip() == ''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for args in [['--help'], ['estimate_ploidy', '--help'], ['estimate_ploidy', '--no_such_option']]:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {REPO_DIR!r}); from popopolus_cli import cli; cli({args!r})'], cwd = temp_dir, capture_output = True)
+            assert time.perf_counter() - start < 1.0
+
+def test_shared_array():
+    """
+    Test that shared arrays in shared memory and memory-mapped files are seen by attached views and spawned processes, and removed by unlink
+    """
+    import multiprocessing
+    import pytest
+    from concurrent.futures import ProcessPoolExecutor
+    import numpy as np
+    from popopolus.shared import SharedArray, attach
+    values = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for directory in [None, temp_dir]:
+            with SharedArray.create(values.shape, np.float32, directory) as shared:
+                shared.array[:] = values
+                view = SharedArray(shared.handle)
+                view.array[1, 2, 3] = -1
+                assert shared.array[1, 2, 3] == -1
+                view.close()
+                assert attach(shared.handle) is shared.array
+                with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as executor:
+                    attached = executor.submit(attach, shared.handle).result()
+                np.testing.assert_array_equal(attached, shared.array)
+                handle = shared.handle
+            if directory is None:
+                with pytest.raises(FileNotFoundError):
+                    SharedArray(handle)
+            else:
+                assert os.listdir(temp_dir) == []